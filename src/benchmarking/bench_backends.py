@@ -0,0 +1,131 @@
+import argparse
+import json
+import math
+import sys
+import time
+
+import numpy as np
+
+from graph_utils import get_graph_arrays, read_graph_from_dataset
+from mip_backends import BACKENDS, district_area_perimeter, solve_with_backend
+from solution_io import district_indices, read_solution
+
+"""
+Compares the solver backends of mip_backends on the bundled datasets, with and without graph reduction, and checks
+every result against the stored optimum of the instance in data/solutions and the best single node district. A
+reported bound above a known district, an optimal objective that differs from the stored optimum or is worse than a
+known district is a mismatch; the benchmark then exits with code 1. Run from the repository root with the solver
+modules on the PYTHONPATH:
+    PYTHONPATH=src:src/mip_solving:src/preprocessing python src/benchmarking/bench_backends.py
+A backend that fails on an instance (e.g., the size-limited Gurobi licence) is reported with its error.
+"""
+
+DATASETS = ["issoire", "avignon", "braunschweig", "karlsruhe", "neumuenster", "rheinruhr"]
+
+
+def reference_scores(DG, dataset: str, area_lower_bound: float) -> tuple[float | None, float]:
+    """
+    Scores to check a result against, both recomputed on the graph.
+    :return: The score of the stored optimal solution (None if there is none, it is not optimal or has no area) and
+        the best score of a known district (stored solution or single node).
+    """
+    arrays = get_graph_arrays(DG)
+    optimum = None
+    try:
+        metadata, fids, _ = read_solution(dataset + (f"_LB={area_lower_bound}" if area_lower_bound > 0 else ""))
+        area, perimeter = district_area_perimeter(arrays, district_indices(arrays.fids, fids))
+        if area > 0 and area >= area_lower_bound and metadata.get('status') in (2, 'OPTIMAL'):
+            optimum = perimeter * perimeter / (4 * math.pi * area)
+    except FileNotFoundError:
+        pass
+
+    total_perim = arrays.boundary_perim + np.bincount(arrays.arc_tails(), weights=arrays.shared_perim,
+                                                      minlength=arrays.num_nodes)
+    feasible = (arrays.node_weight > 0) & (arrays.node_weight >= area_lower_bound)
+    singles = total_perim[feasible] ** 2 / (4 * math.pi * arrays.node_weight[feasible])
+    best_known = float(singles.min()) if len(singles) else math.inf
+    return optimum, best_known if optimum is None else min(best_known, optimum)
+
+
+def check_result(result: dict, tolerance: float = 1e-4) -> str | None:
+    """The mismatch of a result with the reference scores (None if it is consistent)."""
+    slack = tolerance * max(1.0, result['best_known'])
+    if result['bound'] > result['best_known'] + slack:
+        return f"bound {result['bound']:.4f} above the known district {result['best_known']:.4f}"
+    if result['status'] != 'OPTIMAL':
+        return None
+    if result['optimum'] is not None and abs(result['objective'] - result['optimum']) > slack:
+        return f"optimal objective {result['objective']:.4f}, stored optimum {result['optimum']:.4f}"
+    if result['objective'] > result['best_known'] + slack:
+        return f"optimal objective {result['objective']:.4f} above the known district {result['best_known']:.4f}"
+    return None
+
+
+def run_benchmark(datasets: list[str], area_lower_bounds: list[float], backends: list[str],
+                  time_limit: float = 600, threads: int = 1, reductions: tuple[bool, ...] = (True, False)) -> list[dict]:
+    """
+    Solves every (dataset, area lower bound) instance with every backend, with and without graph reduction.
+
+    :return: One result dict per instance, backend and reduction.
+    """
+    results = []
+    for dataset in datasets:
+        DG = read_graph_from_dataset(dataset)
+        for area_lower_bound in area_lower_bounds:
+            optimum, best_known = reference_scores(DG, dataset, area_lower_bound)
+            for backend in backends:
+                for reduce in reductions:
+                    result = {'dataset': dataset, 'area_lower_bound': area_lower_bound, 'backend': backend,
+                              'reduce': reduce, 'optimum': optimum, 'best_known': best_known}
+                    start = time.perf_counter()
+                    try:
+                        solved = solve_with_backend(DG, area_lower_bound, backend=backend, threads=threads,
+                                                    time_limit=time_limit, reduce=reduce, verbose=False)
+                        result.update(status=solved.status, objective=solved.objective, bound=solved.bound,
+                                      district_size=len(solved.solution) if solved.solution is not None else 0,
+                                      node_count=solved.node_count, num_lazy_cuts=solved.num_lazy_cuts,
+                                      solver_time=solved.runtime)
+                        result['mismatch'] = check_result(result)
+                    except Exception as e:
+                        result['error'] = repr(e)
+                    result['time'] = time.perf_counter() - start
+                    results.append(result)
+    return results
+
+
+def print_results(results: list[dict]) -> None:
+    """Prints one line per instance, backend and reduction."""
+    print(f"{'dataset':<14}{'LB':>10}  {'backend':<8}{'reduce':<8}{'status':<16}{'objective':>11}{'bound':>11}"
+          f"{'optimum':>11}{'nodes':>9}{'cuts':>7}{'time':>9}")
+    for r in results:
+        head = f"{r['dataset']:<14}{r['area_lower_bound']:>10g}  {r['backend']:<8}{'on' if r['reduce'] else 'off':<8}"
+        if 'error' in r:
+            print(f"{head}ERROR {r['error'][:80]}")
+            continue
+        objective = "-" if math.isinf(r['objective']) else f"{r['objective']:.4f}"
+        optimum = "-" if r['optimum'] is None else f"{r['optimum']:.4f}"
+        print(f"{head}{r['status']:<16}{objective:>11}{r['bound']:>11.4f}{optimum:>11}{r['node_count']:>9}"
+              f"{r['num_lazy_cuts']:>7}{r['time']:>8.2f}s{'  MISMATCH: ' + r['mismatch'] if r['mismatch'] else ''}")
+
+
+parser = argparse.ArgumentParser(description="Compare the solver backends on the bundled datasets")
+parser.add_argument('-d', '--datasets', nargs='+', default=DATASETS, help='Datasets to solve')
+parser.add_argument('-l', '--lower-bounds', type=float, nargs='+', default=[0, 1e6], help='Area lower bounds')
+parser.add_argument('-b', '--backends', nargs='+', choices=list(BACKENDS), default=list(BACKENDS),
+                    help='Backends to compare')
+parser.add_argument('-r', '--reduce', choices=['on', 'off', 'both'], default='both',
+                    help='Solve with graph reduction, without or both')
+parser.add_argument('--time-limit', type=float, default=600, help='Time limit per solve in seconds')
+parser.add_argument('-t', '--threads', type=int, default=1, help='Threads per solve')
+parser.add_argument('-o', '--output', type=str, default=None, help='Write the results to this json file')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    reductions = {'on': (True,), 'off': (False,), 'both': (True, False)}[args.reduce]
+    results = run_benchmark(args.datasets, args.lower_bounds, args.backends, args.time_limit, args.threads,
+                            reductions)
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    sys.exit(1 if any(r.get('mismatch') for r in results) else 0)
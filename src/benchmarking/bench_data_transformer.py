@@ -0,0 +1,102 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+
+from data_transformer import write_graph_to_container, write_graph_to_csv
+
+"""
+Throughput benchmark of the dual graph converter in data_transformer on synthetic grid graphs. Every run converts the
+file in a fresh process, so the reported peak memory belongs to that run only.
+Run with src/preprocessing on the PYTHONPATH:
+    PYTHONPATH=src/preprocessing python src/benchmarking/bench_data_transformer.py
+"""
+
+
+def write_synthetic_dual_graph(path: str, rows: int, cols: int, seed: int = 0) -> int:
+    """
+    Writes the dual graph of a rows x cols grid of cells (plus the outside vertex -1) in the text format read by
+    data_transformer. Every edge is written in both directions, in random order.
+
+    :return: The number of edge lines in the file.
+    """
+    rng = np.random.default_rng(seed)
+    ids = np.arange(rows * cols).reshape(rows, cols)
+
+    # Right and lower neighbors inside the grid, the outside vertex for cells on the border
+    border = np.unique(np.concatenate((ids[0, :], ids[-1, :], ids[:, 0], ids[:, -1])))
+    sources = np.concatenate((ids[:, :-1].ravel(), ids[:-1, :].ravel(), border))
+    targets = np.concatenate((ids[:, 1:].ravel(), ids[1:, :].ravel(), np.full(len(border), -1)))
+    weights = rng.uniform(1, 1000, len(sources))
+
+    # Both directions in random order
+    order = rng.permutation(2 * len(sources))
+    from_ids = np.concatenate((sources, targets))[order]
+    to_ids = np.concatenate((targets, sources))[order]
+    weights = np.concatenate((weights, weights))[order]
+    areas = rng.uniform(1, 1e6, rows * cols)
+
+    with open(path, "w") as file:
+        file.write(f"{rows * cols + 1} {len(from_ids)}\n")
+        file.write("v -1 0\n")
+        file.writelines(f"v {i} {a!r}\n" for i, a in enumerate(areas.tolist()))
+        file.writelines(f"e {u} {v} {w!r}\n" for u, v, w in zip(from_ids.tolist(), to_ids.tolist(), weights.tolist()))
+    return len(from_ids)
+
+
+def _convert(input_file: str, output_prefix: str, output_format: str, queue):
+    """Converts the file in a worker process and reports the time and the peak memory."""
+    start = time.perf_counter()
+    if output_format == "csv":
+        write_graph_to_csv(input_file, f"{output_prefix}_vertices.csv", f"{output_prefix}_edges.csv")
+    else:
+        write_graph_to_container(input_file, f"{output_prefix}_graph.bin")
+    queue.put((time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def run_benchmark(sizes: list[int], formats: list[str]) -> list[dict]:
+    """
+    Converts a synthetic square grid of every size with every output format.
+
+    :param sizes: Side lengths of the grids.
+    :param formats: Output formats ('csv', 'binary').
+    :return: One result per size and format.
+    """
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            input_file = os.path.join(directory, f"grid_{size}.txt")
+            # Generate the file in a separate process as well, the peak memory is inherited by spawned processes
+            with context.Pool(1) as pool:
+                num_edges = pool.apply(write_synthetic_dual_graph, (input_file, size, size))
+            input_mb = os.path.getsize(input_file) / 2 ** 20
+
+            for output_format in formats:
+                queue = context.Queue()
+                process = context.Process(target=_convert, args=(input_file, os.path.join(directory, f"out_{size}"),
+                                                                  output_format, queue))
+                process.start()
+                seconds, peak_mb = queue.get()
+                process.join()
+
+                result = {'size': size, 'format': output_format, 'edges': num_edges, 'input_mb': input_mb,
+                          'seconds': seconds, 'edges_per_second': num_edges / seconds, 'peak_mb': peak_mb}
+                results.append(result)
+                print(f"{size}x{size} grid, {num_edges} edges ({input_mb:.0f} MB) -> {output_format}: "
+                      f"{seconds:.2f}s, {result['edges_per_second'] / 1e6:.2f}M edges/s, peak {peak_mb:.0f} MB")
+    return results
+
+
+parser = argparse.ArgumentParser(description="Throughput benchmark of the dual graph converter")
+parser.add_argument('--sizes', type=int, nargs='+', default=[250, 500, 1000],
+                    help='Side lengths of the synthetic grids (a side length of 1000 gives about 4M edge lines)')
+parser.add_argument('--formats', nargs='+', choices=['csv', 'binary'], default=['csv', 'binary'], help='Output formats')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    run_benchmark(args.sizes, args.formats)
@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+"""
+Startup benchmark of the command line (src/circularity.py). Every subcommand is started with --help in fresh
+interpreters, which imports the module of the subcommand and exits, and compared to an eager start that imports the
+modules of all subcommands (like a single entry point importing everything up front). The heavy packages every
+subcommand loads are listed; loading one of FORBIDDEN for a subcommand is reported as failure (exit code 1), e.g.
+geopandas or matplotlib when solving, and so is a subcommand that fails to start. A subcommand that needs a package
+which is not installed is skipped and reported, its timings are not comparable. Run from the repository root:
+    python src/benchmarking/bench_imports.py -r 5
+"""
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ["geopandas", "matplotlib", "libpysal", "shapely", "pandas", "gurobipy", "highspy", "networkx", "scipy"]
+
+# Heavy packages a subcommand must not load just to start
+FORBIDDEN = {
+    'preprocess': ["gurobipy", "highspy", "matplotlib", "libpysal", "networkx"],
+    'solve': ["geopandas", "matplotlib", "libpysal", "shapely"],
+    'sweep': ["geopandas", "matplotlib", "libpysal", "shapely"],
+    'local': ["gurobipy", "geopandas", "matplotlib", "libpysal", "shapely"],
+    'multilevel': ["geopandas", "matplotlib", "libpysal", "shapely"],
+    'partition': ["geopandas", "matplotlib", "libpysal", "shapely"],
+    'plot': ["gurobipy", "highspy", "libpysal", "matplotlib"],
+    'cache': ["geopandas", "matplotlib", "libpysal", "gurobipy", "highspy"],
+}
+
+# Runs in the child interpreter: starts a subcommand (or imports all modules) and prints the loaded heavy packages
+_PROBE = """
+import importlib, json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {src!r})
+import circularity
+error, missing = None, []
+def record(exception):
+    global error
+    if isinstance(exception, ModuleNotFoundError) and exception.name not in missing:
+        missing.append(exception.name)
+    elif not isinstance(exception, ModuleNotFoundError):
+        error = repr(exception)
+if {command!r} == 'eager':
+    for module, folder, _ in circularity.COMMANDS.values():
+        sys.path.insert(0, circularity.os.path.join(circularity.SRC_DIR, folder))
+        try:
+            importlib.import_module(module)
+        except Exception as exception:
+            record(exception)
+else:
+    try:
+        circularity.run_command({command!r}, ['--help'])
+    except SystemExit:
+        pass
+    except Exception as exception:
+        record(exception)
+print(json.dumps({{'time': time.perf_counter() - start, 'error': error, 'missing': missing,
+                  'loaded': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def probe(command: str) -> dict:
+    """Starts a subcommand ('eager' imports all modules) in a fresh interpreter, returns its timings and imports."""
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-c", _PROBE.format(src=SRC_DIR, command=command, heavy=HEAVY)],
+                             capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    return dict(result, wall=wall)
+
+
+def benchmark(commands: list[str], repeats: int) -> dict:
+    """
+    Median wall time (interpreter start included) and import time of every command over repeats fresh interpreters.
+    """
+    results = {}
+    for command in commands:
+        runs = [probe(command) for _ in range(repeats)]
+        results[command] = {'wall': statistics.median(run['wall'] for run in runs),
+                            'import': statistics.median(run['time'] for run in runs),
+                            'loaded': runs[-1]['loaded'], 'error': runs[-1]['error'], 'missing': runs[-1]['missing'],
+                            'forbidden': [name for name in FORBIDDEN.get(command, []) if name in runs[-1]['loaded']]}
+    return results
+
+
+parser = argparse.ArgumentParser(description="Measure the startup time of the subcommands of the command line")
+parser.add_argument('commands', nargs='*', default=list(FORBIDDEN), help='Subcommands to measure')
+parser.add_argument('-r', '--repeats', type=int, default=5, help='Fresh interpreters per subcommand')
+parser.add_argument('-o', '--output', type=str, default=None, help='Write the results as json to this file')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    results = benchmark(['eager'] + args.commands, args.repeats)
+    eager = results['eager']['wall']
+    print(f"{'command':<12}{'wall':>9}{'imports':>9}{'gain':>9}  heavy packages")
+    for name, result in results.items():
+        gain = "" if name == 'eager' else f"{eager - result['wall']:.3f}s"
+        print(f"{name:<12}{result['wall']:>8.3f}s{result['import']:>8.3f}s{gain:>9}  {', '.join(result['loaded'])}"
+              f"{'  FORBIDDEN: ' + ', '.join(result['forbidden']) if result['forbidden'] else ''}"
+              f"{'  skipped, not installed: ' + ', '.join(result['missing']) if result['missing'] else ''}"
+              f"{'  error: ' + result['error'] if result['error'] else ''}")
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    sys.exit(1 if any(result['forbidden'] or result['error'] for result in results.values()) else 0)
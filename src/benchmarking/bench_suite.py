@@ -0,0 +1,352 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from graph_utils import get_graph_arrays, read_graph_arrays_from_dataset, read_graph_from_dataset
+from mip_backends import BACKENDS, solve_with_backend
+from mip_contiguity import ContiguityEngine, find_fischetti_separator
+from synthetic_instances import instance_name, parse_instance_spec, synthetic_instance, write_instance
+
+"""
+Reproducible benchmark suite of the solver pipeline. Every stage is timed separately on the bundled datasets and on
+synthetic instances (see synthetic_instances, e.g. 'grid:1000' or 'voronoi:100000'):
+    load csv        parse the vertices and edges csv files into GraphArrays
+    load container  load the binary graph container
+    load graph      build the networkx graph (read_graph_from_dataset)
+    build           build_single_district_mip
+    callback        the contiguity callback (components and separator cuts) on recorded MIPSOL solutions
+    separator       find_fischetti_separator on the components of the recorded solutions
+    separator csr   ContiguityEngine.separator on the same components
+    solve           end-to-end solve with a short time limit
+The MIPSOL solutions are recorded once per instance with Gurobi (data/benchmarks/mipsol/<instance>.npz) and replayed
+offline, so the callback is timed on the same solutions in every run. Without Gurobi, random unions of balls in the
+graph are used instead. Results are written as json; the compare command reports stages that got slower than in a
+baseline. Run from the repository root with the solver modules on the PYTHONPATH:
+    PYTHONPATH=src:src/mip_solving:src/preprocessing python src/benchmarking/bench_suite.py run -o current.json
+    PYTHONPATH=src:src/mip_solving:src/preprocessing python src/benchmarking/bench_suite.py compare \
+        data/benchmarks/baseline.json current.json
+"""
+
+DATASETS = ["issoire", "avignon", "braunschweig", "karlsruhe", "neumuenster", "rheinruhr"]
+SYNTHETIC = ["grid:100", "grid:1000", "grid:10000", "voronoi:1000", "voronoi:10000"]
+STAGES = ["load csv", "load container", "load graph", "build", "callback", "separator", "separator csr", "solve"]
+MIPSOL_PATH = os.path.join("data", "benchmarks", "mipsol")
+FORMAT_VERSION = 1
+
+
+def time_repeated(function, repeats: int) -> dict:
+    """Runs function repeats times and returns the median and minimum time in seconds (and the last return value)."""
+    times = []
+    value = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        value = function()
+        times.append(time.perf_counter() - start)
+    return {'median': statistics.median(times), 'min': min(times), 'repeats': repeats, 'value': value}
+
+
+def prepare_instance(spec: str, seed: int = 0) -> str:
+    """
+    Makes an instance loadable with read_graph_from_dataset: synthetic instances are written to data/graphs (once),
+    dataset names are returned as they are.
+    :return: The dataset name of the instance.
+    """
+    if parse_instance_spec(spec) is None:
+        return spec
+    name = instance_name(spec)
+    if not os.path.exists(os.path.join("data", "graphs", name, f"{name}_edges.csv")):
+        write_instance(spec, synthetic_instance(spec, seed))
+    return name
+
+
+def _solution_path(name: str, area_lower_bound: float) -> str:
+    return os.path.join(MIPSOL_PATH, f"{name}_LB={area_lower_bound}.npz")
+
+
+def record_mipsol_solutions(DG, area_lower_bound: float = 0, time_limit: float = 10,
+                            max_solutions: int = 500) -> list[np.ndarray]:
+    """
+    Solves the single district MIP with Gurobi (without reduction and warm start) and records the selected nodes
+    of every solution passed to the contiguity callback.
+    :return: The node indices (into the graph arrays of DG) of every recorded solution.
+    """
+    import gurobipy as gp
+    from gurobipy import GRB
+    from mip_build_district import build_single_district_mip
+
+    m = build_single_district_mip(DG, area_lower_bound=area_lower_bound, env=gp.Env(params={'OutputFlag': 0}),
+                                  verbose=False)
+    m.Params.TimeLimit = time_limit
+    callback = m._callback
+    recorded = []
+
+    def recording_callback(model, where):
+        if where == GRB.Callback.MIPSOL and len(recorded) < max_solutions:
+            xval = np.fromiter(model.cbGetSolution(model._xvars), dtype=float, count=len(model._xvars))
+            recorded.append(np.flatnonzero(xval > 0.5))
+        callback(model, where)
+
+    m.optimize(recording_callback)
+    m.dispose()
+    return recorded
+
+
+def random_solutions(num_nodes: int, engine: ContiguityEngine, num_solutions: int = 100,
+                     seed: int = 0) -> list[np.ndarray]:
+    """
+    Stand-in for recorded MIPSOL solutions: unions of one to three balls (breadth-first search regions) of random
+    size around random nodes, so most solutions have several components like early solutions of the MIP.
+    """
+    rng = np.random.default_rng(seed)
+    adjacency = engine._adjacency_lists
+    solutions = []
+    for _ in range(num_solutions):
+        selected = set()
+        for _ in range(int(rng.integers(1, 4))):
+            size = int(rng.integers(1, max(2, min(num_nodes, 200))))
+            frontier = [int(rng.integers(num_nodes))]
+            ball = set(frontier)
+            while frontier and len(ball) < size:
+                frontier = list(dict.fromkeys(u for v in frontier for u in adjacency[v] if u not in ball))
+                frontier = frontier[:size - len(ball)]
+                ball.update(frontier)
+            selected |= ball
+        solutions.append(np.array(sorted(selected), dtype=np.int64))
+    return solutions
+
+
+def load_solutions(name: str, DG, engine: ContiguityEngine, area_lower_bound: float = 0,
+                   time_limit: float = 10) -> tuple[list[np.ndarray], str]:
+    """
+    Recorded MIPSOL solutions of an instance: loaded from data/benchmarks/mipsol, recorded with Gurobi if there are
+    none, or random solutions if Gurobi is not available.
+    :return: The solutions (node indices) and where they come from ('recorded' or 'random').
+    """
+    path = _solution_path(name, area_lower_bound)
+    if os.path.exists(path):
+        data = np.load(path)
+        return np.split(data['nodes'], data['offsets'][1:-1]), 'recorded'
+
+    try:
+        solutions = record_mipsol_solutions(DG, area_lower_bound, time_limit)
+    except ImportError:
+        return random_solutions(engine.num_nodes, engine), 'random'
+
+    offsets = np.cumsum([0] + [len(solution) for solution in solutions])
+    os.makedirs(MIPSOL_PATH, exist_ok=True)
+    np.savez_compressed(path, nodes=np.concatenate(solutions or [np.zeros(0, dtype=np.int64)]), offsets=offsets)
+    return solutions, 'recorded'
+
+
+def benchmark_instance(spec: str, area_lower_bound: float = 0, stages: list[str] = STAGES, repeats: int = 3,
+                       time_limit: float = 10, backend: str = "gurobi", seed: int = 0) -> dict:
+    """
+    Times the selected stages of the pipeline on one instance. A stage that fails (e.g., build without Gurobi) is
+    reported with its error instead of its times.
+    :return: Dict with the instance size and one entry per stage ('median', 'min', 'repeats' and extra counts).
+    """
+    name = prepare_instance(spec, seed)
+    DG = read_graph_from_dataset(name)
+    arrays = get_graph_arrays(DG)
+    result = {'instance': spec, 'area_lower_bound': area_lower_bound, 'nodes': arrays.num_nodes,
+              'arcs': arrays.num_arcs, 'stages': {}}
+
+    engine = ContiguityEngine(arrays)
+    solutions, pairs = None, None
+
+    for stage in stages:
+        try:
+            if stage == "load csv":
+                timing = time_repeated(lambda: read_graph_arrays_from_dataset(name, use_cache=False), repeats)
+            elif stage == "load container":
+                timing = time_repeated(lambda: read_graph_arrays_from_dataset(name), repeats)
+            elif stage == "load graph":
+                timing = time_repeated(lambda: read_graph_from_dataset(name), repeats)
+            elif stage == "build":
+                timing = _time_build(DG, area_lower_bound, repeats)
+            elif stage == "solve":
+                timing = _time_solve(DG, area_lower_bound, backend, time_limit)
+            else:
+                if solutions is None:
+                    solutions, origin = load_solutions(name, DG, engine, area_lower_bound, time_limit)
+                    pairs = _separator_pairs(engine, solutions)
+                if stage == "callback":
+                    timing = time_repeated(lambda: [engine.integer_separator_cuts(S) for S in solutions], repeats)
+                    timing['solutions'] = len(solutions)
+                    timing['origin'] = origin
+                    timing['cuts'] = sum(len(cuts) for cuts, _ in timing['value'])
+                elif stage == "separator":
+                    fids = arrays.fids
+                    fid_pairs = [(fids[component].tolist(), int(fids[b])) for component, b in pairs]
+                    timing = time_repeated(lambda: [find_fischetti_separator(DG, component, b)
+                                                    for component, b in fid_pairs], repeats)
+                    timing['separators'] = len(pairs)
+                elif stage == "separator csr":
+                    timing = time_repeated(lambda: [engine.separator(component, b) for component, b in pairs],
+                                           repeats)
+                    timing['separators'] = len(pairs)
+                else:
+                    raise ValueError(f"Unknown stage '{stage}', expected one of {', '.join(STAGES)}.")
+            timing.pop('value', None)
+        except Exception as e:
+            timing = {'error': repr(e)}
+        result['stages'][stage] = timing
+    return result
+
+
+def _separator_pairs(engine: ContiguityEngine, solutions: list[np.ndarray]) -> list[tuple[np.ndarray, int]]:
+    """(component, b) of every separator the callback computes for the solutions."""
+    pairs = []
+    for S in solutions:
+        components = engine.components(S)
+        if len(components) < 2:
+            continue
+        b = int(components[0][np.argmax(engine.arrays.node_weight[components[0]])])
+        pairs.extend((component, b) for component in components[1:])
+    return pairs
+
+
+def _time_build(DG, area_lower_bound: float, repeats: int) -> dict:
+    import gurobipy as gp
+    from mip_build_district import build_single_district_mip
+
+    env = gp.Env(params={'OutputFlag': 0})
+
+    def build():
+        m = build_single_district_mip(DG, area_lower_bound=area_lower_bound, env=env, verbose=False)
+        num_vars, num_constrs = m.NumVars, m.NumConstrs
+        m.dispose()
+        return num_vars, num_constrs
+
+    timing = time_repeated(build, repeats)
+    timing['variables'], timing['constraints'] = timing['value']
+    return timing
+
+
+def _time_solve(DG, area_lower_bound: float, backend: str, time_limit: float) -> dict:
+    timing = time_repeated(lambda: solve_with_backend(DG, area_lower_bound, backend=backend, time_limit=time_limit,
+                                                      verbose=False), 1)
+    solved = timing['value']
+    timing.update(backend=backend, time_limit=time_limit, status=solved.status,
+                  objective=solved.objective if solved.solution is not None else None, bound=solved.bound,
+                  node_count=solved.node_count, num_lazy_cuts=solved.num_lazy_cuts)
+    return timing
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(instances: list[str], area_lower_bounds: list[float], stages: list[str] = STAGES, repeats: int = 3,
+              time_limit: float = 10, backend: str = "gurobi", seed: int = 0) -> dict:
+    """
+    Benchmarks every instance and area lower bound.
+    :return: The results with a description of the machine and the code version (json serializable).
+    """
+    results = []
+    for spec in instances:
+        for area_lower_bound in area_lower_bounds:
+            result = benchmark_instance(spec, area_lower_bound, stages, repeats, time_limit, backend, seed)
+            print_result(result)
+            results.append(result)
+    return {'version': FORMAT_VERSION, 'commit': _git_commit(), 'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                        'numpy': np.__version__, 'cpus': os.cpu_count()},
+            'settings': {'repeats': repeats, 'time_limit': time_limit, 'backend': backend, 'seed': seed},
+            'results': results}
+
+
+def print_result(result: dict) -> None:
+    """Prints one line per stage of an instance."""
+    print(f"{result['instance']} (LB={result['area_lower_bound']:g}): {result['nodes']} nodes, {result['arcs']} arcs")
+    for stage, timing in result['stages'].items():
+        if 'error' in timing:
+            print(f"    {stage:<16}ERROR {timing['error'][:80]}")
+        else:
+            print(f"    {stage:<16}{timing['median']:>10.4f}s (min {timing['min']:.4f}s)")
+
+
+def compare(baseline: dict, current: dict, tolerance: float = 0.2, min_seconds: float = 0.005) -> list[dict]:
+    """
+    Compares the median times of every (instance, area lower bound, stage) in both results. A stage regressed if it
+    is more than tolerance (relative) and min_seconds (absolute, to ignore noise of very fast stages) slower than in
+    the baseline. A changed solve objective is reported as well.
+    :return: One dict per stage present in both results, with 'regression' set for the regressed ones.
+    """
+    def keyed(results):
+        return {(r['instance'], r['area_lower_bound'], stage): timing
+                for r in results['results'] for stage, timing in r['stages'].items() if 'error' not in timing}
+
+    old, new = keyed(baseline), keyed(current)
+    rows = []
+    for key in old.keys() & new.keys():
+        before, after = old[key]['median'], new[key]['median']
+        row = {'instance': key[0], 'area_lower_bound': key[1], 'stage': key[2], 'baseline': before,
+               'current': after, 'ratio': after / before if before > 0 else float('inf')}
+        row['regression'] = after > before * (1 + tolerance) and after - before > min_seconds
+        if key[2] == "solve" and old[key].get('objective') is not None and new[key].get('objective') is not None:
+            row['objective_change'] = new[key]['objective'] - old[key]['objective']
+        rows.append(row)
+    rows.sort(key=lambda row: (row['instance'], row['area_lower_bound'], STAGES.index(row['stage'])
+                               if row['stage'] in STAGES else len(STAGES)))
+    return rows
+
+
+def print_comparison(rows: list[dict]) -> None:
+    print(f"{'instance':<16}{'LB':>10}  {'stage':<16}{'baseline':>10}{'current':>10}{'ratio':>8}")
+    for row in rows:
+        flag = "  REGRESSION" if row['regression'] else ""
+        if abs(row.get('objective_change', 0)) > 1e-6:
+            flag += f"  objective {row['objective_change']:+.6f}"
+        print(f"{row['instance']:<16}{row['area_lower_bound']:>10g}  {row['stage']:<16}{row['baseline']:>9.4f}s"
+              f"{row['current']:>9.4f}s{row['ratio']:>8.2f}{flag}")
+
+
+parser = argparse.ArgumentParser(description="Benchmark the stages of the solver pipeline")
+subparsers = parser.add_subparsers(dest='command', required=True)
+run_parser = subparsers.add_parser('run', help='Run the benchmark suite')
+run_parser.add_argument('-i', '--instances', nargs='+', default=DATASETS + SYNTHETIC,
+                        help='Datasets and synthetic instances (e.g. grid:1000, voronoi:100000)')
+run_parser.add_argument('-l', '--lower-bounds', type=float, nargs='+', default=[0], help='Area lower bounds')
+run_parser.add_argument('-s', '--stages', nargs='+', choices=STAGES, default=STAGES, help='Stages to time')
+run_parser.add_argument('-r', '--repeats', type=int, default=3, help='Repetitions of every stage but solve')
+run_parser.add_argument('--time-limit', type=float, default=10,
+                        help='Time limit of the solve stage and of recording the MIPSOL solutions')
+run_parser.add_argument('-b', '--backend', choices=list(BACKENDS), default='gurobi', help='Backend of the solve stage')
+run_parser.add_argument('--seed', type=int, default=0, help='Seed of the random synthetic instances')
+run_parser.add_argument('-o', '--output', type=str, default=None, help='Write the results to this json file')
+compare_parser = subparsers.add_parser('compare', help='Compare results with a baseline')
+compare_parser.add_argument('baseline', help='Baseline results (json)')
+compare_parser.add_argument('current', help='Current results (json)')
+compare_parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slowdown')
+compare_parser.add_argument('--min-seconds', type=float, default=0.005, help='Allowed absolute slowdown')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.command == 'run':
+        suite = run_suite(args.instances, args.lower_bounds, args.stages, args.repeats, args.time_limit, args.backend,
+                          args.seed)
+        if args.output:
+            os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+            with open(args.output, "w") as file:
+                json.dump(suite, file, indent=2)
+    else:
+        with open(args.baseline) as file:
+            baseline_results = json.load(file)
+        with open(args.current) as file:
+            current_results = json.load(file)
+        comparison = compare(baseline_results, current_results, args.tolerance, args.min_seconds)
+        print_comparison(comparison)
+        # a non-zero exit code lets scripts fail on regressions
+        sys.exit(1 if any(row['regression'] for row in comparison) else 0)
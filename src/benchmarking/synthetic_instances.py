@@ -0,0 +1,168 @@
+import argparse
+import os
+import re
+
+import numpy as np
+from scipy.spatial import Voronoi
+
+from graph_utils import GraphArrays
+from preprocessing.graph_container import arrays_from_edge_list, write_graph_container
+
+"""
+Synthetic districting instances of any size, to measure how the pipeline scales. Instances are given by a spec
+'<kind>:<number of faces>' (e.g., 'grid:1000', 'voronoi:100000') and built directly as GraphArrays:
+    grid     square cells on a (nearly) square grid with the outside around it
+    voronoi  Voronoi cells of uniformly random points, clipped to a square
+Every instance has faces of about FACE_AREA square units, like a dataset in meters with faces of 100 x 100.
+Run with the solver modules on the PYTHONPATH to write instances to data/graphs, so they can be solved like datasets:
+    PYTHONPATH=src:src/mip_solving:src/preprocessing python src/benchmarking/synthetic_instances.py grid:1000
+"""
+
+FACE_AREA = 1e4
+INSTANCE_KINDS = ("grid", "voronoi")
+
+
+def _arrays_from_edges(areas: np.ndarray, sources: np.ndarray, targets: np.ndarray, lengths: np.ndarray,
+                       name: str) -> GraphArrays:
+    """GraphArrays of faces 0..n-1 with the given areas and edges (a target of -1 is the outside)."""
+    vertex_ids = np.arange(len(areas), dtype=np.int64)
+    return GraphArrays(**arrays_from_edge_list(vertex_ids, areas, sources, targets, lengths, source=name))
+
+
+def grid_instance(num_faces: int) -> GraphArrays:
+    """
+    A rows x cols grid of square cells with rows * cols >= num_faces (rows = floor(sqrt(num_faces))), the cells on
+    the border touch the outside.
+    """
+    rows = max(1, int(np.sqrt(num_faces)))
+    cols = -(-num_faces // rows)
+    side = np.sqrt(FACE_AREA)
+    ids = np.arange(rows * cols).reshape(rows, cols)
+
+    # Right and lower neighbors, then one outside edge per border cell with the length of its border sides
+    border_sides = np.zeros((rows, cols))
+    border_sides[0, :] += 1
+    border_sides[-1, :] += 1
+    border_sides[:, 0] += 1
+    border_sides[:, -1] += 1
+    border = np.flatnonzero(border_sides.ravel())
+    sources = np.concatenate((ids[:, :-1].ravel(), ids[:-1, :].ravel(), border))
+    targets = np.concatenate((ids[:, 1:].ravel(), ids[1:, :].ravel(), np.full(len(border), -1)))
+    lengths = np.concatenate((np.full(len(sources) - len(border), side), side * border_sides.ravel()[border]))
+
+    return _arrays_from_edges(np.full(rows * cols, FACE_AREA), sources, targets, lengths, f"grid:{num_faces}")
+
+
+def voronoi_instance(num_faces: int, seed: int = 0) -> GraphArrays:
+    """
+    Voronoi cells of num_faces uniformly random points in a square of num_faces * FACE_AREA square units.
+    The points are mirrored at the four sides of the square, so every cell of an original point is bounded and
+    exactly its cell clipped to the square: a ridge between a point and one of its mirror images lies on the side of
+    the square and is part of the boundary with the outside.
+    """
+    rng = np.random.default_rng(seed)
+    side = np.sqrt(num_faces * FACE_AREA)
+    points = rng.uniform(0, side, (num_faces, 2))
+    mirrored = [points]
+    for axis in (0, 1):
+        for border in (0.0, side):
+            image = points.copy()
+            image[:, axis] = 2 * border - image[:, axis]
+            mirrored.append(image)
+    voronoi = Voronoi(np.concatenate(mirrored))
+
+    # Keep the ridges with at least one original point, the other point's index modulo num_faces is its original
+    ridge_points = voronoi.ridge_points
+    ridge_vertices = np.array(voronoi.ridge_vertices)
+    keep = (ridge_points < num_faces).any(axis=1) & (ridge_vertices >= 0).all(axis=1)
+    ridge_points, ridge_vertices = ridge_points[keep], ridge_vertices[keep]
+    start, end = voronoi.vertices[ridge_vertices[:, 0]], voronoi.vertices[ridge_vertices[:, 1]]
+    lengths = np.hypot(*(end - start).T)
+
+    # The (convex) cell of point p is the union of the triangles (p, ridge start, ridge end) of its ridges
+    areas = np.zeros(num_faces)
+    for column in (0, 1):
+        p = ridge_points[:, column]
+        original = p < num_faces
+        a, b = start[original] - points[p[original]], end[original] - points[p[original]]
+        np.add.at(areas, p[original], 0.5 * np.abs(a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]))
+
+    # Ridges between two original points are shared boundaries, ridges to mirror images lie on the sides of the
+    # square and are summed up to one outside edge per cell
+    sources, targets = ridge_points.min(axis=1), ridge_points.max(axis=1)
+    outside = targets >= num_faces
+    boundary_perim = np.bincount(sources[outside], weights=lengths[outside], minlength=num_faces)
+    border = np.flatnonzero(boundary_perim)
+    sources = np.concatenate((sources[~outside], border))
+    targets = np.concatenate((targets[~outside], np.full(len(border), -1)))
+    lengths = np.concatenate((lengths[~outside], boundary_perim[border]))
+    return _arrays_from_edges(areas, sources, targets, lengths, f"voronoi:{num_faces}")
+
+
+def parse_instance_spec(spec: str) -> tuple[str, int] | None:
+    """(kind, number of faces) of a synthetic instance spec like 'grid:1000' or None for dataset names."""
+    match = re.fullmatch(r"(\w+):(\d+)", spec)
+    if match is None or match.group(1) not in INSTANCE_KINDS:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+def synthetic_instance(spec: str, seed: int = 0) -> GraphArrays:
+    """
+    Builds the synthetic instance of a spec (see parse_instance_spec).
+    :raises ValueError: If the spec is not a synthetic instance.
+    """
+    parsed = parse_instance_spec(spec)
+    if parsed is None:
+        raise ValueError(f"'{spec}' is not a synthetic instance, expected one of "
+                         f"{', '.join(kind + ':<faces>' for kind in INSTANCE_KINDS)}.")
+    kind, num_faces = parsed
+    return grid_instance(num_faces) if kind == "grid" else voronoi_instance(num_faces, seed)
+
+
+def instance_name(spec: str) -> str:
+    """Dataset name of a synthetic instance (e.g., 'grid_1000' for 'grid:1000')."""
+    return spec.replace(":", "_")
+
+
+def write_instance(spec: str, arrays: GraphArrays, csv: bool = True) -> str:
+    """
+    Writes an instance like a dataset to data/graphs/<name>/ (binary container and, optionally, the csv files), so
+    it can be loaded with read_graph_from_dataset.
+    :return: The dataset name.
+    """
+    name = instance_name(spec)
+    path = os.path.join("data", "graphs", name, name)
+    write_graph_container(path + "_graph.bin", arrays._asdict(), metadata={'dataset': name, 'source': spec})
+    if csv:
+        fids = arrays.fids
+        with open(path + "_vertices.csv", "w") as file:
+            file.write("FID,area\n")
+            file.writelines(f"{fid},{area!r}\n" for fid, area in zip(fids.tolist(), arrays.node_weight.tolist()))
+        tails, heads = arrays.arc_tails(), arrays.indices
+        forward = tails < heads
+        boundary = np.flatnonzero(arrays.boundary_node)
+        with open(path + "_edges.csv", "w") as file:
+            file.write("from_id,to_id,weight\n")
+            file.writelines(f"{u},{v},{w!r}\n" for u, v, w in zip(fids[tails[forward]].tolist(),
+                                                                   fids[heads[forward]].tolist(),
+                                                                   arrays.shared_perim[forward].tolist()))
+            file.writelines(f"{u},-1,{w!r}\n" for u, w in zip(fids[boundary].tolist(),
+                                                             arrays.boundary_perim[boundary].tolist()))
+        # the container must not be older than the csv files, otherwise it is rebuilt on load
+        os.utime(path + "_graph.bin")
+    return name
+
+
+parser = argparse.ArgumentParser(description="Write synthetic districting instances to data/graphs")
+parser.add_argument('instances', nargs='+', help="Instance specs, e.g. grid:1000 voronoi:10000")
+parser.add_argument('-s', '--seed', type=int, default=0, help='Seed of the random instances')
+parser.add_argument('--no-csv', action='store_true', help='Only write the binary graph container')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    for spec in args.instances:
+        arrays = synthetic_instance(spec, args.seed)
+        name = write_instance(spec, arrays, csv=not args.no_csv)
+        print(f"{spec}: {arrays.num_nodes} faces, {arrays.num_arcs // 2} edges, "
+              f"{int(arrays.boundary_node.sum())} boundary faces -> data/graphs/{name}")
@@ -0,0 +1,53 @@
+import argparse
+import os
+import runpy
+import sys
+
+"""
+Command line entry point of the project:
+    python src/circularity.py preprocess roads-reduced/issoire
+    python src/circularity.py solve -d issoire -l 0 1e6
+    python src/circularity.py sweep issoire --geometric 1e5 1e7 8
+    python src/circularity.py plot issoire -f svg
+Every subcommand runs the command line (parser and __main__ block) of one module and only imports that module, so
+solving does not load geopandas and matplotlib and preprocessing does not load gurobipy. The modules are run like
+'python -m', so their worker processes work with every multiprocessing start method. Arguments after the subcommand
+are passed to the module, e.g. 'python src/circularity.py solve --help' shows the options of solve.
+src/benchmarking/bench_imports.py measures the startup time of every subcommand.
+"""
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Subcommand: (module, folder of its bare imports, description)
+COMMANDS = {
+    'preprocess': ('dataToAdjacencyGraph', 'preprocessing', "Build the adjacency graphs of shapefiles"),
+    'solve': ('solve', 'mip_solving', "Solve the single district problem for datasets and area lower bounds"),
+    'sweep': ('mip_sweep', 'mip_solving', "Solve one dataset for many area lower bounds with one model"),
+    'local': ('local_search', 'mip_solving', "Solve the single district problem with multi-start local search"),
+    'multilevel': ('mip_multilevel', 'mip_solving', "Solve large regions with coarsen-solve-refine"),
+    'partition': ('mip_partition', 'mip_solving', "Partition a dataset into k districts"),
+    'plot': ('solution_plotting.solution_plotter', 'mip_solving', "Plot solutions"),
+    'cache': ('result_cache', 'mip_solving', "Show or shrink the result cache"),
+}
+
+
+def run_command(command: str, arguments: list[str]) -> None:
+    """Runs the command line of the module of a subcommand with the given arguments."""
+    module, folder, _ = COMMANDS[command]
+    for path in (os.path.join(SRC_DIR, folder), SRC_DIR):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    sys.argv = [sys.argv[0]] + arguments
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+
+
+parser = argparse.ArgumentParser(description="Districting with maximal Polsby-Popper score",
+                                 epilog="subcommands:\n" + "\n".join(f"  {command:<12}{description}" for command, (
+                                     _, _, description) in COMMANDS.items()),
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('command', choices=list(COMMANDS), help='Subcommand')
+parser.add_argument('arguments', nargs=argparse.REMAINDER, help='Arguments of the subcommand')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    run_command(args.command, args.arguments)
@@ -0,0 +1,201 @@
+from typing import NamedTuple
+
+import networkx as nx
+import numpy as np
+from scipy.sparse.csgraph import connected_components
+
+from graph_utils import GraphArrays, adjacency_matrix, get_graph_arrays, graph_from_arrays, subgraph_arrays
+
+"""
+Reductions of the dataset graph before the single district MIP is built. All reductions keep at least one optimal
+district, they rely on the following dominance argument: if u is in a district D, v is not, v is adjacent to D and
+adding v does not increase the perimeter, then D + v is contiguous, has a larger area and a better (smaller)
+inverse Polsby-Popper score. So some optimal district contains v whenever it contains u.
+"""
+
+
+class GraphReduction(NamedTuple):
+    """Result of reduce_graph."""
+    arrays: GraphArrays  # the reduced graph
+    members: dict[int, list[int]]  # original FIDs of every node (FID) of the reduced graph
+    implications: list[tuple[int, int]]  # pairs (u, v) of reduced FIDs with x[u] <= x[v]
+    bounds: dict[str, float]  # bounds for the area ('area_min', 'area_max') and perimeter ('perimeter_max')
+    report: list[dict]  # variables and constraints removed (or added) by every reduction
+
+
+def _report_entry(name: str, nodes: int, arcs: int, constraints_added: int = 0) -> dict:
+    """
+    Entry of the reduction report. Every node is one x variable, every arc one y variable and one cut constraint.
+    """
+    return {'reduction': name, 'nodes': nodes, 'arcs': arcs, 'variables': nodes + arcs,
+            'constraints': arcs - constraints_added}
+
+
+def remove_small_components(arrays: GraphArrays, area_lower_bound: float) -> tuple[GraphArrays, dict]:
+    """
+    A district lies in a single connected component, so components with a total area below the area lower bound can
+    be removed.
+    """
+    num_components, labels = connected_components(adjacency_matrix(arrays), directed=False)
+    component_area = np.bincount(labels, weights=arrays.node_weight, minlength=num_components)
+    keep = component_area[labels] >= area_lower_bound
+
+    reduced = subgraph_arrays(arrays, keep)
+    return reduced, _report_entry("small components", arrays.num_nodes - reduced.num_nodes,
+                                  arrays.num_arcs - reduced.num_arcs)
+
+
+def merge_dominated_pendants(arrays: GraphArrays, area_lower_bound: float) -> tuple[GraphArrays, dict, dict]:
+    """
+    Merges every pendant node v (a node with a single neighbor u) whose boundary perimeter is at most the perimeter
+    shared with u into u: a district containing u contains v without loss of generality, and the only district
+    containing v but not u is {v} itself. Merging is repeated until no such pendant is left (merging can create new
+    pendants). If {v} reaches the area lower bound, it is kept as an isolated node (with its full perimeter as
+    boundary perimeter), so the reduced graph still contains that district.
+    """
+    n = arrays.num_nodes
+    fids = arrays.fids.tolist()
+    weight = arrays.node_weight.tolist()
+    boundary_perim = arrays.boundary_perim.tolist()
+    boundary_node = arrays.boundary_node.tolist()
+    indptr, indices, shared_perim = arrays.indptr.tolist(), arrays.indices.tolist(), arrays.shared_perim.tolist()
+    adjacency = [dict(zip(indices[indptr[i]:indptr[i + 1]], shared_perim[indptr[i]:indptr[i + 1]])) for i in range(n)]
+    members = [[fid] for fid in fids]
+    merged = [False] * n
+    ghosts = []  # (members, area, perimeter) of the kept singleton districts
+
+    queue = [v for v in range(n) if len(adjacency[v]) == 1]
+    while queue:
+        v = queue.pop()
+        if merged[v] or len(adjacency[v]) != 1:
+            continue
+        (u, shared), = adjacency[v].items()
+        if boundary_perim[v] > shared:
+            continue
+
+        if weight[v] >= area_lower_bound:
+            ghosts.append((members[v], weight[v], boundary_perim[v] + shared))
+
+        # merge v into u, the perimeter shared by u and v is inside the merged node
+        weight[u] += weight[v]
+        boundary_perim[u] += boundary_perim[v]
+        boundary_node[u] = boundary_node[u] or boundary_node[v]
+        members[u] = members[u] + members[v]
+        del adjacency[u][v]
+        adjacency[v] = {}
+        merged[v] = True
+        if len(adjacency[u]) == 1:
+            queue.append(u)
+
+    kept = [i for i in range(n) if not merged[i]]
+    new_index = {i: k for k, i in enumerate(kept)}
+    num_kept = len(kept)
+
+    # kept nodes first (in the original order), then the isolated singleton districts
+    ghost_fids = [members_v[0] for members_v, _, _ in ghosts]
+    degrees = [len(adjacency[i]) for i in kept] + [0] * len(ghosts)
+    reduced_indptr = np.zeros(len(degrees) + 1, dtype=np.int64)
+    np.cumsum(degrees, out=reduced_indptr[1:])
+    reduced = GraphArrays(
+        fids=np.array([fids[i] for i in kept] + ghost_fids, dtype=np.int64),
+        node_weight=np.array([weight[i] for i in kept] + [area for _, area, _ in ghosts]),
+        boundary_node=np.array([boundary_node[i] for i in kept] + [True] * len(ghosts), dtype=bool),
+        boundary_perim=np.array([boundary_perim[i] for i in kept] + [perim for _, _, perim in ghosts]),
+        indptr=reduced_indptr,
+        indices=np.array([new_index[j] for i in kept for j in adjacency[i]], dtype=np.int64),
+        shared_perim=np.array([s for i in kept for s in adjacency[i].values()]))
+
+    reduced_members = {fids[i]: members[i] for i in kept}
+    reduced_members.update({fid: members_v for fid, (members_v, _, _) in zip(ghost_fids, ghosts)})
+
+    report = _report_entry("pendant merging", n - num_kept, arrays.num_arcs - reduced.num_arcs)
+    report['nodes'] -= len(ghosts)
+    report['variables'] -= len(ghosts)
+    return reduced, reduced_members, report
+
+
+def find_implications(arrays: GraphArrays) -> tuple[list[tuple[int, int]], dict]:
+    """
+    Finds pairs of neighbors u, v where the perimeter of v not shared with u (boundary perimeter plus the perimeter
+    shared with its other neighbors) is at most the perimeter shared with u. Adding v to a district containing u
+    never increases the perimeter, so x[u] <= x[v] holds for some optimal district.
+    """
+    tails, heads = arrays.arc_tails(), arrays.indices
+    total_perim = arrays.boundary_perim + np.bincount(tails, weights=arrays.shared_perim, minlength=arrays.num_nodes)
+
+    # arc (v, u) with the perimeter of v not shared with u at most the perimeter shared with u
+    dominated = (total_perim[tails] - arrays.shared_perim <= arrays.shared_perim) & (arrays.node_weight[tails] > 0)
+    implications = list(zip(arrays.fids[heads[dominated]].tolist(), arrays.fids[tails[dominated]].tolist()))
+    return implications, _report_entry("implications", 0, 0, constraints_added=len(implications))
+
+
+def reduce_graph(arrays: GraphArrays, area_lower_bound: float = 0) -> GraphReduction:
+    """
+    Applies all reductions to the graph and derives bounds for the area and perimeter of the district.
+
+    :param arrays: The graph as GraphArrays
+    :param area_lower_bound: Lower bound for the area of the district.
+    :return: The GraphReduction.
+    """
+    report = []
+
+    reduced, entry = remove_small_components(arrays, area_lower_bound)
+    report.append(entry)
+
+    reduced, members, entry = merge_dominated_pendants(reduced, area_lower_bound)
+    report.append(entry)
+
+    # merging can not create components below the area lower bound, but singleton districts may be too small
+    implications, entry = find_implications(reduced)
+    report.append(entry)
+
+    # the district lies in one component and contains at least one node
+    num_components, labels = connected_components(adjacency_matrix(reduced), directed=False)
+    component_area = np.bincount(labels, weights=reduced.node_weight, minlength=num_components)
+    bounds = {'area_min': max(area_lower_bound, float(reduced.node_weight.min(initial=np.inf))),
+              'area_max': float(component_area.max(initial=0)),
+              'perimeter_max': float(reduced.boundary_perim.sum() + reduced.shared_perim.sum() / 2)}
+
+    return GraphReduction(arrays=reduced, members=members, implications=implications, bounds=bounds, report=report)
+
+
+def reduce_district_graph(DG: nx.DiGraph, area_lower_bound: float = 0,
+                          verbose: bool = True) -> tuple[nx.DiGraph, GraphReduction]:
+    """
+    Reduces the graph of a single district problem with reduce_graph and builds the reduced networkx graph, which
+    carries the graph attributes of DG plus the derived 'implications' and 'bounds' (used by the model builders).
+
+    :param DG: Directed graph representing the districting problem (see build_single_district_mip).
+    :param area_lower_bound: Lower bound for the area of the district.
+    :param verbose: If True, print the reduction report.
+    :return: A tuple of the reduced graph and the GraphReduction (to expand solutions with expand_solution).
+    """
+    reduction = reduce_graph(get_graph_arrays(DG), area_lower_bound)
+    if verbose:
+        print_reduction_report(reduction, get_graph_arrays(DG))
+    reduced_DG = graph_from_arrays(reduction.arrays)
+    reduced_DG.graph.update({key: value for key, value in DG.graph.items() if key != 'arrays'})
+    reduced_DG.graph['implications'] = reduction.implications
+    reduced_DG.graph['bounds'] = reduction.bounds
+    return reduced_DG, reduction
+
+
+def expand_solution(reduction: GraphReduction, solution: list[int]) -> list[int]:
+    """
+    Maps a district of the reduced graph (list of FIDs) back to the original FIDs.
+    """
+    return sorted(fid for node in solution for fid in reduction.members[node])
+
+
+def print_reduction_report(reduction: GraphReduction, original: GraphArrays) -> None:
+    """
+    Prints how many variables and constraints every reduction removed.
+    """
+    print("######Graph reduction######")
+    for entry in reduction.report:
+        print(f"{entry['reduction']}: -{entry['nodes']} nodes, -{entry['arcs']} arcs, "
+              f"-{entry['variables']} variables, {-entry['constraints']:+d} constraints")
+    print(f"Nodes: {original.num_nodes} -> {reduction.arrays.num_nodes}, "
+          f"arcs: {original.num_arcs} -> {reduction.arrays.num_arcs}")
+    print(f"Bounds: area in [{reduction.bounds['area_min']:.4f}, {reduction.bounds['area_max']:.4f}], "
+          f"perimeter <= {reduction.bounds['perimeter_max']:.4f}")
@@ -1,50 +1,213 @@
-import networkx as nx
 import os
-import csv
+from typing import NamedTuple
+
+import networkx as nx
+import numpy as np
+
+from preprocessing.graph_container import (arrays_from_edge_list, read_graph_container, source_hash, source_stamp,
+                                           write_graph_container)
+
+
+class GraphArrays(NamedTuple):
+    """
+    Array (CSR) representation of a dataset graph. Node i corresponds to the vertex with FID fids[i], its neighbors
+    are indices[indptr[i]:indptr[i + 1]] and the shared perimeters with them are shared_perim[indptr[i]:indptr[i + 1]].
+    Every undirected edge is stored in both directions.
+    """
+    fids: np.ndarray  # int64, FID of every node
+    node_weight: np.ndarray  # float64, area of every node
+    boundary_node: np.ndarray  # bool, True if the node touches the outside
+    boundary_perim: np.ndarray  # float64, length of the boundary shared with the outside (0 for inner nodes)
+    indptr: np.ndarray  # int64, CSR row pointers (length n + 1)
+    indices: np.ndarray  # int64, CSR column indices (node indices, not FIDs)
+    shared_perim: np.ndarray  # float64, length of the boundary shared between the two nodes of an arc
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.fids)
+
+    @property
+    def num_arcs(self) -> int:
+        return len(self.indices)
+
+    def arc_tails(self) -> np.ndarray:
+        """Index of the tail node of every arc (the arcs' heads are self.indices)."""
+        return np.repeat(np.arange(self.num_nodes), np.diff(self.indptr))
+
+
+def _dataset_file_paths(dataset: str) -> tuple[str, str, str]:
+    """Paths of the vertices csv, the edges csv and the binary graph container of a dataset."""
+    dataset_path = os.path.join("data", "graphs", dataset)
+    return (os.path.join(dataset_path, f"{dataset}_vertices.csv"),
+            os.path.join(dataset_path, f"{dataset}_edges.csv"),
+            os.path.join(dataset_path, f"{dataset}_graph.bin"))
+
+
+def read_graph_arrays_from_csv(vertices_file_path: str, edges_file_path: str) -> GraphArrays:
+    """
+    Parses the vertices and edges csv files of a dataset into a GraphArrays object with one bulk read per file.
+
+    :param vertices_file_path: Path to the *_vertices.csv file (FID in the first, area in the second column).
+    :param edges_file_path: Path to the *_edges.csv file (from_id, to_id, weight).
+    :return: The graph as GraphArrays
+    """
+    vertices = np.loadtxt(vertices_file_path, delimiter=",", skiprows=1, usecols=(0, 1), ndmin=2)
+    edges = np.loadtxt(edges_file_path, delimiter=",", skiprows=1, usecols=(0, 1, 2), ndmin=2)
+
+    return GraphArrays(**arrays_from_edge_list(vertices[:, 0].astype(np.int64), vertices[:, 1],
+                                               edges[:, 0].astype(np.int64), edges[:, 1].astype(np.int64),
+                                               edges[:, 2], source=edges_file_path))
+
+
+def read_graph_arrays_from_dataset(dataset: str, use_cache: bool = True, verify: bool = False) -> GraphArrays:
+    """
+    Reads a dataset from graphs/{dataset} as GraphArrays.
+    The graph is loaded from the binary container graphs/{dataset}/{dataset}_graph.bin (memory-mapped, so loading
+    is nearly instant and does not copy the arrays). The container stores the modification times and sizes of the
+    csv files it was built from and their content hash. If the times or sizes differ, the hash decides: with the
+    same content (e.g., after a checkout) only the stored times are updated, otherwise, or if there is no container
+    or it has no hash of the csv files, the csv files are parsed and the container is rewritten.
+
+    :param dataset: Name of the dataset (e.g., 'issoire')
+    :param use_cache: If False, always parse the csv files (and do not write the container)
+    :param verify: If True, verify the checksum of the container (it is computed when the container is written)
+    :return: The graph as GraphArrays (read-only arrays if loaded from the container)
+    """
+    vertices_file_path, edges_file_path, container_file_path = _dataset_file_paths(dataset)
+    sources = [vertices_file_path, edges_file_path]
+    has_csv = all(os.path.exists(path) for path in sources)
+
+    if not use_cache:
+        return read_graph_arrays_from_csv(vertices_file_path, edges_file_path)
+
+    stamp = source_stamp(sources) if has_csv else None
+    if os.path.exists(container_file_path):
+        arrays, header = read_graph_container(container_file_path, verify=verify)
+        metadata = header['metadata']
+        if not has_csv or metadata.get('csv_stamp') == stamp:
+            return GraphArrays(**arrays)
+        if metadata.get('csv_hash') == source_hash(sources):
+            arrays = {name: np.array(array) for name, array in arrays.items()}
+            write_graph_container(container_file_path, arrays, metadata=dict(metadata, csv_stamp=stamp))
+            return GraphArrays(**arrays)
+
+    arrays = read_graph_arrays_from_csv(vertices_file_path, edges_file_path)
+    write_graph_container(container_file_path, arrays._asdict(),
+                          metadata={'dataset': dataset, 'source': 'csv', 'csv_stamp': stamp,
+                                    'csv_hash': source_hash(sources)})
+    return arrays
+
+
+def subgraph_arrays(arrays: GraphArrays, keep: np.ndarray) -> GraphArrays:
+    """
+    GraphArrays of the subgraph induced by the kept nodes (in their original order), for districts that never
+    contain any of the removed nodes. The removed nodes are treated like the outside: the shared perimeter of an
+    arc from a kept to a removed node is added to the boundary perimeter of the kept node, so the perimeter of
+    every district of the subgraph stays the same as in the full graph.
+
+    :param arrays: The graph as GraphArrays
+    :param keep: Boolean mask of the nodes to keep
+    :return: The subgraph as GraphArrays
+    """
+    new_index = np.cumsum(keep) - 1
+    tails = arrays.arc_tails()
+    keep_arc = keep[tails] & keep[arrays.indices]
+
+    # Boundary with removed nodes becomes boundary with the outside
+    to_removed = keep[tails] & ~keep[arrays.indices]
+    boundary_perim = arrays.boundary_perim + np.bincount(tails[to_removed], weights=arrays.shared_perim[to_removed],
+                                                         minlength=arrays.num_nodes)
+    boundary_node = arrays.boundary_node | (np.bincount(tails[to_removed], minlength=arrays.num_nodes) > 0)
+
+    indptr = np.zeros(int(keep.sum()) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(new_index[tails[keep_arc]], minlength=len(indptr) - 1), out=indptr[1:])
+    return GraphArrays(fids=arrays.fids[keep], node_weight=arrays.node_weight[keep],
+                       boundary_node=boundary_node[keep], boundary_perim=boundary_perim[keep],
+                       indptr=indptr, indices=new_index[arrays.indices[keep_arc]],
+                       shared_perim=arrays.shared_perim[keep_arc])
+
+
+def adjacency_matrix(arrays: GraphArrays) -> "scipy.sparse.csr_matrix":
+    """
+    Adjacency matrix of the graph (CSR, a one for every arc), e.g. for the algorithms of scipy.sparse.csgraph.
+
+    :param arrays: The graph as GraphArrays
+    :return: The n x n adjacency matrix, sharing indptr and indices with the arrays
+    """
+    import scipy.sparse as sp
+    return sp.csr_matrix((np.ones(arrays.num_arcs, dtype=np.int8), arrays.indices, arrays.indptr),
+                         shape=(arrays.num_nodes, arrays.num_nodes))
+
+
+def graph_from_arrays(arrays: GraphArrays) -> nx.DiGraph:
+    """
+    Builds the networkx DiGraph (with the 'node_weight', 'boundary_node', 'boundary_perim' and 'shared_perim'
+    attributes the MIP solver expects) from GraphArrays. The arrays are kept in graph.graph['arrays'].
+
+    :param arrays: The graph as GraphArrays
+    :return: A networkx.DiGraph object representing the graph
+    """
+    graph = nx.DiGraph(arrays=arrays)
+
+    fids = arrays.fids.tolist()
+    graph.add_nodes_from(
+        (fid, {'node_weight': weight, 'boundary_node': boundary, 'boundary_perim': perim} if boundary
+        else {'node_weight': weight, 'boundary_node': boundary})
+        for fid, weight, boundary, perim in zip(fids, arrays.node_weight.tolist(), arrays.boundary_node.tolist(),
+                                                arrays.boundary_perim.tolist()))
+
+    tails = arrays.fids[arrays.arc_tails()].tolist()
+    heads = arrays.fids[arrays.indices].tolist()
+    graph.add_edges_from((u, v, {'shared_perim': w}) for u, v, w in zip(tails, heads, arrays.shared_perim.tolist()))
+
+    return graph
+
+
+def get_graph_arrays(DG: nx.DiGraph) -> GraphArrays:
+    """
+    Returns the GraphArrays of a graph. Graphs loaded with read_graph_from_dataset already carry them, for all other
+    graphs they are built from the networkx attributes (in node and edge order of the graph).
+
+    :param DG: A networkx.DiGraph with the attributes written by read_graph_from_dataset
+    :return: The graph as GraphArrays
+    """
+    arrays = DG.graph.get('arrays')
+    if arrays is not None and arrays.num_nodes == DG.number_of_nodes() and arrays.num_arcs == DG.number_of_edges():
+        return arrays
+
+    fids = np.fromiter(DG.nodes, dtype=np.int64, count=DG.number_of_nodes())
+    index = {fid: i for i, fid in enumerate(fids.tolist())}
+    boundary_node = np.array([DG.nodes[i]['boundary_node'] for i in DG.nodes], dtype=bool)
+    tails = np.array([index[u] for u, _ in DG.edges], dtype=np.int64)
+    heads = np.array([index[v] for _, v in DG.edges], dtype=np.int64)
+    arc_order = np.argsort(tails, kind="stable")
+    indptr = np.zeros(len(fids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(tails, minlength=len(fids)), out=indptr[1:])
+
+    arrays = GraphArrays(
+        fids=fids,
+        node_weight=np.array([DG.nodes[i]['node_weight'] for i in DG.nodes], dtype=float),
+        boundary_node=boundary_node,
+        boundary_perim=np.array([DG.nodes[i]['boundary_perim'] if DG.nodes[i]['boundary_node'] else 0.0
+                                 for i in DG.nodes], dtype=float),
+        indptr=indptr,
+        indices=heads[arc_order],
+        shared_perim=np.array([w for _, _, w in DG.edges(data='shared_perim')], dtype=float)[arc_order])
+    DG.graph['arrays'] = arrays
+    return arrays
 
 
 def read_graph_from_dataset(dataset : str) -> nx.DiGraph:
     """
     Reads a dataset from graphs/{dataset} and loads it as a networkx DiGraph.
     Loads the networkx Graph in the correct format for our MIP solver.
+    The arrays are loaded with read_graph_arrays_from_dataset (from the binary container or the csv files) and kept
+    in graph.graph['arrays'].
 
     :param dataset: Name of the dataset (e.g., 'issoire')
     :return: A networkx.DiGraph object representing the graph from the dataset
     """
-
-    # Construct the file paths
-    edges_file_path = os.path.join("data","graphs", dataset, f"{dataset}_edges.csv")
-    vertices_file_path = os.path.join("data","graphs", dataset, f"{dataset}_vertices.csv")
-
-    # Initialize a directed graph
-    graph = nx.DiGraph()
-
-    # Read the vertices file and add vertex weights as attributes
-    with open(vertices_file_path, mode='r') as file:
-        reader = csv.reader(file)
-        next(reader)  # Skip the header line
-        for row in reader:
-            vertex, weight = int(row[0]), float(row[1])
-            if vertex != -1:  # Skip outside vertex
-                graph.add_node(vertex, node_weight=weight, boundary_node=False)
-
-    # Read the CSV file and add edges to the graph
-    with open(edges_file_path, mode='r') as file:
-        reader = csv.reader(file)
-        next(reader)  # Skip the header line
-        for row in reader:
-            source, target, weight = int(row[0]), int(row[1]), float(row[2])
-
-            # Handle the case where source or target is -1 (outside vertex)
-            if source == -1 or target == -1:
-                valid_vertex = source if source != -1 else target
-                graph.nodes[valid_vertex]['boundary_node'] = True
-                graph.nodes[valid_vertex]['boundary_perim'] = weight
-            else:
-                graph.add_edge(source, target, shared_perim=weight)
-                graph.add_edge(target, source, shared_perim=weight)
-
-    return graph
+    return graph_from_arrays(read_graph_arrays_from_dataset(dataset))
 
 
 def print_graph(graph: nx.DiGraph):
@@ -59,4 +222,4 @@ def print_graph(graph: nx.DiGraph):
 
     print("\nEdges:")
     for source, target, data in graph.edges(data=True):
-        print(f"Edge from {source} to {target} with weight {data['weight']}")
\ No newline at end of file
+        print(f"Edge from {source} to {target} with weight {data['weight']}")
@@ -0,0 +1,343 @@
+import argparse
+import math
+import random
+import time
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+from graph_utils import GraphArrays, read_graph_arrays_from_dataset
+from mip_heuristic import _adjacency_lists, inverse_polsby_popper
+from solution_io import save_solution_summary
+
+"""
+Anytime local search for the single district problem on graphs too large for the MISOCP. Simulated annealing with
+add and remove moves on the district boundary, run from several starts in parallel. DistrictState keeps the area,
+the perimeter and the boundary of the district up to date in O(deg(v)) per added or removed node, and evaluates a
+move in O(1). Adding a neighboring node always keeps the district contiguous; a removal is checked with a bounded
+breadth-first search that has to reconnect the district neighbors of the removed node, moves for which the search
+hits its limit are rejected, so the district is contiguous at all times. Needs neither Gurobi nor the networkx graph.
+"""
+
+# State of a worker process, set by _init_worker
+_worker = {}
+
+
+class _IndexedSet:
+    """Set of node indices with O(1) add, discard and uniform sampling."""
+
+    def __init__(self, num_nodes: int):
+        self.items = []
+        self.position = [-1] * num_nodes
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def add(self, v: int):
+        if self.position[v] < 0:
+            self.position[v] = len(self.items)
+            self.items.append(v)
+
+    def discard(self, v: int):
+        i = self.position[v]
+        if i >= 0:
+            last = self.items.pop()
+            if last != v:
+                self.items[i] = last
+                self.position[last] = i
+            self.position[v] = -1
+
+    def sample(self, rng: random.Random) -> int:
+        return self.items[rng.randrange(len(self.items))]
+
+
+class DistrictState:
+    """
+    District with its area, perimeter, frontier (outside nodes adjacent to it) and border (district nodes with an
+    outside neighbor or on the outer boundary). For every node the summed shared perimeter with district nodes is
+    kept, so the perimeter change of a move is known in O(1) and applying a move costs O(deg(v)).
+    """
+
+    def __init__(self, arrays: GraphArrays, adjacency: list[list[int]] | None = None,
+                 shared: list[list[float]] | None = None):
+        if adjacency is None:
+            adjacency, shared = _adjacency_lists(arrays)
+        n = arrays.num_nodes
+        self.weight = arrays.node_weight.tolist()
+        self.boundary_perim = arrays.boundary_perim.tolist()
+        self.adjacency = adjacency
+        self.shared = shared
+        self.total_shared = [sum(s) for s in shared]
+        self.inside = bytearray(n)
+        self.inside_shared = [0.0] * n
+        self.inside_count = [0] * n
+        self.frontier = _IndexedSet(n)
+        self.border = _IndexedSet(n)
+        self.size = 0
+        self.area = 0.0
+        self.perimeter = 0.0
+
+    def perimeter_change(self, v: int) -> float:
+        """Change of the perimeter when v is added (for a node of the district: minus the change when removed)."""
+        return self.boundary_perim[v] + self.total_shared[v] - 2 * self.inside_shared[v]
+
+    def objective(self) -> float:
+        return inverse_polsby_popper(self.area, self.perimeter)
+
+    def objective_after_add(self, v: int) -> float:
+        return inverse_polsby_popper(self.area + self.weight[v], self.perimeter + self.perimeter_change(v))
+
+    def objective_after_remove(self, v: int) -> float:
+        return inverse_polsby_popper(self.area - self.weight[v], self.perimeter - self.perimeter_change(v))
+
+    def _is_border(self, v: int) -> bool:
+        return self.inside_count[v] < len(self.adjacency[v]) or self.boundary_perim[v] > 0
+
+    def add(self, v: int):
+        self.perimeter += self.perimeter_change(v)
+        self.area += self.weight[v]
+        self.size += 1
+        self.inside[v] = 1
+        self.frontier.discard(v)
+        if self._is_border(v):
+            self.border.add(v)
+        inside, inside_shared, inside_count = self.inside, self.inside_shared, self.inside_count
+        for u, s in zip(self.adjacency[v], self.shared[v]):
+            inside_shared[u] += s
+            inside_count[u] += 1
+            if not inside[u]:
+                self.frontier.add(u)
+            elif not self._is_border(u):
+                self.border.discard(u)
+
+    def remove(self, v: int):
+        self.perimeter -= self.perimeter_change(v)
+        self.area -= self.weight[v]
+        self.size -= 1
+        self.inside[v] = 0
+        self.border.discard(v)
+        if self.inside_count[v] > 0:
+            self.frontier.add(v)
+        inside, inside_shared, inside_count = self.inside, self.inside_shared, self.inside_count
+        for u, s in zip(self.adjacency[v], self.shared[v]):
+            inside_shared[u] -= s
+            inside_count[u] -= 1
+            if inside[u]:
+                self.border.add(u)
+            elif inside_count[u] == 0:
+                self.frontier.discard(u)
+
+    def stays_contiguous_without(self, v: int, limit: int = 1000) -> bool:
+        """
+        True if the district stays connected (and not empty) without v: a breadth-first search through the district
+        from one district neighbor of v has to reach all others. Returns False if the search visits more than limit
+        nodes, so a True is always correct.
+        """
+        inside, adjacency = self.inside, self.adjacency
+        neighbors = [u for u in adjacency[v] if inside[u]]
+        if len(neighbors) <= 1:
+            return len(neighbors) == 1
+        targets = set(neighbors[1:])
+        seen = {v, neighbors[0]}
+        queue = deque([neighbors[0]])
+        while queue and len(seen) <= limit:
+            for u in adjacency[queue.popleft()]:
+                if inside[u] and u not in seen:
+                    if u in targets:
+                        targets.discard(u)
+                        if not targets:
+                            return True
+                    seen.add(u)
+                    queue.append(u)
+        return False
+
+    def nodes(self) -> np.ndarray:
+        """Node indices of the district."""
+        return np.flatnonzero(np.frombuffer(bytes(self.inside), dtype=np.uint8))
+
+    def recompute(self):
+        """Recomputes area and perimeter from the district nodes (removes the rounding errors of the updates)."""
+        nodes = self.nodes().tolist()
+        self.area = sum(self.weight[v] for v in nodes)
+        self.perimeter = sum(self.boundary_perim[v] + sum(s for u, s in zip(self.adjacency[v], self.shared[v])
+                                                          if not self.inside[u]) for v in nodes)
+
+
+def initial_district(state: DistrictState, seed: int, area_lower_bound: float = 0) -> bool:
+    """
+    Starts the district at the seed and adds nodes in breadth-first order until the area lower bound is reached.
+    :return: True if the area lower bound was reached.
+    """
+    state.add(seed)
+    queue = deque([seed])
+    while queue and state.area < area_lower_bound:
+        for u in state.adjacency[queue.popleft()]:
+            if not state.inside[u]:
+                state.add(u)
+                queue.append(u)
+                if state.area >= area_lower_bound:
+                    break
+    return state.area >= area_lower_bound
+
+
+def anneal(state: DistrictState, area_lower_bound: float = 0, time_limit: float = 60,
+           max_iterations: int | None = None, rng: random.Random | None = None, initial_temperature: float = 0.05,
+           final_temperature: float = 1e-5, contiguity_limit: int = 1000) -> dict:
+    """
+    Simulated annealing with add and remove moves. A random frontier node is added or a random border node removed,
+    a worse district is accepted with probability exp(-relative worsening / temperature). The temperature decreases
+    geometrically over the time limit. At the end the state holds the best district found.
+    :return: Dict with the number of iterations and accepted moves, the status ('TIME_LIMIT' or 'ITERATION_LIMIT')
+             and the trace of (time, objective) of every improvement of the best district.
+    """
+    rng = rng or random.Random(0)
+    start = time.perf_counter()
+    objective = best = state.objective()
+    journal = []  # moves since the best district, undone at the end
+    trace = [(0.0, best)]
+    temperature = initial_temperature
+    cooling = math.log(final_temperature / initial_temperature)
+    iteration = accepted = 0
+    status = 'ITERATION_LIMIT'
+
+    while max_iterations is None or iteration < max_iterations:
+        if iteration & 255 == 0:
+            elapsed = time.perf_counter() - start
+            if elapsed >= time_limit:
+                status = 'TIME_LIMIT'
+                break
+            temperature = initial_temperature * math.exp(cooling * elapsed / time_limit)
+        iteration += 1
+
+        add = len(state.frontier) > 0 and (state.size <= 1 or rng.random() < 0.5)
+        if add:
+            v = state.frontier.sample(rng)
+            candidate = state.objective_after_add(v)
+        elif len(state.border) == 0:
+            break
+        else:
+            v = state.border.sample(rng)
+            if state.area - state.weight[v] < area_lower_bound:
+                continue
+            candidate = state.objective_after_remove(v)
+
+        if candidate > objective and (not math.isfinite(candidate)
+                                      or rng.random() >= math.exp((objective - candidate) / (temperature * objective))):
+            continue
+        if not add and not state.stays_contiguous_without(v, contiguity_limit):
+            continue
+
+        (state.add if add else state.remove)(v)
+        journal.append((v, add))
+        objective = candidate
+        accepted += 1
+        if objective < best - 1e-12:
+            best = objective
+            journal.clear()
+            trace.append((time.perf_counter() - start, best))
+
+    for v, added in reversed(journal):
+        (state.remove if added else state.add)(v)
+    state.recompute()
+    return {'iterations': iteration, 'accepted': accepted, 'status': status, 'trace': trace,
+            'time': time.perf_counter() - start}
+
+
+def _init_worker(arrays: GraphArrays, area_lower_bound: float, options: dict):
+    """Stores the problem data (and the adjacency lists, built once per worker) in the worker process."""
+    _worker['arrays'] = arrays
+    _worker['adjacency'] = _adjacency_lists(arrays)
+    _worker['area_lower_bound'] = area_lower_bound
+    _worker['options'] = options
+
+
+def _run_start(job: tuple[int, np.ndarray, int]) -> dict:
+    """Runs the annealing from one start (a seed node or the node indices of a district)."""
+    index, start_nodes, rng_seed = job
+    arrays, area_lower_bound = _worker['arrays'], _worker['area_lower_bound']
+    state = DistrictState(arrays, *_worker['adjacency'])
+    start_nodes = np.atleast_1d(start_nodes).tolist()
+    if len(start_nodes) > 1:
+        # a given district, added in breadth-first order so the state is contiguous after every step
+        members = set(start_nodes)
+        state.add(start_nodes[0])
+        queue = deque([start_nodes[0]])
+        while queue:
+            for u in state.adjacency[queue.popleft()]:
+                if u in members and not state.inside[u]:
+                    state.add(u)
+                    queue.append(u)
+        feasible = state.area >= area_lower_bound
+    else:
+        feasible = initial_district(state, start_nodes[0], area_lower_bound)
+    if not feasible:
+        return {'start': index, 'nodes': None, 'objective': math.inf, 'status': 'INFEASIBLE', 'iterations': 0,
+                'time': 0.0, 'trace': []}
+
+    result = anneal(state, area_lower_bound, rng=random.Random(rng_seed), **_worker['options'])
+    return dict(result, start=index, nodes=state.nodes(), objective=state.objective(), area=state.area,
+                perimeter=state.perimeter)
+
+
+def solve_local_search(arrays: GraphArrays, area_lower_bound: float = 0, starts: int = 8,
+                       processes: int | None = None, time_limit: float = 60, seed: int = 0,
+                       start_district: np.ndarray | None = None, max_iterations: int | None = None,
+                       contiguity_limit: int = 1000) -> dict:
+    """
+    Multi-start simulated annealing. The seeds are drawn with probability proportional to the node weight, every
+    start grows a district from its seed (see initial_district) and anneals it.
+    :param arrays: The graph as GraphArrays (e.g., get_graph_arrays of the graph of read_graph_from_dataset).
+    :param area_lower_bound: Lower bound for the area of the district.
+    :param starts: Number of starts.
+    :param processes: Number of worker processes (default: number of CPUs, at most starts), 1 runs in this process.
+    :param time_limit: Time limit of every start.
+    :param start_district: Optional node indices of a contiguous district used as the first start.
+    :param contiguity_limit: Nodes the contiguity check of a removal may visit before the removal is rejected.
+    :return: The best result: node indices ('nodes'), objective, area, perimeter, status and trace, plus the
+             objective of every start in 'starts'.
+    """
+    rng = np.random.default_rng(seed)
+    probabilities = arrays.node_weight / arrays.node_weight.sum()
+    seeds = rng.choice(arrays.num_nodes, size=min(starts, arrays.num_nodes), replace=False, p=probabilities)
+    jobs = [(index, node, seed + index) for index, node in enumerate(seeds.tolist())]
+    if start_district is not None:
+        jobs[0] = (0, np.asarray(start_district, dtype=np.int64), seed)
+
+    options = {'time_limit': time_limit, 'max_iterations': max_iterations, 'contiguity_limit': contiguity_limit}
+    processes = min(processes or cpu_count(), len(jobs))
+    if processes == 1:
+        _init_worker(arrays, area_lower_bound, options)
+        results = [_run_start(job) for job in jobs]
+    else:
+        with Pool(processes, initializer=_init_worker, initargs=(arrays, area_lower_bound, options)) as pool:
+            results = list(pool.imap_unordered(_run_start, jobs))
+
+    best = min(results, key=lambda result: result['objective'])
+    best['starts'] = sorted((result['start'], result['objective']) for result in results)
+    return best
+
+
+parser = argparse.ArgumentParser(description="Solve the single district problem with multi-start simulated annealing")
+parser.add_argument('dataset', help='Name of the dataset (e.g. issoire)')
+parser.add_argument('-l', '--lower-bound', type=float, default=0, help='Area lower bound')
+parser.add_argument('-n', '--starts', type=int, default=8, help='Number of starts')
+parser.add_argument('-p', '--processes', type=int, default=None, help='Number of worker processes')
+parser.add_argument('--time-limit', type=float, default=60, help='Time limit of every start')
+parser.add_argument('--max-iterations', type=int, default=None, help='Iteration limit of every start')
+parser.add_argument('--seed', type=int, default=0, help='Random seed')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    graph_arrays = read_graph_arrays_from_dataset(args.dataset)
+    result = solve_local_search(graph_arrays, args.lower_bound, args.starts, args.processes, args.time_limit,
+                                args.seed, max_iterations=args.max_iterations)
+    if result['nodes'] is None:
+        print(f"No start reached the area lower bound {args.lower_bound}.")
+    else:
+        print(f"Local search: best start {result['start']}, {result['iterations']} iterations "
+              f"({result['accepted']} accepted) in {result['time']:.2f}s, objectives of all starts: "
+              f"{', '.join(f'{objective:.4f}' for _, objective in result['starts'])}")
+        suffix = f"_LB={args.lower_bound}" if args.lower_bound > 0 else ""
+        save_solution_summary(graph_arrays.fids[result['nodes']].tolist(), result['objective'], result['area'],
+                              result['perimeter'], result['status'], args.dataset, f"{suffix}_local")
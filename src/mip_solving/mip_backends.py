@@ -0,0 +1,430 @@
+import math
+import time
+from typing import NamedTuple
+
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+
+from graph_reduction import expand_solution, reduce_district_graph
+from graph_utils import GraphArrays, get_graph_arrays
+from mip_contiguity import ContiguityEngine
+from mip_heuristic import find_warm_start
+
+"""
+Solver backends for the single district problem. A backend builds the model (x, y, A, P, z with the constraint
+P^2 <= 4 pi A z), enforces contiguity with a,b-separator cuts on integer solutions and extracts the result in a
+solver independent form. The solver packages are imported when a backend is created, so e.g. the HiGHS backend
+runs without gurobipy.
+"""
+
+
+class BackendResult(NamedTuple):
+    """Solver independent result of a single district solve."""
+    solution: list[int] | None  # FIDs of the district (None if no district was found)
+    objective: float  # inverse Polsby-Popper score of the district
+    bound: float  # lower bound on the inverse Polsby-Popper score
+    area: float
+    perimeter: float
+    status: str  # 'OPTIMAL', 'TIME_LIMIT', 'INFEASIBLE', ...
+    runtime: float  # seconds
+    node_count: int  # branch-and-bound nodes (summed over all MIP solves)
+    num_lazy_cuts: int  # contiguity cuts added
+    model: object  # the solver's model object
+
+
+def district_area_perimeter(arrays: GraphArrays, nodes: np.ndarray) -> tuple[float, float]:
+    """Area and perimeter of the district consisting of the given node indices."""
+    x = np.zeros(arrays.num_nodes)
+    x[nodes] = 1
+    perimeter = arrays.boundary_perim @ x + arrays.shared_perim @ (x[arrays.arc_tails()] * (1 - x[arrays.indices]))
+    return float(arrays.node_weight @ x), float(perimeter)
+
+
+class SolverBackend:
+    """
+    Interface of a solver backend. A backend is used once: build, optionally set_start, optimize and result.
+    """
+    name = None
+
+    def build(self, DG: nx.DiGraph, area_lower_bound: float = 0, root: int | None = None) -> None:
+        """
+        Builds the model for the graph (see build_single_district_mip for the attributes of DG, the graph attributes
+        'implications' and 'bounds' of graph_reduction are used if present).
+        :param root: Optional FID of a node that has to be in the district.
+        """
+        raise NotImplementedError
+
+    def set_start(self, district: np.ndarray) -> None:
+        """Passes a contiguous district (node indices into the graph arrays) as start solution."""
+        raise NotImplementedError
+
+    def optimize(self, time_limit: float = 3600, threads: int = 1) -> None:
+        raise NotImplementedError
+
+    def result(self) -> BackendResult:
+        raise NotImplementedError
+
+
+class GurobiBackend(SolverBackend):
+    """The MISOCP of build_single_district_mip with lazy contiguity cuts in a Gurobi callback."""
+    name = "gurobi"
+
+    def __init__(self, user_cuts: bool = False, log_file: str | None = None, verbose: bool = True):
+        import gurobipy  # fail early if Gurobi is not installed
+        self.user_cuts = user_cuts
+        self.log_file = log_file
+        self.verbose = verbose
+        self.model = None
+
+    def build(self, DG: nx.DiGraph, area_lower_bound: float = 0, root: int | None = None) -> None:
+        from mip_build_district import build_single_district_mip
+        self.model = build_single_district_mip(DG, root=root, area_lower_bound=area_lower_bound,
+                                               user_cuts=self.user_cuts, verbose=self.verbose)
+        if not self.verbose:
+            self.model.Params.OutputFlag = 0
+        if self.log_file is not None:
+            self.model.Params.LogFile = self.log_file
+
+    def set_start(self, district: np.ndarray) -> None:
+        from mip_solver import set_mip_start
+        set_mip_start(self.model, district)
+
+    def optimize(self, time_limit: float = 3600, threads: int = 1) -> None:
+        m = self.model
+        m.Params.TimeLimit = time_limit
+        m.Params.Threads = threads
+        m.optimize(m._callback)
+
+    def result(self) -> BackendResult:
+        from gurobipy import GRB
+        m = self.model
+        status_names = {GRB.OPTIMAL: 'OPTIMAL', GRB.TIME_LIMIT: 'TIME_LIMIT', GRB.INFEASIBLE: 'INFEASIBLE',
+                        GRB.INF_OR_UNBD: 'INFEASIBLE', GRB.INTERRUPTED: 'INTERRUPTED', GRB.SUBOPTIMAL: 'SUBOPTIMAL'}
+        found = m.SolCount > 0
+        return BackendResult(
+            solution=[i for i in m._DG.nodes if m._x[i].X > 0.5] if found else None,
+            objective=m._z.X if found else math.inf, bound=m.ObjBound if m.status != GRB.INFEASIBLE else math.inf,
+            area=m._A.X if found else 0.0, perimeter=m._P.X if found else 0.0,
+            status=status_names.get(m.status, str(m.status)), runtime=m.Runtime, node_count=int(m.NodeCount),
+            num_lazy_cuts=m._numLazyCuts, model=m)
+
+
+class HighsBackend(SolverBackend):
+    """
+    Outer approximation of the MISOCP with the open-source MILP solver HiGHS. The convex function P^2 / A is
+    replaced by its tangents 4 pi z >= 2 r P - r^2 A at ratios r = P / A of actual districts (the inequality is tight
+    for districts with P = r A). The MILP is solved repeatedly; after every solve, a,b-separator cuts are added for the
+    components of a non-contiguous solution and a tangent at the solution if z underestimates its score. The loop
+    stops when the solution is contiguous and its z equals its score, then it is optimal. Contiguous solutions (and
+    the components of non-contiguous ones) are kept as incumbents and passed to HiGHS as start solution.
+    A and P are scaled by the total area and its square root, so both are of order one and the tangent coefficients
+    stay small. Scores are computed from the selected nodes, not from the A and P columns of the MILP. For districts
+    too small for a well scaled tangent (e.g., sliver polygons), a district cut is added instead. The MILP optimum is
+    a lower bound, so a z above the score of a known district is reported as NUMERICAL_ERROR instead of optimality.
+    """
+    name = "highs"
+
+    def __init__(self, tolerance: float = 1e-6, num_initial_tangents: int = 16, max_iterations: int = 10000,
+                 verbose: bool = True):
+        import highspy
+        self._highspy = highspy
+        self.tolerance = tolerance
+        self.num_initial_tangents = num_initial_tangents
+        self.max_iterations = max_iterations
+        self.verbose = verbose
+
+        self.highs = None
+        self.area_scale = 1.0
+        self.perimeter_scale = 1.0
+        self.incumbent = None  # (objective, node indices, area, perimeter) of the best district
+        self.bound = 0.0
+        self.status = 'LOADED'
+        self.runtime = 0.0
+        self.node_count = 0
+        self.num_lazy_cuts = 0
+        self.num_tangents = 0
+        self.num_district_cuts = 0
+        self.iterations = 0
+
+    def _add_rows(self, matrix: sp.csr_matrix, lower: np.ndarray, upper: np.ndarray) -> None:
+        matrix = sp.csr_matrix(matrix)
+        self.highs.addRows(matrix.shape[0], np.asarray(lower, dtype=float), np.asarray(upper, dtype=float),
+                           matrix.nnz, matrix.indptr[:-1].astype(np.int32), matrix.indices.astype(np.int32),
+                           matrix.data.astype(float))
+
+    def _add_tangent(self, area: float, perimeter: float) -> None:
+        """
+        Adds the tangent 4 pi z - 2 r P + r^2 A >= 0 at the ratio r = P / A of a district (in scaled units), divided
+        by r to keep its coefficients small.
+        """
+        ratio = (perimeter / self.perimeter_scale) / (area / self.area_scale)
+        self.highs.addRow(0.0, math.inf, 3, np.array([self._A, self._P, self._z], dtype=np.int32),
+                          np.array([ratio, -2.0, 4 * math.pi / ratio]))
+        self.num_tangents += 1
+
+    def _well_scaled(self, area: float) -> bool:
+        """True if the tangent at a district with this area has coefficients HiGHS can handle."""
+        return area / self.area_scale >= self.tolerance
+
+    def _add_district_cut(self, nodes: np.ndarray, score: float) -> None:
+        """
+        Adds z >= score (sum(x_v for v in S) - |S| + 1 - sum(x_u for u in N(S))) for the contiguous district S. Only
+        S itself contains S and no neighbor of S, so the inequality is tight at S and redundant for other districts.
+        """
+        arrays = self.arrays
+        inside = np.zeros(arrays.num_nodes, dtype=bool)
+        inside[nodes] = True
+        neighbors = np.unique(arrays.indices[np.concatenate([np.arange(arrays.indptr[v], arrays.indptr[v + 1])
+                                                             for v in nodes])])
+        neighbors = neighbors[~inside[neighbors]]
+        columns = np.concatenate(([self._z], nodes, neighbors)).astype(np.int32)
+        values = np.concatenate(([1.0], np.full(len(nodes), -score), np.full(len(neighbors), score)))
+        self.highs.addRow(score * (1 - len(nodes)), math.inf, len(columns), columns, values)
+        self.num_district_cuts += 1
+
+    def _add_separator_cut(self, a: int, b: int, C: np.ndarray) -> None:
+        """Adds the a,b-separator inequality x_a + x_b - sum(x_c for c in C) <= 1."""
+        self.highs.addRow(-math.inf, 1.0, 2 + len(C), np.concatenate(([a, b], C)).astype(np.int32),
+                          np.concatenate(([1.0, 1.0], -np.ones(len(C)))))
+        self.num_lazy_cuts += 1
+
+    def _update_incumbent(self, nodes: np.ndarray) -> None:
+        """Keeps the district as incumbent if it is feasible and better than the current incumbent."""
+        if len(nodes) == 0 or (self._root_index is not None and self._root_index not in nodes):
+            return
+        area, perimeter = district_area_perimeter(self.arrays, nodes)
+        if area < self.area_lower_bound or area <= 0:
+            return
+        objective = perimeter * perimeter / (4 * math.pi * area)
+        if self.incumbent is None or objective < self.incumbent[0]:
+            self.incumbent = (objective, np.sort(nodes), area, perimeter)
+
+    def _incumbent_columns(self) -> np.ndarray:
+        """Column values of the incumbent (x, y, A, P, z)."""
+        objective, nodes, area, perimeter = self.incumbent
+        arrays = self.arrays
+        x = np.zeros(arrays.num_nodes)
+        x[nodes] = 1
+        y = x[arrays.arc_tails()] * (1 - x[arrays.indices])
+        return np.concatenate((x, y, [area / self.area_scale, perimeter / self.perimeter_scale, objective]))
+
+    def build(self, DG: nx.DiGraph, area_lower_bound: float = 0, root: int | None = None) -> None:
+        highspy = self._highspy
+        self.DG = DG
+        self.arrays = arrays = get_graph_arrays(DG)
+        self.engine = ContiguityEngine(arrays)
+        self.area_lower_bound = area_lower_bound
+        self._root_index = None if root is None else self.engine.index[root]
+        n, num_arcs = arrays.num_nodes, arrays.num_arcs
+        tails, heads = arrays.arc_tails(), arrays.indices
+
+        h = self.highs = highspy.Highs()
+        h.setOptionValue('output_flag', False)
+        h.setOptionValue('mip_rel_gap', 0.0)
+        h.setOptionValue('mip_feasibility_tolerance', 1e-7)
+
+        # Columns: x (n), y (num_arcs), A, P (scaled), z
+        self._A, self._P, self._z = n + num_arcs, n + num_arcs + 1, n + num_arcs + 2
+        num_cols = n + num_arcs + 3
+        total_area = float(arrays.node_weight.sum())
+        self.area_scale = total_area if total_area > 0 else 1.0
+        self.perimeter_scale = math.sqrt(self.area_scale)
+        bounds = DG.graph.get('bounds') or {}
+        lower = np.zeros(num_cols)
+        upper = np.ones(num_cols)
+        lower[self._A] = max(area_lower_bound, bounds.get('area_min', 0)) / self.area_scale
+        upper[self._A] = bounds.get('area_max', math.inf) / self.area_scale
+        upper[self._P] = bounds.get('perimeter_max', math.inf) / self.perimeter_scale
+        upper[self._z] = math.inf
+        if self._root_index is not None:
+            lower[self._root_index] = 1
+        costs = np.zeros(num_cols)
+        costs[self._z] = 1
+        h.addCols(num_cols, costs, lower, upper, 0, np.zeros(num_cols, dtype=np.int32), np.zeros(0, dtype=np.int32),
+                  np.zeros(0))
+        integer = np.arange(n + num_arcs, dtype=np.int32)
+        h.changeColsIntegrality(len(integer), integer, np.full(len(integer), highspy.HighsVarType.kInteger,
+                                                               dtype=np.uint8))
+
+        # y[u,v] >= x[u] - x[v] for every arc
+        arc_range = np.arange(num_arcs)
+        cut_rows = sp.csr_matrix((np.concatenate((np.ones(num_arcs), -np.ones(num_arcs), -np.ones(num_arcs))),
+                                  (np.tile(arc_range, 3), np.concatenate((tails, heads, n + arc_range)))),
+                                 shape=(num_arcs, num_cols))
+        self._add_rows(cut_rows, np.full(num_arcs, -math.inf), np.zeros(num_arcs))
+
+        # A = w x, P = s y + b x
+        area_row = np.concatenate((arrays.node_weight / self.area_scale, np.zeros(num_arcs), [-1, 0, 0]))
+        perimeter_row = np.concatenate((arrays.boundary_perim / self.perimeter_scale,
+                                        arrays.shared_perim / self.perimeter_scale, [0, -1, 0]))
+        self._add_rows(sp.csr_matrix(np.vstack((area_row, perimeter_row))), np.zeros(2), np.zeros(2))
+
+        # at least one node with positive area, districts of area zero have no score
+        if area_lower_bound <= 0:
+            positive = np.flatnonzero(arrays.node_weight > 0)
+            self._add_rows(sp.csr_matrix((np.ones(len(positive)), (np.zeros(len(positive), dtype=int), positive)),
+                                         shape=(1, num_cols)), [1], [math.inf])
+
+        # x[u] <= x[v] for the implications of graph_reduction
+        implications = DG.graph.get('implications')
+        if implications:
+            index = self.engine.index
+            k = len(implications)
+            rows = sp.csr_matrix((np.concatenate((np.ones(k), -np.ones(k))),
+                                  (np.tile(np.arange(k), 2), [index[u] for u, _ in implications]
+                                   + [index[v] for _, v in implications])), shape=(k, num_cols))
+            self._add_rows(rows, np.full(k, -math.inf), np.zeros(k))
+
+        # Initial tangents at single node districts, spread over their ratios P / A
+        total_perim = arrays.boundary_perim + np.bincount(tails, weights=arrays.shared_perim, minlength=n)
+        positive = np.flatnonzero([self._well_scaled(area) for area in arrays.node_weight])
+        if len(positive) > 0 and self.num_initial_tangents > 0:
+            by_ratio = positive[np.argsort(total_perim[positive] / arrays.node_weight[positive])]
+            picks = np.unique(np.linspace(0, len(by_ratio) - 1, self.num_initial_tangents).round().astype(int))
+            for v in by_ratio[picks]:
+                self._add_tangent(float(arrays.node_weight[v]), float(total_perim[v]))
+
+    def set_start(self, district: np.ndarray) -> None:
+        self._update_incumbent(np.asarray(district))
+        if self.incumbent is not None:
+            _, _, area, perimeter = self.incumbent
+            if self._well_scaled(area):
+                self._add_tangent(area, perimeter)
+
+    def optimize(self, time_limit: float = 3600, threads: int = 1) -> None:
+        highspy = self._highspy
+        h = self.highs
+        h.setOptionValue('threads', threads)
+        start = time.time()
+        n = self.arrays.num_nodes
+        self.status = 'ITERATION_LIMIT'
+
+        for self.iterations in range(1, self.max_iterations + 1):
+            remaining = time_limit - (time.time() - start)
+            if remaining <= 0:
+                self.status = 'TIME_LIMIT'
+                break
+            h.setOptionValue('time_limit', remaining)
+            if self.incumbent is not None:
+                columns = self._incumbent_columns()
+                h.setSolution(len(columns), np.arange(len(columns), dtype=np.int32), columns)
+
+            h.run()
+            model_status = h.getModelStatus()
+            info = h.getInfo()
+            self.node_count += max(0, int(info.mip_node_count))
+
+            if model_status in (highspy.HighsModelStatus.kInfeasible, highspy.HighsModelStatus.kModelEmpty):
+                self.status = 'OPTIMAL' if self.incumbent is not None else 'INFEASIBLE'
+                break
+            if model_status != highspy.HighsModelStatus.kOptimal:
+                # time limit (or another limit) in the MILP, its dual bound is still a valid bound
+                self.bound = max(self.bound, float(info.mip_dual_bound))
+                self.status = 'TIME_LIMIT' if model_status == highspy.HighsModelStatus.kTimeLimit \
+                    else h.modelStatusToString(model_status)
+                break
+
+            # the MILP is a relaxation of the problem, so its optimum is a lower bound; above the score of a known
+            # district it is a numerical failure and no bound
+            columns = np.asarray(h.getSolution().col_value)
+            z = float(columns[self._z])
+            if self.incumbent is not None and z > self.incumbent[0] + self.tolerance * max(1.0, self.incumbent[0]):
+                self.status = 'NUMERICAL_ERROR'
+                break
+            self.bound = max(self.bound, z)
+
+            selected = np.flatnonzero(columns[:n] > 0.5)
+            cuts, num_components = self.engine.integer_separator_cuts(selected, self._root_index)
+            for component in (self.engine.components(selected) if num_components > 1 else [selected]):
+                self._update_incumbent(component)
+            for a, b, C in cuts:
+                self._add_separator_cut(a, b, C)
+
+            area, perimeter = district_area_perimeter(self.arrays, selected)
+            score = perimeter * perimeter / (4 * math.pi * area) if area > 0 else math.inf
+            underestimated = z < score - self.tolerance * max(1.0, score)
+            if underestimated and area > 0:
+                if self._well_scaled(area):
+                    self._add_tangent(area, perimeter)
+                elif not cuts:
+                    self._add_district_cut(selected, score)
+
+            if self.incumbent is not None and self.bound >= self.incumbent[0] - self.tolerance * max(1.0, self.bound):
+                self.status = 'OPTIMAL'
+                break
+            if not cuts and not underestimated:
+                self.status = 'OPTIMAL'
+                break
+
+        self.runtime = time.time() - start
+        if self.verbose:
+            print(f"HiGHS outer approximation: {self.iterations} MILP solves, {self.num_lazy_cuts} contiguity cuts, "
+                  f"{self.num_tangents} tangents, {self.num_district_cuts} district cuts, {self.node_count} nodes in "
+                  f"{self.runtime:.3f}s")
+
+    def result(self) -> BackendResult:
+        if self.incumbent is None:
+            return BackendResult(solution=None, objective=math.inf,
+                                 bound=math.inf if self.status == 'INFEASIBLE' else self.bound, area=0.0, perimeter=0.0,
+                                 status=self.status, runtime=self.runtime, node_count=self.node_count,
+                                 num_lazy_cuts=self.num_lazy_cuts, model=self.highs)
+        objective, nodes, area, perimeter = self.incumbent
+        return BackendResult(solution=self.arrays.fids[nodes].tolist(), objective=objective,
+                             bound=self.bound, area=area, perimeter=perimeter, status=self.status,
+                             runtime=self.runtime, node_count=self.node_count, num_lazy_cuts=self.num_lazy_cuts,
+                             model=self.highs)
+
+
+BACKENDS = {backend.name: backend for backend in (GurobiBackend, HighsBackend)}
+
+
+def get_backend(name: str, **options) -> SolverBackend:
+    """
+    Creates the backend with the given name ('gurobi' or 'highs').
+    :param options: Options passed to the backend (e.g., user_cuts for Gurobi).
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown solver backend '{name}', available backends: {', '.join(BACKENDS)}")
+    return BACKENDS[name](**options)
+
+
+def solve_with_backend(DG: nx.DiGraph, area_lower_bound: float = 0, backend: str = "highs", threads: int = 1,
+                       time_limit: float = 3600, warm_start: bool = True, reduce: bool = True,
+                       **options) -> BackendResult:
+    """
+    Solve the single district problem with the given backend. Like solve_single_district_mip, the graph is reduced
+    first and the heuristic district is used as start solution.
+
+    :param DG: Directed graph representing the districting problem (see build_single_district_mip).
+    :param area_lower_bound: Lower bound for the area.
+    :param backend: Name of the backend ('gurobi' or 'highs').
+    :param threads: Number of threads the solver may use.
+    :param time_limit: Time limit in seconds.
+    :param warm_start: If True, pass the district of the heuristic of mip_heuristic as start solution.
+    :param reduce: If True, solve on the graph reduced by graph_reduction.reduce_graph.
+    :param options: Options of the backend (see get_backend).
+    :return: The BackendResult, with the district in FIDs of the original graph.
+    """
+    reduction = None
+    if reduce:
+        DG, reduction = reduce_district_graph(DG, area_lower_bound)
+
+    solver = get_backend(backend, **options)
+    solver.build(DG, area_lower_bound)
+
+    if warm_start:
+        heuristic = find_warm_start(get_graph_arrays(DG), area_lower_bound)
+        if heuristic is not None:
+            print(f"Warm start heuristic: objective {heuristic['objective']:.4f} with {len(heuristic['nodes'])} nodes "
+                  f"in {heuristic['time']:.3f}s")
+            solver.set_start(heuristic['nodes'])
+
+    solver.optimize(time_limit=time_limit, threads=threads)
+    result = solver.result()
+    print(f"Backend {backend}: status {result.status}, objective {result.objective:.4f}, bound {result.bound:.4f}, "
+          f"{result.num_lazy_cuts} contiguity cuts, {result.node_count} nodes, runtime {result.runtime:.3f}s")
+
+    if reduction is not None and result.solution is not None:
+        result = result._replace(solution=expand_solution(reduction, result.solution))
+    return result
@@ -1,32 +1,218 @@
 import math
+import time
 
 import gurobipy as gp
 from gurobipy import GRB
 import networkx as nx
+import numpy as np
+import scipy.sparse as sp
 
-from mip_contiguity import find_fischetti_separator
+from graph_utils import get_graph_arrays
+from mip_contiguity import ContiguityEngine
 
 """
 Code based on "Political districting to optimize the Polsby-Popper compactness score with application to  voting
 rights"
 """
 
+# Gurobi parameters of every single district model, the params of build_single_district_mip are set on top of them
+DEFAULT_PARAMS = {'MIPGap': 0.0, 'FeasibilityTol': 1e-7, 'IntFeasTol': 1e-7}
 
-def build_single_district_mip(DG : nx.DiGraph, root: int | None = None, area_lower_bound: float = 0) -> gp.Model:
+
+def build_single_district_mip(DG : nx.DiGraph, root: int | None = None, area_lower_bound: float = 0,
+                              use_matrix_api: bool = True, user_cuts: bool = False, user_cut_rounds: int = 5,
+                              user_cuts_per_round: int = 10, env: gp.Env | None = None,
+                              verbose: bool = True, params: dict | None = None) -> gp.Model:
     """
     Builds a MISOCP model for a single district in a directed graph DG, with the goal of maximizing the Polsby-Popper score.
     :param DG: Directed graph representing the districting problem, where nodes have 'node_weight' and 'boundary_perim' attributes,
                 and edges have 'shared_perim' attribute.
     :param root: Optional root node for the district, used to ensure contiguity. If None, no specific root is enforced.
     :param area_lower_bound: Lower bound for the area of the district. If set to a positive value, it enforces a minimum area constraint.
+    :param use_matrix_api: If True, build the model with the matrix API from the graph arrays (fast), otherwise build
+                it with one expression per node/edge of DG.
+    :param user_cuts: If True, also separate violated a,b-separator inequalities from fractional LP solutions at
+                MIPNODE (user cuts), in addition to the lazy cuts on integer solutions.
+    :param user_cut_rounds: Maximum number of user cut rounds per branch-and-bound node.
+    :param user_cuts_per_round: Maximum number of user cuts added in one round.
+    :param env: Optional Gurobi environment for the model (e.g., one with OutputFlag=0).
+    :param verbose: If False, do not print the build time.
+    :param params: Gurobi parameters (name: value) set on the model in addition to DEFAULT_PARAMS.
     :return: A Gurobi model object representing the districting problem.
     """
+    start = time.time()
+
+    if use_matrix_api:
+        m = _build_single_district_mip_matrix(DG, area_lower_bound, env)
+    else:
+        m = _build_single_district_mip_expressions(DG, area_lower_bound, env)
+
+    ###################################
+    # ADD DERIVED IMPLICATIONS AND BOUNDS (see graph_reduction)
+    ###################################
+
+    implications = DG.graph.get('implications')
+    if implications:
+        m.addConstrs((m._x[u] <= m._x[v] for u, v in implications), name="implication")
+
+    bounds = DG.graph.get('bounds')
+    if bounds:
+        m._A.LB = bounds['area_min']
+        m._A.UB = bounds['area_max']
+        m._P.UB = bounds['perimeter_max']
+
+    ###################################
+    # ADD CONTIGUITY CONSTRAINTS
+    ###################################
+
+    m._callback = None
+    m._numCallbacks = 0
+    m._numLazyCuts = 0
+    m._callbackTime = 0.0
+    m._separatorTime = 0.0
+    m._lazyCuts = []  # (a, b, separator) of all lazy cuts, so re-optimizations can add them as constraints
+    m._telemetry = None  # RunTelemetry (see mip_telemetry) fed with incumbents and bounds by the callback
+
+    m.Params.LazyConstraints = 1
+    m._DG = DG
+    m._root = root # TODO i dont know if its okay that we use root=None
+
+    # the contiguity engine works on node indices of the graph arrays, m._xvars and m._yvars hold x and y in the
+    # same node and arc order
+    arrays = get_graph_arrays(DG)
+    m._contiguity = ContiguityEngine(arrays)
+    m._xvars = [m._x[i] for i in arrays.fids.tolist()]
+    m._yvars = [m._y[u, v] for u, v in zip(arrays.fids[arrays.arc_tails()].tolist(), arrays.fids[arrays.indices].tolist())]
+    m._firstIncumbentTime = None
+    m._rootIndex = None if root is None else m._contiguity.index[root]
+    if root is not None:
+        # the root is always part of the district
+        m._x[root].LB = 1
+    m._callback = cut_callback
+
+    # user cuts from fractional solutions (optional)
+    m._userCuts = user_cuts
+    m._userCutRounds = user_cut_rounds
+    m._userCutsPerRound = user_cuts_per_round
+    m._numUserCuts = 0
+    m._userCutTime = 0.0
+    m._cutPool = set()  # (a, b, separator) of all cuts added so far, to never add a cut twice
+    m._lastCutNode = -1
+    m._cutRoundsAtNode = 0
+    if user_cuts:
+        m.Params.PreCrush = 1
+
+    ###################################
+    # SOLVE PARAMETERS
+    ###################################
+
+    for name, value in dict(DEFAULT_PARAMS, **(params or {})).items():
+        m.setParam(name, value)
+    m.update()
+
+    m._buildTime = time.time() - start
+    if verbose:
+        print(f"Model build time ({'matrix API' if use_matrix_api else 'expressions'}): {m._buildTime:.3f}s "
+              f"({m.NumVars} variables, {m.NumConstrs} constraints)")
+
+    return m
+
+
+def _build_single_district_mip_matrix(DG: nx.DiGraph, area_lower_bound: float = 0, env: gp.Env | None = None) -> gp.Model:
+    """
+    Builds the variables and constraints of the single district model with the matrix API, using sparse incidence
+    matrices made from the graph arrays. The variables are also exposed as tupledicts keyed like the networkx
+    nodes and edges (m._x[i], m._y[u, v]), so the model can be used exactly like the one built from expressions.
+    """
+    arrays = get_graph_arrays(DG)
+    n, num_arcs = arrays.num_nodes, arrays.num_arcs
+    tails, heads = arrays.arc_tails(), arrays.indices
+    fids = arrays.fids.tolist()
+    arcs = list(zip(arrays.fids[tails].tolist(), arrays.fids[heads].tolist()))
 
     ##################################
     # CREATE MODEL AND MAIN VARIABLES
     ##################################
 
-    m = gp.Model()
+    m = gp.Model(env=env)
+
+    # x[i] equals one when node i is selected in the district
+    m._xm = m.addMVar(n, vtype=GRB.BINARY, name=np.array([f"x[{i}]" for i in fids]))
+
+    # y[u,v] equals one when arc (u,v) is cut because u (but not v) is selected in the district
+    m._ym = m.addMVar(num_arcs, vtype=GRB.BINARY, name=np.array([f"y[{u},{v}]" for u, v in arcs]))
+
+    m._x = gp.tupledict(zip(fids, m._xm.tolist()))
+    m._y = gp.tupledict(zip(arcs, m._ym.tolist()))
+
+    ###########################
+    # ADD MAIN CONSTRAINTS
+    ###########################
+
+    # add constraints saying that edge {u,v} is cut if u (but not v) is selected in the district
+    # (arc-node incidence matrix with +1 at the tail and -1 at the head of every arc)
+    arc_range = np.arange(num_arcs)
+    incidence = sp.csr_matrix((np.concatenate((np.ones(num_arcs), -np.ones(num_arcs))),
+                               (np.concatenate((arc_range, arc_range)), np.concatenate((tails, heads)))),
+                              shape=(num_arcs, n))
+    m.addConstr(incidence @ m._xm - m._ym <= 0, name="cut")
+
+    ###########################
+    # ADD OBJECTIVE
+    ###########################
+
+    # z is inverse Polsby-Popper score for the district
+    m._z = m.addVar(name='z')
+
+    # objective is to minimize the inverse Polsby-Popper score
+    m.setObjective(m._z, GRB.MINIMIZE)
+
+    ###################################
+    # ADD POLSBY-POPPER CONSTRAINTS
+    ###################################
+
+    # A = area of the district
+    m._A = m.addVar(name='A')
+
+    # P = perimeter of the district
+    m._P = m.addVar(name='P')
+
+    # add SOCP constraint relating inverse Polsby-Popper score z to area and perimeter
+    m._ppConstr = m.addConstr(m._P * m._P <= 4 * math.pi * m._A * m._z)
+
+    # add constraint on area A
+    m.addConstr(arrays.node_weight @ m._xm == m._A)
+
+    # add constraint on perimeter P
+    m.addConstr(arrays.shared_perim @ m._ym + arrays.boundary_perim @ m._xm == m._P)
+
+    ###################################
+    # ADD DISTRICT AREA LOWER BOUND CONSTRAINT
+    ###################################
+
+    # the RHS is changed between the solves of a lower bound sweep (see mip_sweep)
+    m._areaConstr = m.addConstr(m._A >= area_lower_bound)
+
+    ###################################
+    # ADD DISTRICT SIZE CONSTRAINT
+    ###################################
+
+    if area_lower_bound <=0:
+        m.addConstr(m._xm.sum() >= 1)
+
+    return m
+
+
+def _build_single_district_mip_expressions(DG: nx.DiGraph, area_lower_bound: float = 0, env: gp.Env | None = None) -> gp.Model:
+    """
+    Builds the variables and constraints of the single district model with one expression per node/edge of DG.
+    """
+
+    ##################################
+    # CREATE MODEL AND MAIN VARIABLES
+    ##################################
+
+    m = gp.Model(env=env)
 
     # x[i] equals one when node i is selected in the district
     m._x = m.addVars(DG.nodes, name='x', vtype=GRB.BINARY)
@@ -62,7 +248,7 @@ def build_single_district_mip(DG : nx.DiGraph, root: int | None = None, area_low
     m._P = m.addVar(name='P')
 
     # add SOCP constraint relating inverse Polsby-Popper score z to area and perimeter
-    m.addConstr(m._P * m._P <= 4 * math.pi * m._A * m._z)
+    m._ppConstr = m.addConstr(m._P * m._P <= 4 * math.pi * m._A * m._z)
 
     # add constraint on area A
     m.addConstr(m._A == gp.quicksum(DG.nodes[i]['node_weight'] * m._x[i] for i in DG.nodes))
@@ -78,7 +264,7 @@ def build_single_district_mip(DG : nx.DiGraph, root: int | None = None, area_low
     # ADD DISTRICT AREA LOWER BOUND CONSTRAINT
     ###################################
 
-    m.addConstr(gp.quicksum(DG.nodes[i]['node_weight'] * m._x[i] for i in DG.nodes) >= area_lower_bound)
+    m._areaConstr = m.addConstr(gp.quicksum(DG.nodes[i]['node_weight'] * m._x[i] for i in DG.nodes) >= area_lower_bound)
 
     ###################################
     # ADD DISTRICT SIZE CONSTRAINT
@@ -87,28 +273,6 @@ def build_single_district_mip(DG : nx.DiGraph, root: int | None = None, area_low
     if area_lower_bound <=0:
         m.addConstr(gp.quicksum(m._x[i] for i in DG.nodes) >= 1)
 
-    ###################################
-    # ADD CONTIGUITY CONSTRAINTS
-    ###################################
-
-    m._callback = None
-    m._numCallbacks = 0
-    m._numLazyCuts = 0
-
-    m.Params.LazyConstraints = 1
-    m._DG = DG
-    m._root = root # TODO i dont know if its okay that we use root=None
-    m._callback = cut_callback
-
-    ###################################
-    # SOLVE PARAMETERS
-    ###################################
-
-    m.Params.MIPGap = 0.00
-    m.Params.FeasibilityTol = 1e-7
-    m.Params.IntFeasTol = 1e-7
-    m.update()
-
     return m
 
 
@@ -123,47 +287,105 @@ def cut_callback(m, where):
     """
 
 
-    if where == GRB.Callback.MIPSOL:
+    if where == GRB.Callback.MIP:
+        if m._telemetry is not None:
+            m._telemetry.record_progress(m.cbGet(GRB.Callback.RUNTIME), m.cbGet(GRB.Callback.MIP_OBJBST),
+                                         m.cbGet(GRB.Callback.MIP_OBJBND))
+
+    elif where == GRB.Callback.MIPSOL:
+        start = time.perf_counter()
         m._numCallbacks += 1
-        DG = m._DG
-        xval = m.cbGetSolution(m._x)
+        engine = m._contiguity
+        xvars = m._xvars
+        xval = np.fromiter(m.cbGetSolution(xvars), dtype=float, count=len(xvars))
 
         ##########################################
         # ADD CUT FOR COMPLEMENT
         ##########################################
 
         # vertices assigned to this district
-        S = [v for v in DG.nodes if xval[v] > 0.5]
-
-        # what shall we deem as the "root" of this district? call it b
-        b = m._root  # possibly None
-
-        # for each component that doesn't contain b, add a cut
-        for component in sorted(nx.strongly_connected_components(DG.subgraph(S)), key=len, reverse=True):
-
-            # what is the maximum population node in this component?
-            maxp = max(DG.nodes[v]['node_weight'] for v in component)
-            mpv = [v for v in component if DG.nodes[v]['node_weight'] == maxp][0]
-
-            # if no root 'b' has been selected yet, pick one
-            if b is None:
-                # find some vertex "b" that has largest population in this component
-                b = mpv
-
-            if b in component:
-                continue
-
-            # find some vertex "a" that has largest population in this component
-            a = mpv
-
-            # get minimal a,b-separator
-            C = find_fischetti_separator(DG, component, b)
+        S = np.flatnonzero(xval > 0.5)
 
+        # for each component that doesn't contain the root b (possibly None), add a cut
+        separator_time = engine.separator_time
+        cuts, num_components = engine.integer_separator_cuts(S, m._rootIndex)
+        m._separatorTime += engine.separator_time - separator_time
+        for a, b, C in cuts:
             # add lazy cut
-            m.cbLazy(m._x[a] + m._x[b] <= 1 + gp.quicksum(m._x[c] for c in C))
+            m.cbLazy(xvars[a] + xvars[b] <= 1 + gp.quicksum(xvars[c] for c in C.tolist()))
             m._numLazyCuts += 1
+            m._lazyCuts.append((a, b, C))
+
+        if m._firstIncumbentTime is None and num_components == 1:
+            # the first contiguous solution found
+            m._firstIncumbentTime = m.cbGet(GRB.Callback.RUNTIME)
+
+        m._callbackTime += time.perf_counter() - start
+
+    elif where == GRB.Callback.MIPNODE:
+        if m._telemetry is not None:
+            m._telemetry.record_root(m.cbGet(GRB.Callback.RUNTIME))
+        if not m._userCuts or m.cbGet(GRB.Callback.MIPNODE_STATUS) != GRB.OPTIMAL:
+            return
+
+        # limit the number of separation rounds per node
+        node = m.cbGet(GRB.Callback.MIPNODE_NODCNT)
+        if node != m._lastCutNode:
+            m._lastCutNode = node
+            m._cutRoundsAtNode = 0
+        if m._cutRoundsAtNode >= m._userCutRounds:
+            return
+        m._cutRoundsAtNode += 1
+
+        start = time.perf_counter()
+        add_fractional_separator_cuts(m)
+        elapsed = time.perf_counter() - start
+        m._userCutTime += elapsed
+        m._callbackTime += elapsed
 
     return
 
 
+def add_fractional_separator_cuts(m):
+    """
+    Separates violated a,b-separator inequalities x_a + x_b <= 1 + sum(x_c for c in C) from the fractional solution
+    at the current node and adds them as user cuts. b is the root (or the node with the largest x value),
+    a ranges over the nodes with the largest x values that are not adjacent to b.
 
+    :param m: Gurobi model object representing the districting problem.
+    :return: None
+    """
+    engine = m._contiguity
+    xvars = m._xvars
+    xval = np.fromiter(m.cbGetNodeRel(xvars), dtype=float, count=len(xvars))
+    tolerance = 1e-4
+
+    if m._rootIndex is not None:
+        b = m._rootIndex
+    else:
+        # node with the largest x value, ties broken by the largest weight
+        b = int(np.lexsort((engine.arrays.node_weight, xval))[-1])
+
+    # only nodes a with x_a + x_b - 1 > 0 can give a violated inequality, try the largest x values first
+    candidates = np.flatnonzero(xval + xval[b] - 1 > tolerance)
+    candidates = candidates[np.argsort(-xval[candidates], kind="stable")]
+
+    num_cuts = 0
+    for a in candidates.tolist():
+        if num_cuts >= m._userCutsPerRound:
+            break
+        if a == b or engine.is_adjacent(a, b):
+            continue
+
+        weight, C = engine.fractional_separator(xval, a, b)
+        if xval[a] + xval[b] - 1 - weight <= tolerance:
+            continue
+
+        key = (min(a, b), max(a, b), C.tobytes())
+        if key in m._cutPool:
+            continue
+        m._cutPool.add(key)
+
+        m.cbCut(xvars[a] + xvars[b] <= 1 + gp.quicksum(xvars[c] for c in C.tolist()))
+        m._numUserCuts += 1
+        num_cuts += 1
@@ -1,4 +1,11 @@
+import time
+
 import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import breadth_first_order, maximum_flow
+
+from graph_utils import GraphArrays
 
 """
 Code based on "Political districting to optimize the Polsby-Popper compactness score with application to  voting
@@ -29,4 +36,196 @@ def find_fischetti_separator(DG, component, b):
                         visited[j] = True
 
     C = [i for i in DG.nodes if neighbors_component[i] and visited[i]]
-    return C
\ No newline at end of file
+    return C
+
+
+# Fractional separation solves max-flow problems with integer capacities: x values are scaled by FLOW_SCALE and
+# arcs without a capacity get FLOW_INFINITY
+FLOW_SCALE = 10000
+FLOW_INFINITY = 2 ** 30
+
+
+class ContiguityEngine:
+    """
+    Finds the components of a selected node set and minimal a,b-separators (like find_fischetti_separator) on the
+    CSR adjacency of the graph arrays. Everything that only depends on the graph is precomputed once per model, so
+    the contiguity callback does not touch networkx at all. All nodes are given as indices into the graph arrays.
+    """
+
+    def __init__(self, arrays: GraphArrays):
+        self.arrays = arrays
+        self.num_nodes = arrays.num_nodes
+        self.index = {fid: i for i, fid in enumerate(arrays.fids.tolist())}
+
+        # int32 CSR arrays (scipy.sparse.csgraph would convert int64 arrays on every call)
+        self._indptr = arrays.indptr.astype(np.int32)
+        self._indices = arrays.indices.astype(np.int32)
+        self._tails = arrays.arc_tails()
+        self._degrees = np.diff(self._indptr)
+        self._reachable_indptr = np.zeros(self.num_nodes + 1, dtype=np.int32)
+        self._adjacency_lists = [self._indices[self._indptr[i]:self._indptr[i + 1]].tolist()
+                                 for i in range(self.num_nodes)]
+
+        # Preallocated node marks. Instead of clearing the marks after every search, the stamp is increased.
+        self._mark = [0] * self.num_nodes
+        self._stamp = 0
+
+        # Preallocated node masks, reset after every use
+        self._in_component = np.zeros(self.num_nodes, dtype=bool)
+        self._neighbors_component = np.zeros(self.num_nodes, dtype=bool)
+
+        # Split graph for fractional separation, built on first use (see fractional_separator)
+        self._split_graph = None
+
+        # Total time spent in separator (seconds)
+        self.separator_time = 0.0
+
+    def components(self, selected: np.ndarray) -> list[np.ndarray]:
+        """
+        Connected components of the subgraph induced by the selected nodes, largest component first.
+        Selected node sets (districts) are small compared to the graph, so the components are found with a plain
+        search over the adjacency lists that only touches the selected nodes and their neighbors.
+        :param selected: Array of selected node indices.
+        :return: A list of node index arrays.
+        """
+        adjacency_lists, mark = self._adjacency_lists, self._mark
+
+        # mark[v] == selected_stamp: v is selected but not visited yet, mark[v] == visited_stamp: v was visited
+        self._stamp += 2
+        selected_stamp, visited_stamp = self._stamp - 1, self._stamp
+        selected = selected.tolist()
+        for v in selected:
+            mark[v] = selected_stamp
+
+        components = []
+        for s in selected:
+            if mark[s] != selected_stamp:
+                continue
+            mark[s] = visited_stamp
+            component = [s]
+            stack = [s]
+            while stack:
+                for v in adjacency_lists[stack.pop()]:
+                    if mark[v] == selected_stamp:
+                        mark[v] = visited_stamp
+                        component.append(v)
+                        stack.append(v)
+            components.append(np.array(component, dtype=np.int64))
+
+        components.sort(key=len, reverse=True)
+        return components
+
+    def neighbors(self, nodes: np.ndarray) -> np.ndarray:
+        """All neighbors of the given nodes (with repetitions, possibly including the nodes themselves)."""
+        starts, ends = self._indptr[nodes], self._indptr[nodes + 1]
+        lengths = ends - starts
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return self._indices[offsets]
+
+    def separator(self, component: np.ndarray, b: int) -> np.ndarray:
+        """
+        Minimal a,b-separator for any node a of the component (Fischetti, et al. (2017)): the neighbors of the
+        component that can be reached from b without passing through other neighbors of the component.
+        :param component: Node indices of a component that does not contain b.
+        :param b: Index of the root node.
+        :return: Array of node indices of the separator.
+        """
+        in_component, neighbors_component = self._in_component, self._neighbors_component
+
+        # Neighbors of the component that are not in the component themselves
+        in_component[component] = True
+        neighbors = self.neighbors(component)
+        neighbors = neighbors[~in_component[neighbors]]
+        neighbors_component[neighbors] = True
+        in_component[component] = False
+
+        # Search from b, but do not leave the neighbors of the component (their rows are emptied)
+        expand = ~neighbors_component
+        reachable_indptr = self._reachable_indptr
+        np.cumsum(self._degrees * expand, out=reachable_indptr[1:])
+        reachable_indices = self._indices[expand[self._tails]]
+        reachable_graph = sp.csr_matrix((np.ones(len(reachable_indices), dtype=np.int8), reachable_indices,
+                                         reachable_indptr), shape=(self.num_nodes, self.num_nodes))
+        visited = breadth_first_order(reachable_graph, b, directed=True, return_predecessors=False)
+
+        C = visited[neighbors_component[visited]]
+        neighbors_component[neighbors] = False
+        return np.sort(C)
+
+    def integer_separator_cuts(self, selected: np.ndarray, b: int | None = None) \
+            -> tuple[list[tuple[int, int, np.ndarray]], int]:
+        """
+        a,b-separator inequalities x_a + x_b <= 1 + sum(x_c for c in C) violated by an integer solution: one for
+        every component of the selected nodes that does not contain b, with a the node of the component with the
+        largest weight and C a minimal a,b-separator.
+        :param selected: Array of selected node indices.
+        :param b: Index of the root node. If None, the node with the largest weight of the largest component is used.
+        :return: A tuple of the list of cuts (a, b, C) and the number of components of the selected nodes.
+        """
+        node_weight = self.arrays.node_weight
+        components = self.components(selected)
+        cuts = []
+        for component in components:
+            # the maximum weight node of this component
+            mpv = int(component[np.argmax(node_weight[component])])
+
+            # if no root 'b' has been selected yet, pick one
+            if b is None:
+                b = mpv
+
+            if b in component:
+                continue
+
+            # get minimal a,b-separator
+            separator_start = time.perf_counter()
+            C = self.separator(component, b)
+            self.separator_time += time.perf_counter() - separator_start
+            cuts.append((mpv, b, C))
+
+        return cuts, len(components)
+
+    def _build_split_graph(self):
+        """
+        Builds the split graph used for fractional separation: every node v becomes an arc from v_in = v to
+        v_out = v + n (capacity x_v), every arc (u, v) becomes an arc from u_out to v_in (infinite capacity).
+        Rows 0..n-1 of the CSR hold exactly the n node arcs, so only data[:n] changes between max-flow problems.
+        """
+        n = self.num_nodes
+        indptr = np.concatenate((np.arange(n + 1, dtype=np.int32), n + self._indptr[1:]))
+        indices = np.concatenate((np.arange(n, 2 * n, dtype=np.int32), self._indices))
+        data = np.full(len(indices), FLOW_INFINITY, dtype=np.int32)
+        self._split_graph = (indptr, indices, data)
+
+    def fractional_separator(self, xval: np.ndarray, a: int, b: int) -> tuple[float, np.ndarray]:
+        """
+        Minimum weight a,b-separator for fractional x values, found with a max-flow/min-cut on the split graph.
+        The a,b-separator inequality x_a + x_b <= 1 + sum(x_c for c in C) is violated by xval if the returned
+        weight is smaller than xval[a] + xval[b] - 1.
+        :param xval: x values of all nodes (in array order).
+        :param a: Index of the first node, must not be adjacent to b.
+        :param b: Index of the second node.
+        :return: A tuple of the weight of the separator (in x values) and the array of its node indices.
+        """
+        if self._split_graph is None:
+            self._build_split_graph()
+        indptr, indices, data = self._split_graph
+        n = self.num_nodes
+
+        data[:n] = np.rint(np.clip(xval, 0, 1) * FLOW_SCALE)
+        split_graph = sp.csr_matrix((data, indices, indptr), shape=(2 * n, 2 * n))
+        result = maximum_flow(split_graph, a + n, b)
+
+        # Nodes on the source side of the minimum cut: search the residual graph from a_out
+        residual = split_graph - result.flow
+        residual.data = (residual.data > 0).astype(np.int8)
+        residual.eliminate_zeros()
+        source_side = np.zeros(2 * n, dtype=bool)
+        source_side[breadth_first_order(residual, a + n, directed=True, return_predecessors=False)] = True
+
+        # The separator consists of the nodes whose split arc is cut
+        C = np.flatnonzero(source_side[:n] & ~source_side[n:])
+        return result.flow_value / FLOW_SCALE, C
+
+    def is_adjacent(self, u: int, v: int) -> bool:
+        """True if the nodes u and v are adjacent."""
+        return v in self._adjacency_lists[u]
@@ -0,0 +1,170 @@
+import math
+import time
+
+import numpy as np
+
+from graph_utils import GraphArrays
+
+"""
+Primal heuristic for the single district problem: greedy region growing from seeds with a large node weight,
+followed by a local search with add/remove moves that keep the district contiguous. The district is used as a MIP
+start for Gurobi.
+"""
+
+
+def inverse_polsby_popper(area: float, perimeter: float) -> float:
+    """Inverse Polsby-Popper score P^2 / (4 pi A) of a district (infinity for an empty district)."""
+    return perimeter * perimeter / (4 * math.pi * area) if area > 0 else math.inf
+
+
+class _DistrictState:
+    """
+    Node set of a district together with its area and perimeter, updated in O(deg(v)) per added or removed node.
+    """
+
+    def __init__(self, arrays: GraphArrays, adjacency: list[list[int]], shared: list[list[float]]):
+        self.weight = arrays.node_weight.tolist()
+        self.boundary_perim = arrays.boundary_perim.tolist()
+        self.adjacency = adjacency
+        self.shared = shared
+        self.nodes = set()
+        self.area = 0.0
+        self.perimeter = 0.0
+
+    def perimeter_change(self, v: int) -> float:
+        """Change of the perimeter when v is added to (or, with flipped sign, removed from) the district."""
+        change = self.boundary_perim[v]
+        nodes = self.nodes
+        for u, s in zip(self.adjacency[v], self.shared[v]):
+            change += -s if u in nodes else s
+        return change
+
+    def objective_after_add(self, v: int) -> float:
+        return inverse_polsby_popper(self.area + self.weight[v], self.perimeter + self.perimeter_change(v))
+
+    def objective_after_remove(self, v: int) -> float:
+        # the edges of v to the other district nodes become boundary, the rest of v's boundary disappears
+        self.nodes.discard(v)
+        change = self.perimeter_change(v)
+        self.nodes.add(v)
+        return inverse_polsby_popper(self.area - self.weight[v], self.perimeter - change)
+
+    def add(self, v: int):
+        self.perimeter += self.perimeter_change(v)
+        self.area += self.weight[v]
+        self.nodes.add(v)
+
+    def remove(self, v: int):
+        self.nodes.discard(v)
+        self.perimeter -= self.perimeter_change(v)
+        self.area -= self.weight[v]
+
+    def objective(self) -> float:
+        return inverse_polsby_popper(self.area, self.perimeter)
+
+    def frontier(self) -> set[int]:
+        """Nodes outside the district that are adjacent to it."""
+        nodes = self.nodes
+        return {u for v in nodes for u in self.adjacency[v] if u not in nodes}
+
+    def stays_contiguous_without(self, v: int) -> bool:
+        """True if the district without v is still connected (and not empty)."""
+        nodes = self.nodes
+        neighbors = [u for u in self.adjacency[v] if u in nodes]
+        if not neighbors:
+            return False
+        seen = {v, neighbors[0]}
+        stack = [neighbors[0]]
+        while stack:
+            for u in self.adjacency[stack.pop()]:
+                if u in nodes and u not in seen:
+                    seen.add(u)
+                    stack.append(u)
+        return len(seen) == len(nodes)
+
+
+def _adjacency_lists(arrays: GraphArrays) -> tuple[list[list[int]], list[list[float]]]:
+    """Neighbors and shared perimeters of every node as python lists."""
+    indptr = arrays.indptr.tolist()
+    indices = arrays.indices.tolist()
+    shared_perim = arrays.shared_perim.tolist()
+    return ([indices[indptr[i]:indptr[i + 1]] for i in range(arrays.num_nodes)],
+            [shared_perim[indptr[i]:indptr[i + 1]] for i in range(arrays.num_nodes)])
+
+
+def grow_district(state: _DistrictState, seed: int, area_lower_bound: float = 0) -> bool:
+    """
+    Greedy region growing: starting from the seed, repeatedly add the neighboring node that gives the best inverse
+    Polsby-Popper score. Nodes are added until the area lower bound is reached, afterwards only while the score
+    improves.
+    :return: True if the area lower bound was reached.
+    """
+    state.add(seed)
+    frontier = set(state.adjacency[seed])
+    while frontier:
+        v = min(frontier, key=state.objective_after_add)
+        if state.area >= area_lower_bound and state.objective_after_add(v) >= state.objective():
+            break
+        state.add(v)
+        frontier.discard(v)
+        frontier.update(u for u in state.adjacency[v] if u not in state.nodes)
+    return state.area >= area_lower_bound
+
+
+def improve_district(state: _DistrictState, area_lower_bound: float = 0, max_moves: int = 1000) -> int:
+    """
+    Local search with add/remove moves: apply the best improving move (adding a neighboring node or removing a node
+    whose removal keeps the district contiguous and above the area lower bound) until no move improves the score.
+    :return: The number of moves made.
+    """
+    for move in range(max_moves):
+        objective = state.objective()
+        best_objective, best_move = objective - 1e-12, None
+
+        for v in state.frontier():
+            candidate = state.objective_after_add(v)
+            if candidate < best_objective:
+                best_objective, best_move = candidate, (state.add, v)
+
+        if len(state.nodes) > 1:
+            for v in list(state.nodes):
+                if state.area - state.weight[v] < area_lower_bound:
+                    continue
+                candidate = state.objective_after_remove(v)
+                if candidate < best_objective and state.stays_contiguous_without(v):
+                    best_objective, best_move = candidate, (state.remove, v)
+
+        if best_move is None:
+            return move
+        apply, v = best_move
+        apply(v)
+    return max_moves
+
+
+def find_warm_start(arrays: GraphArrays, area_lower_bound: float = 0, num_seeds: int = 10) -> dict | None:
+    """
+    Runs the heuristic from the num_seeds nodes with the largest node weight and returns the best district.
+
+    :param arrays: The graph as GraphArrays
+    :param area_lower_bound: Lower bound for the area of the district.
+    :param num_seeds: Number of seeds to grow districts from.
+    :return: A dict with the node indices ('nodes'), 'objective', 'area', 'perimeter' and 'time' of the best district,
+             or None if no district reached the area lower bound.
+    """
+    start = time.time()
+    adjacency, shared = _adjacency_lists(arrays)
+    seeds = np.argsort(-arrays.node_weight, kind="stable")[:num_seeds].tolist()
+
+    best = None
+    for seed in seeds:
+        state = _DistrictState(arrays, adjacency, shared)
+        if not grow_district(state, seed, area_lower_bound):
+            continue
+        improve_district(state, area_lower_bound)
+        if best is None or state.objective() < best['objective']:
+            best = {'nodes': np.array(sorted(state.nodes), dtype=np.int64), 'objective': state.objective(),
+                    'area': state.area, 'perimeter': state.perimeter}
+
+    if best is not None:
+        best['time'] = time.time() - start
+    return best
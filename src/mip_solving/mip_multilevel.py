@@ -0,0 +1,276 @@
+import argparse
+import json
+import os
+import time
+
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+from graph_utils import (GraphArrays, adjacency_matrix, get_graph_arrays, graph_from_arrays, read_graph_from_dataset,
+                         subgraph_arrays)
+from mip_backends import BACKENDS, district_area_perimeter, get_backend, solve_with_backend
+from mip_heuristic import inverse_polsby_popper
+from solution_io import district_indices, save_solution_summary
+
+"""
+Multilevel solve of the single district problem for regions too large for the monolithic MIP. The graph is coarsened
+repeatedly by merging pairs of neighboring faces (the pair with the longest shared perimeter first): areas and
+boundary perimeters are summed, the perimeter shared by the pair disappears. The single district problem is solved
+exactly on the coarsest graph and the district is projected back level by level, which keeps its area and perimeter.
+On every level the district is refined by re-solving the problem on a band of faces around its boundary, with the
+faces inside the district but away from the band fixed to the district (contracted into one node that is the root of
+the model) and the faces outside removed. The projected district is the start solution of the refinement, so a
+refinement never makes it worse.
+"""
+
+
+def contract_arrays(arrays: GraphArrays, labels: np.ndarray) -> GraphArrays:
+    """
+    GraphArrays of the graph in which the nodes with the same label are merged into one node (label i becomes node
+    i). Areas, boundary perimeters and the perimeters shared with other merged nodes are summed, the perimeter shared
+    within a merged node is dropped. A merged node is identified by the FID of its first member (see district_indices).
+    """
+    num_nodes = int(labels.max()) + 1 if len(labels) > 0 else 0
+    tails, heads = labels[arrays.arc_tails()], labels[arrays.indices]
+    external = tails != heads
+    shared = sp.csr_matrix((arrays.shared_perim[external], (tails[external], heads[external])),
+                           shape=(num_nodes, num_nodes))
+    shared.sum_duplicates()
+    shared.sort_indices()
+    first = np.full(num_nodes, arrays.num_nodes, dtype=np.int64)
+    np.minimum.at(first, labels, np.arange(arrays.num_nodes))
+    return GraphArrays(fids=arrays.fids[first],
+                       node_weight=np.bincount(labels, weights=arrays.node_weight, minlength=num_nodes),
+                       boundary_node=np.bincount(labels, weights=arrays.boundary_node, minlength=num_nodes) > 0,
+                       boundary_perim=np.bincount(labels, weights=arrays.boundary_perim, minlength=num_nodes),
+                       indptr=shared.indptr.astype(np.int64), indices=shared.indices.astype(np.int64),
+                       shared_perim=shared.data.astype(float))
+
+
+def match_neighbors(arrays: GraphArrays, max_area: float = np.inf) -> np.ndarray:
+    """
+    Heavy edge matching: the nodes are visited from the smallest to the largest area, an unmatched node is merged
+    with the unmatched neighbor it shares the longest perimeter with (if the merged area stays at most max_area).
+    :return: Label (index of the merged node) of every node.
+    """
+    weight = arrays.node_weight.tolist()
+    indptr, indices, shared_perim = arrays.indptr.tolist(), arrays.indices.tolist(), arrays.shared_perim.tolist()
+    labels = [-1] * arrays.num_nodes
+    num_labels = 0
+    for v in np.argsort(arrays.node_weight, kind="stable").tolist():
+        if labels[v] >= 0:
+            continue
+        best, best_shared = -1, 0.0
+        for k in range(indptr[v], indptr[v + 1]):
+            u = indices[k]
+            if labels[u] < 0 and shared_perim[k] > best_shared and weight[u] + weight[v] <= max_area:
+                best, best_shared = u, shared_perim[k]
+        labels[v] = num_labels
+        if best >= 0:
+            labels[best] = num_labels
+        num_labels += 1
+    return np.array(labels, dtype=np.int64)
+
+
+def coarsen(arrays: GraphArrays, coarse_size: int = 2000, max_area: float = np.inf, min_shrink: float = 0.05,
+            max_levels: int = 30) -> tuple[list[GraphArrays], list[np.ndarray]]:
+    """
+    Coarsens the graph until it has at most coarse_size nodes or a level shrinks it by less than min_shrink.
+    :return: The graphs of all levels (level 0 is the given graph) and, for every level but the coarsest, the label
+             of every node in the next coarser level.
+    """
+    levels, labels = [arrays], []
+    while levels[-1].num_nodes > coarse_size and len(levels) <= max_levels:
+        level_labels = match_neighbors(levels[-1], max_area)
+        coarse = contract_arrays(levels[-1], level_labels)
+        if coarse.num_nodes > (1 - min_shrink) * levels[-1].num_nodes:
+            break
+        levels.append(coarse)
+        labels.append(level_labels)
+    return levels, labels
+
+
+def boundary_band(arrays: GraphArrays, district: np.ndarray, radius: int = 2) -> np.ndarray:
+    """Nodes at most radius - 1 arcs away from an arc that crosses the district boundary (boolean mask)."""
+    tails = arrays.arc_tails()
+    band = np.zeros(arrays.num_nodes, dtype=bool)
+    band[tails[district[tails] != district[arrays.indices]]] = True
+    adjacency = adjacency_matrix(arrays)
+    for _ in range(radius - 1):
+        band |= (adjacency @ band.astype(np.int8)) > 0
+    return band
+
+
+def refine_district(arrays: GraphArrays, district: np.ndarray, area_lower_bound: float = 0, radius: int = 2,
+                    backend: str = "gurobi", time_limit: float = 600, threads: int = 1) -> tuple[np.ndarray, dict]:
+    """
+    Re-solves the single district problem on the band of nodes around the district boundary (see boundary_band).
+    District nodes outside the band are fixed: their largest connected part is contracted into the root node of the
+    model (smaller parts are added to the band, so the fixed part is connected), nodes outside both are removed.
+    :param district: Boolean mask of a contiguous district reaching the area lower bound.
+    :return: The refined district (boolean mask, the given one if the solve does not improve it) and the statistics
+             of the restricted problem.
+    """
+    band = boundary_band(arrays, district, radius)
+    core = district & ~band
+    if core.any():
+        core_arrays = subgraph_arrays(arrays, core)
+        num_components, component = connected_components(adjacency_matrix(core_arrays), directed=False)
+        if num_components > 1:
+            largest = np.argmax(np.bincount(component, weights=core_arrays.node_weight))
+            moved = np.flatnonzero(core)[component != largest]
+            core[moved] = False
+            band[moved] = True
+
+    keep = core | band
+    kept_nodes = np.flatnonzero(keep)
+    sub = subgraph_arrays(arrays, keep)
+    sub_core = core[keep]
+    labels = np.zeros(sub.num_nodes, dtype=np.int64)
+    labels[~sub_core] = np.arange(int((~sub_core).sum())) + (1 if sub_core.any() else 0)
+    restricted = contract_arrays(sub, labels)
+    root = int(restricted.fids[0]) if sub_core.any() else None
+
+    start = time.perf_counter()
+    solver = get_backend(backend, verbose=False)
+    solver.build(graph_from_arrays(restricted), area_lower_bound, root=root)
+    solver.set_start(np.unique(labels[district[keep]]))
+    solver.optimize(time_limit=time_limit, threads=threads)
+    result = solver.result()
+
+    area, perimeter = district_area_perimeter(arrays, np.flatnonzero(district))
+    objective = inverse_polsby_popper(area, perimeter)
+    stats = {'free_nodes': int(band.sum()), 'restricted_nodes': restricted.num_nodes, 'status': result.status,
+             'bound': result.bound, 'time': time.perf_counter() - start}
+    if result.solution is None or result.objective >= objective - 1e-9:
+        return district, stats
+
+    refined = np.zeros(arrays.num_nodes, dtype=bool)
+    refined[kept_nodes] = np.isin(restricted.fids, result.solution)[labels]
+    return refined, stats
+
+
+def solve_multilevel(DG: nx.DiGraph, area_lower_bound: float = 0, coarse_size: int = 2000, radius: int = 2,
+                     passes: int = 2, backend: str = "gurobi", time_limit: float = 600, threads: int = 1,
+                     max_area: float | None = None) -> dict:
+    """
+    Coarsen-solve-refine (see the module docstring).
+    :param DG: Directed graph representing the districting problem (see build_single_district_mip).
+    :param area_lower_bound: Lower bound for the area of the district.
+    :param coarse_size: Coarsen until the graph has at most this many nodes.
+    :param radius: Radius (in arcs) of the band around the district boundary that is re-solved on every level.
+    :param passes: Maximum number of refinements per level (a level stops early when a refinement does not change
+                   the district).
+    :param backend: Solver backend of the coarse solve and the refinements (see mip_backends).
+    :param time_limit: Time limit of the coarse solve and of every refinement.
+    :param max_area: Largest area of a merged node (default: the area lower bound divided by 8, unbounded for 0).
+    :return: Dict with the district ('solution', FIDs), objective, area, perimeter, status and the report of every
+             level ('levels', from the coarsest to the original graph).
+    """
+    start = time.perf_counter()
+    arrays = get_graph_arrays(DG)
+    if max_area is None:
+        max_area = area_lower_bound / 8 if area_lower_bound > 0 else np.inf
+    levels, labels = coarsen(arrays, coarse_size, max_area)
+    print(f"Multilevel: {len(levels)} levels, {' -> '.join(str(level.num_nodes) for level in levels)} nodes "
+          f"({time.perf_counter() - start:.2f}s)")
+
+    coarsest = levels[-1]
+    result = solve_with_backend(graph_from_arrays(coarsest), area_lower_bound, backend, threads, time_limit)
+    if result.solution is None:
+        print(f"No district on the coarsest level (status {result.status}).")
+        return {'solution': None, 'status': result.status, 'levels': []}
+    district = np.zeros(coarsest.num_nodes, dtype=bool)
+    district[district_indices(coarsest.fids, np.asarray(result.solution))] = True
+
+    report = [{'level': len(levels) - 1, 'nodes': coarsest.num_nodes, 'arcs': coarsest.num_arcs,
+               'free_nodes': coarsest.num_nodes, 'objective': result.objective, 'bound': result.bound,
+               'status': result.status, 'time': result.runtime, 'elapsed': time.perf_counter() - start}]
+    status = result.status
+    for level in range(len(levels) - 2, -1, -1):
+        level_start = time.perf_counter()
+        district = district[labels[level]]
+        free_nodes, level_status = 0, status
+        for _ in range(passes):
+            refined, stats = refine_district(levels[level], district, area_lower_bound, radius, backend, time_limit,
+                                             threads)
+            free_nodes, level_status = max(free_nodes, stats['free_nodes']), stats['status']
+            changed = not np.array_equal(refined, district)
+            district = refined
+            if not changed:
+                break
+        area, perimeter = district_area_perimeter(levels[level], np.flatnonzero(district))
+        report.append({'level': level, 'nodes': levels[level].num_nodes, 'arcs': levels[level].num_arcs,
+                       'free_nodes': free_nodes, 'objective': inverse_polsby_popper(area, perimeter), 'bound': None,
+                       'status': level_status, 'time': time.perf_counter() - level_start,
+                       'elapsed': time.perf_counter() - start})
+        print(f"Level {level}: {levels[level].num_nodes} nodes, {free_nodes} free, objective "
+              f"{report[-1]['objective']:.4f}, {report[-1]['time']:.2f}s")
+        status = level_status
+
+    area, perimeter = district_area_perimeter(arrays, np.flatnonzero(district))
+    return {'solution': arrays.fids[district].tolist(), 'objective': inverse_polsby_popper(area, perimeter),
+            'area': area, 'perimeter': perimeter, 'status': status, 'levels': report}
+
+
+def compare_with_monolithic(DG: nx.DiGraph, multilevel: dict, area_lower_bound: float = 0, backend: str = "gurobi",
+                            time_limit: float = 3600, threads: int = 1) -> dict:
+    """
+    Solves the monolithic problem (solve_with_backend) and adds the gap of every level to its objective ('gap', the
+    relative difference of the inverse Polsby-Popper scores) and the ratio of the times ('speedup').
+    :return: The objective, bound, status and time of the monolithic solve.
+    """
+    start = time.perf_counter()
+    result = solve_with_backend(DG, area_lower_bound, backend, threads, time_limit)
+    monolithic = {'objective': result.objective if result.solution is not None else None, 'bound': result.bound,
+                  'status': result.status, 'time': time.perf_counter() - start}
+    for level in multilevel['levels']:
+        level['gap'] = (level['objective'] / monolithic['objective'] - 1) if monolithic['objective'] else None
+        level['speedup'] = monolithic['time'] / level['elapsed'] if level['elapsed'] > 0 else None
+    return monolithic
+
+
+def print_level_report(multilevel: dict, monolithic: dict | None = None) -> None:
+    print(f"{'level':>6}{'nodes':>10}{'free':>10}{'objective':>12}{'time':>10}{'elapsed':>10}"
+          + (f"{'gap':>10}{'speedup':>9}" if monolithic else ""))
+    for level in multilevel['levels']:
+        line = (f"{level['level']:>6}{level['nodes']:>10}{level['free_nodes']:>10}{level['objective']:>12.4f}"
+                f"{level['time']:>9.2f}s{level['elapsed']:>9.2f}s")
+        if monolithic and level.get('gap') is not None:
+            line += f"{level['gap']:>9.2%}{level['speedup']:>8.2f}x"
+        print(line)
+    if monolithic:
+        objective = f"{monolithic['objective']:.4f}" if monolithic['objective'] is not None else "-"
+        print(f"{'mono':>6}{'':>20}{objective:>12}{monolithic['time']:>9.2f}s  status {monolithic['status']}, "
+              f"bound {monolithic['bound']:.4f}")
+
+
+parser = argparse.ArgumentParser(description="Solve the single district problem with coarsen-solve-refine")
+parser.add_argument('dataset', help='Name of the dataset (e.g. rheinruhr)')
+parser.add_argument('-l', '--lower-bound', type=float, default=0, help='Area lower bound')
+parser.add_argument('--coarse-size', type=int, default=2000, help='Coarsen until the graph has at most this many nodes')
+parser.add_argument('--radius', type=int, default=2, help='Radius of the band re-solved on every level')
+parser.add_argument('--passes', type=int, default=2, help='Maximum number of refinements per level')
+parser.add_argument('--backend', choices=list(BACKENDS), default='gurobi', help='Solver backend')
+parser.add_argument('-t', '--threads', type=int, default=1, help='Number of solver threads')
+parser.add_argument('--time-limit', type=float, default=600, help='Time limit of every solve')
+parser.add_argument('--compare', action='store_true', help='Also solve the monolithic problem and report the gaps')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    graph = read_graph_from_dataset(args.dataset)
+    solved = solve_multilevel(graph, args.lower_bound, args.coarse_size, args.radius, args.passes, args.backend,
+                              args.time_limit, args.threads)
+    if solved['solution'] is not None:
+        reference = compare_with_monolithic(graph, solved, args.lower_bound, args.backend, args.time_limit,
+                                            args.threads) if args.compare else None
+        print_level_report(solved, reference)
+        suffix = f"{'_LB=' + str(args.lower_bound) if args.lower_bound > 0 else ''}_multilevel"
+        save_solution_summary(solved['solution'], solved['objective'], solved['area'], solved['perimeter'],
+                              solved['status'], args.dataset, suffix)
+        report_path = os.path.join("data", "solutions", f"{args.dataset}{suffix}",
+                                   f"{args.dataset}{suffix}_levels.json")
+        with open(report_path, "w") as file:
+            json.dump({'levels': solved['levels'], 'monolithic': reference}, file, indent=2)
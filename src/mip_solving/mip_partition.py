@@ -0,0 +1,412 @@
+import argparse
+import math
+import time
+from multiprocessing import Pool, cpu_count
+
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components, shortest_path
+
+from graph_utils import (GraphArrays, adjacency_matrix, get_graph_arrays, graph_from_arrays, read_graph_from_dataset,
+                         subgraph_arrays)
+from mip_backends import BACKENDS, district_area_perimeter, get_backend
+from mip_contiguity import ContiguityEngine
+from solution_io import write_solution
+
+"""
+Partitioning a whole region into k contiguous districts of balanced area, maximizing the compactness of the districts.
+Two engines are available:
+    monolithic  one MISOCP with x[j, i], y[j, u, v], A[j], P[j] and z[j] for every district j, the SOC constraints
+                P[j]^2 <= 4 pi A[j] z[j] of the single district model and lazy a,b-separator cuts per district. Every
+                district has a fixed root node, which breaks the symmetry between the districts.
+    carving     the districts are carved one at a time: in every step, the rooted single district problem (with the
+                area bounds of a district) is solved for several candidate roots on the boundary of the remaining
+                region in a worker pool, and the best district that leaves the remaining region contiguous is kept.
+                This scales to regions like rheinruhr, where the monolithic model is too large, and its partition can
+                be used as start of the monolithic model.
+The objective is 'total' (minimize the sum of the inverse Polsby-Popper scores z[j]) or 'min' (minimize the largest
+z[j], i.e., maximize the minimum Polsby-Popper score).
+"""
+
+OBJECTIVES = ("total", "min")
+
+
+def area_bounds(arrays: GraphArrays, k: int, area_tolerance: float) -> tuple[float, float]:
+    """Lower and upper bound on the area of every district: the average area +- area_tolerance (relative)."""
+    average = float(arrays.node_weight.sum()) / k
+    return (1 - area_tolerance) * average, (1 + area_tolerance) * average
+
+
+def spread_roots(arrays: GraphArrays, k: int, candidates: np.ndarray | None = None) -> np.ndarray:
+    """
+    k candidate nodes that are far apart (farthest point sampling by number of hops), starting with the candidate
+    with the largest weight.
+    :param candidates: Boolean mask of the allowed nodes (all nodes if None or empty).
+    :return: Node indices of the roots.
+    """
+    if candidates is None or not candidates.any():
+        candidates = np.ones(arrays.num_nodes, dtype=bool)
+    allowed = np.flatnonzero(candidates)
+    k = min(k, len(allowed))
+    adjacency = adjacency_matrix(arrays)
+    roots = [int(allowed[np.argmax(arrays.node_weight[allowed])])]
+    distance = np.full(arrays.num_nodes, np.inf)
+    while len(roots) < k:
+        distance = np.minimum(distance, shortest_path(adjacency, unweighted=True, indices=roots[-1]))
+        distance[roots] = -1
+        # unreachable nodes (other components) first, ties broken by the largest weight
+        order = np.lexsort((arrays.node_weight[allowed], distance[allowed]))
+        roots.append(int(allowed[order[-1]]))
+    return np.array(roots, dtype=np.int64)
+
+
+def district_scores(arrays: GraphArrays, labels: np.ndarray, k: int) -> list[dict]:
+    """Area, perimeter and inverse Polsby-Popper score of every district of a partition (labels 0..k-1)."""
+    districts = []
+    for j in range(k):
+        nodes = np.flatnonzero(labels == j)
+        area, perimeter = district_area_perimeter(arrays, nodes)
+        districts.append({'district': j, 'size': len(nodes), 'area': area, 'perimeter': perimeter,
+                          'objective': perimeter * perimeter / (4 * math.pi * area) if area > 0 else math.inf})
+    return districts
+
+
+####################################
+# MONOLITHIC MODEL
+####################################
+
+def build_partition_mip(DG: nx.DiGraph, k: int, roots: list[int], area_lower_bound: float, area_upper_bound: float,
+                        objective: str = "total", env=None):
+    """
+    Builds the k district MISOCP with the matrix API: the single district model (see build_single_district_mip) for
+    every district, plus the assignment of every node to exactly one district.
+    :param DG: Directed graph of the region (see build_single_district_mip).
+    :param k: Number of districts.
+    :param roots: FID of the root of every district, x[j, roots[j]] is fixed to one.
+    :param area_lower_bound: Lower bound for the area of every district.
+    :param area_upper_bound: Upper bound for the area of every district.
+    :param objective: 'total' or 'min' (see OBJECTIVES).
+    :param env: Optional Gurobi environment.
+    :return: The Gurobi model, with the contiguity callback in m._callback.
+    """
+    import gurobipy as gp
+    from gurobipy import GRB
+
+    if objective not in OBJECTIVES:
+        raise ValueError(f"Unknown objective '{objective}', expected one of {', '.join(OBJECTIVES)}.")
+
+    start = time.time()
+    arrays = get_graph_arrays(DG)
+    n, num_arcs = arrays.num_nodes, arrays.num_arcs
+    tails, heads = arrays.arc_tails(), arrays.indices
+
+    m = gp.Model(env=env)
+
+    # x[j, i] equals one when node i is in district j, y[j, a] when arc a is cut by district j
+    m._xm = m.addMVar((k, n), vtype=GRB.BINARY, name="x")
+    m._ym = m.addMVar((k, num_arcs), vtype=GRB.BINARY, name="y")
+    m._A = m.addMVar(k, lb=area_lower_bound, ub=area_upper_bound, name="A")
+    m._P = m.addMVar(k, name="P")
+    m._z = m.addMVar(k, name="z")
+
+    # every node is in exactly one district
+    m.addConstr(m._xm.sum(axis=0) == 1, name="assign")
+
+    arc_range = np.arange(num_arcs)
+    incidence = sp.csr_matrix((np.concatenate((np.ones(num_arcs), -np.ones(num_arcs))),
+                               (np.concatenate((arc_range, arc_range)), np.concatenate((tails, heads)))),
+                              shape=(num_arcs, n))
+    for j in range(k):
+        # arc (u,v) is cut by district j if u (but not v) is in it, then area, perimeter and the SOC constraint
+        m.addConstr(incidence @ m._xm[j] - m._ym[j] <= 0, name=f"cut[{j}]")
+        m.addConstr(arrays.node_weight @ m._xm[j] == m._A[j], name=f"area[{j}]")
+        m.addConstr(arrays.shared_perim @ m._ym[j] + arrays.boundary_perim @ m._xm[j] == m._P[j],
+                    name=f"perimeter[{j}]")
+        P, A, z = m._P[j].item(), m._A[j].item(), m._z[j].item()
+        m.addConstr(P * P <= 4 * math.pi * A * z, name=f"pp[{j}]")
+
+    if objective == "total":
+        m.setObjective(m._z.sum(), GRB.MINIMIZE)
+        m._t = None
+    else:
+        m._t = m.addVar(name="t")
+        m.addConstr(m._z <= m._t, name="max_z")
+        m.setObjective(m._t, GRB.MINIMIZE)
+
+    # fixed roots break the symmetry between the districts
+    engine = ContiguityEngine(arrays)
+    m._rootIndices = [engine.index[root] for root in roots]
+    m._xvars = [m._xm[j].tolist() for j in range(k)]
+    for j, root in enumerate(m._rootIndices):
+        m._xvars[j][root].LB = 1
+
+    m._k = k
+    m._arrays = arrays
+    m._contiguity = engine
+    m._allXvars = [var for row in m._xvars for var in row]
+    m._numCallbacks = 0
+    m._numLazyCuts = 0
+    m._callbackTime = 0.0
+    m._callback = partition_callback
+
+    m.Params.LazyConstraints = 1
+    m.Params.FeasibilityTol = 1e-7
+    m.Params.IntFeasTol = 1e-7
+    m.update()
+    m._buildTime = time.time() - start
+    return m
+
+
+def partition_callback(m, where):
+    """Adds an a,b-separator cut for every component of a district that does not contain its root."""
+    from gurobipy import GRB
+    import gurobipy as gp
+
+    if where != GRB.Callback.MIPSOL:
+        return
+    start = time.perf_counter()
+    m._numCallbacks += 1
+    n = m._arrays.num_nodes
+    xval = np.fromiter(m.cbGetSolution(m._allXvars), dtype=float, count=m._k * n).reshape(m._k, n)
+    for j in range(m._k):
+        xvars = m._xvars[j]
+        cuts, _ = m._contiguity.integer_separator_cuts(np.flatnonzero(xval[j] > 0.5), m._rootIndices[j])
+        for a, b, C in cuts:
+            m.cbLazy(xvars[a] + xvars[b] <= 1 + gp.quicksum(xvars[c] for c in C.tolist()))
+            m._numLazyCuts += 1
+    m._callbackTime += time.perf_counter() - start
+
+
+def set_partition_start(m, labels: np.ndarray) -> None:
+    """Passes a partition (district label of every node index) to Gurobi as MIP start."""
+    arrays = m._arrays
+    tails, heads = arrays.arc_tails(), arrays.indices
+    scores = district_scores(arrays, labels, m._k)
+    x = np.zeros((m._k, arrays.num_nodes))
+    x[labels, np.arange(arrays.num_nodes)] = 1
+    m._xm.Start = x
+    m._ym.Start = x[:, tails] * (1 - x[:, heads])
+    m._A.Start = np.array([district['area'] for district in scores])
+    m._P.Start = np.array([district['perimeter'] for district in scores])
+    m._z.Start = np.array([district['objective'] for district in scores])
+    if m._t is not None:
+        m._t.Start = max(district['objective'] for district in scores)
+
+
+def solve_partition_monolithic(DG: nx.DiGraph, k: int, area_tolerance: float = 0.1, objective: str = "total",
+                               start_labels: np.ndarray | None = None, time_limit: float = 3600, threads: int = 1,
+                               mip_gap: float = 1e-4) -> dict:
+    """
+    Solves the k district problem with the monolithic model.
+    :param start_labels: Optional partition (e.g., from carving) used as MIP start. Its district roots (the nodes
+                         with the largest weight) become the fixed roots, otherwise the roots are spread over the
+                         region (see spread_roots).
+    :return: The partition (see _partition_result) with the Gurobi status, bound and node count.
+    """
+    from gurobipy import GRB
+
+    arrays = get_graph_arrays(DG)
+    lower, upper = area_bounds(arrays, k, area_tolerance)
+    if start_labels is not None:
+        roots = [int(np.flatnonzero(start_labels == j)[np.argmax(arrays.node_weight[start_labels == j])])
+                 for j in range(k)]
+    else:
+        roots = spread_roots(arrays, k).tolist()
+
+    m = build_partition_mip(DG, k, arrays.fids[roots].tolist(), lower, upper, objective)
+    m.Params.TimeLimit = time_limit
+    m.Params.Threads = threads
+    m.Params.MIPGap = mip_gap
+    if start_labels is not None:
+        set_partition_start(m, start_labels)
+    m.optimize(m._callback)
+    print(f"Monolithic partition: {m._numCallbacks} callbacks, {m._numLazyCuts} lazy cuts, {m.NodeCount:.0f} nodes, "
+          f"{m.Runtime:.1f}s")
+
+    if m.SolCount == 0:
+        return {'labels': None, 'status': m.status, 'time': m.Runtime}
+    labels = np.argmax(m._xm.X, axis=0)
+    result = _partition_result(arrays, labels, k, objective)
+    result.update(status=m.status, bound=m.ObjBound if m.status != GRB.INFEASIBLE else None,
+                  node_count=int(m.NodeCount), time=m.Runtime, lazy_cuts=m._numLazyCuts)
+    return result
+
+
+####################################
+# CARVING DECOMPOSITION
+####################################
+
+def _carve_candidate(task: tuple) -> dict:
+    """Solves the rooted single district problem of one candidate root in a worker process."""
+    sub_arrays, root, lower, upper, backend, time_limit = task
+    DG = graph_from_arrays(sub_arrays)
+    DG.graph['bounds'] = {'area_min': lower, 'area_max': upper,
+                          'perimeter_max': float(sub_arrays.boundary_perim.sum() + sub_arrays.shared_perim.sum() / 2)}
+    solver = get_backend(backend, verbose=False)
+    solver.build(DG, lower, root=int(sub_arrays.fids[root]))
+    solver.optimize(time_limit=time_limit, threads=1)
+    result = solver.result()
+    return {'root': root, 'solution': result.solution, 'objective': result.objective, 'status': result.status,
+            'time': result.runtime}
+
+
+def _accept_district(arrays: GraphArrays, remaining: np.ndarray, district: np.ndarray,
+                     upper: float) -> np.ndarray | None:
+    """
+    Checks whether a carved district leaves the remaining region contiguous. Every component of the rest touches the
+    district, so all but the largest component can be added to it without breaking its contiguity, as long as its
+    area stays below the upper bound.
+    :param remaining: Boolean mask of the nodes of the remaining region (before carving).
+    :param district: Boolean mask of the carved district.
+    :return: Boolean mask of the district (with the absorbed components) or None if it is not acceptable.
+    """
+    rest = remaining & ~district
+    if not rest.any():
+        return district
+    sub = subgraph_arrays(arrays, rest)
+    num_components, labels = connected_components(adjacency_matrix(sub), directed=False)
+    if num_components == 1:
+        return district
+    component_area = np.bincount(labels, weights=sub.node_weight, minlength=num_components)
+    absorbed = np.flatnonzero(rest)[labels != np.argmax(component_area)]
+    if arrays.node_weight[district].sum() + arrays.node_weight[absorbed].sum() > upper:
+        return None
+    district = district.copy()
+    district[absorbed] = True
+    return district
+
+
+def solve_partition_carving(DG: nx.DiGraph, k: int, area_tolerance: float = 0.1, objective: str = "total",
+                            num_candidates: int = 8, processes: int | None = None, backend: str = "gurobi",
+                            time_limit: float = 60) -> dict:
+    """
+    Solves the k district problem by carving one district after the other out of the remaining region, the last
+    district is the rest. In every step, the rooted single district problem (area between the bounds of a
+    district that still leave room for the other districts) is solved for num_candidates roots spread over the
+    boundary of the remaining region in a worker pool. The best district whose rest is contiguous is kept.
+    :param objective: Only used for the reported objective (carving always optimizes the score of every district).
+    :param num_candidates: Number of candidate roots per step.
+    :param processes: Number of worker processes. Defaults to the number of CPUs.
+    :param backend: Solver backend of the single district problems (see mip_backends).
+    :param time_limit: Time limit of every single district problem.
+    :return: The partition (see _partition_result).
+    """
+    start = time.time()
+    arrays = get_graph_arrays(DG)
+    lower, upper = area_bounds(arrays, k, area_tolerance)
+    labels = np.full(arrays.num_nodes, k - 1, dtype=np.int64)
+    remaining = np.ones(arrays.num_nodes, dtype=bool)
+
+    with Pool(processes or cpu_count()) as pool:
+        for j in range(k - 1):
+            sub = subgraph_arrays(arrays, remaining)
+            sub_nodes = np.flatnonzero(remaining)
+            remaining_area = float(sub.node_weight.sum())
+            left = k - j - 1  # districts after this one
+            step_lower = max(lower, remaining_area - left * upper)
+            step_upper = min(upper, remaining_area - left * lower)
+            if step_lower > step_upper:
+                raise RuntimeError(f"The remaining region can not be split into {left + 1} districts within the area "
+                                   f"bounds.")
+
+            # carving from the boundary keeps the rest contiguous more often than carving from the inside
+            roots = spread_roots(sub, num_candidates, candidates=sub.boundary_node)
+            tasks = [(sub, root, step_lower, step_upper, backend, time_limit) for root in roots.tolist()]
+            candidates = sorted((c for c in pool.map(_carve_candidate, tasks) if c['solution'] is not None),
+                                key=lambda c: c['objective'])
+
+            district, candidate = None, None
+            for candidate in candidates:
+                mask = np.zeros(arrays.num_nodes, dtype=bool)
+                mask[sub_nodes[np.isin(sub.fids, candidate['solution'])]] = True
+                district = _accept_district(arrays, remaining, mask, step_upper)
+                if district is not None:
+                    break
+            if district is None:
+                raise RuntimeError(f"No candidate district of step {j} leaves the remaining region contiguous.")
+
+            labels[district] = j
+            remaining &= ~district
+            print(f"Carving step {j}: district with {int(district.sum())} nodes, objective "
+                  f"{candidate['objective']:.4f} ({len(candidates)} candidates), "
+                  f"{time.time() - start:.1f}s")
+
+    result = _partition_result(arrays, labels, k, objective)
+    result.update(status='HEURISTIC', time=time.time() - start)
+    return result
+
+
+def _partition_result(arrays: GraphArrays, labels: np.ndarray, k: int, objective: str) -> dict:
+    """The partition as dict: labels, scores of every district and the objective values."""
+    districts = district_scores(arrays, labels, k)
+    scores = [district['objective'] for district in districts]
+    return {'labels': labels, 'districts': districts,
+            'objective': sum(scores) if objective == "total" else max(scores),
+            'total_inverse_pp': sum(scores), 'min_polsby_popper': 1 / max(scores) if max(scores) > 0 else math.inf}
+
+
+def solve_partition(DG: nx.DiGraph, k: int, area_tolerance: float = 0.1, objective: str = "total",
+                    mode: str = "carving", processes: int | None = None, backend: str = "gurobi",
+                    time_limit: float = 3600, threads: int = 1) -> dict:
+    """
+    Partitions the region into k contiguous districts.
+    :param mode: 'carving', 'monolithic' or 'both' (carving, then the monolithic model started with its partition).
+    :return: The partition (labels are district numbers per node index of the graph arrays).
+    """
+    if mode not in ("carving", "monolithic", "both"):
+        raise ValueError(f"Unknown partition mode '{mode}', expected 'carving', 'monolithic' or 'both'.")
+    result = None
+    if mode in ("carving", "both"):
+        result = solve_partition_carving(DG, k, area_tolerance, objective, processes=processes, backend=backend,
+                                         time_limit=time_limit)
+    if mode in ("monolithic", "both"):
+        monolithic = solve_partition_monolithic(DG, k, area_tolerance, objective,
+                                                start_labels=result['labels'] if result else None,
+                                                time_limit=time_limit, threads=threads)
+        if monolithic['labels'] is not None or result is None:
+            result = monolithic
+    return result
+
+
+def save_partition(result: dict, arrays: GraphArrays, dataset_name: str, k: int, metadata: dict) -> str:
+    """Writes the partition as solution artifact (see solution_io) named '<dataset>_k=<k>'."""
+    solution_name = f"{dataset_name}_k={k}"
+    metadata = dict(metadata, dataset=dataset_name, k=k, status=result['status'], objective=result['objective'],
+                    total_inverse_pp=result['total_inverse_pp'], min_polsby_popper=result['min_polsby_popper'],
+                    districts=result['districts'])
+    write_solution(solution_name, arrays.fids.tolist(), metadata,
+                   {'node_fids': arrays.fids, 'district': result['labels']})
+    return solution_name
+
+
+parser = argparse.ArgumentParser(description="Partition a dataset into k contiguous, area balanced districts")
+parser.add_argument('dataset', help='Name of the dataset (e.g. issoire)')
+parser.add_argument('-k', '--districts', type=int, required=True, help='Number of districts')
+parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative deviation from the average area')
+parser.add_argument('--objective', choices=OBJECTIVES, default='total',
+                    help='Minimize the sum (total) or the maximum (min) of the inverse Polsby-Popper scores')
+parser.add_argument('--mode', choices=['carving', 'monolithic', 'both'], default='carving', help='Partition engine')
+parser.add_argument('-p', '--processes', type=int, default=None, help='Worker processes of the carving engine')
+parser.add_argument('-t', '--threads', type=int, default=1, help='Gurobi threads of the monolithic model')
+parser.add_argument('--backend', choices=list(BACKENDS), default='gurobi',
+                    help='Solver backend of the carving subproblems')
+parser.add_argument('--time-limit', type=float, default=3600,
+                    help='Time limit of the monolithic model and of every carving subproblem')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    graph = read_graph_from_dataset(args.dataset)
+    partition = solve_partition(graph, args.districts, args.tolerance, args.objective, args.mode, args.processes,
+                                args.backend, args.time_limit, args.threads)
+    if partition['labels'] is None:
+        print(f"No partition found (status {partition['status']}).")
+    else:
+        for district in partition['districts']:
+            print(f"District {district['district']}: {district['size']} nodes, area {district['area']:.1f}, "
+                  f"Polsby-Popper score {1 / district['objective']:.4f}")
+        print(f"Total inverse Polsby-Popper score {partition['total_inverse_pp']:.4f}, "
+              f"minimum Polsby-Popper score {partition['min_polsby_popper']:.4f}")
+        name = save_partition(partition, get_graph_arrays(graph), args.dataset, args.districts,
+                              {'mode': args.mode, 'area_tolerance': args.tolerance})
+        print(f"Saved to data/solutions/{name}")
@@ -0,0 +1,185 @@
+import math
+import time
+from multiprocessing import Pool, Value, cpu_count
+
+import gurobipy as gp
+from gurobipy import GRB
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import breadth_first_order
+
+from graph_utils import GraphArrays, get_graph_arrays, graph_from_arrays, subgraph_arrays
+from mip_build_district import build_single_district_mip, cut_callback
+
+"""
+Rooted decomposition of the single district MIP: every district has a unique root, its node with the largest weight
+(ties broken by the smaller index). For every candidate root r a rooted subproblem is solved, in which x[r] is fixed
+to one and only nodes that can be in a district with root r are kept. The subproblems are solved in a worker pool
+and share the best objective found so far as a global cutoff.
+"""
+
+# State of a worker process, set by _init_worker
+_worker = {}
+
+# Statuses of roots whose subproblem can not contain a better district than the result: solved, infeasible or pruned
+# by the area lower bound or the shared cutoff
+FINISHED_STATUSES = ('AREA_PRUNED', GRB.OPTIMAL, GRB.INFEASIBLE, GRB.CUTOFF)
+
+
+def rooted_subgraph_arrays(arrays: GraphArrays, root: int, area_lower_bound: float = 0) -> GraphArrays | None:
+    """
+    Nodes that can be in a district whose root (node with the largest weight) is the given root: nodes with a
+    smaller weight than the root that are reachable from the root via such nodes.
+
+    :param arrays: The graph as GraphArrays
+    :param root: Index of the root node
+    :param area_lower_bound: Lower bound for the area of the district.
+    :return: The GraphArrays of the rooted subproblem or None, if no district with this root can reach the area
+             lower bound.
+    """
+    n = arrays.num_nodes
+    weight = arrays.node_weight
+    index = np.arange(n)
+    admissible = (weight < weight[root]) | ((weight == weight[root]) & (index >= root))
+
+    # Only search over arcs between admissible nodes
+    tails = arrays.arc_tails()
+    keep_arc = admissible[tails] & admissible[arrays.indices]
+    graph = sp.csr_matrix((np.ones(int(keep_arc.sum()), dtype=np.int8), (tails[keep_arc], arrays.indices[keep_arc])),
+                          shape=(n, n))
+    reachable = np.zeros(n, dtype=bool)
+    reachable[breadth_first_order(graph, root, directed=True, return_predecessors=False)] = True
+
+    if weight[reachable].sum() < area_lower_bound:
+        return None
+    return subgraph_arrays(arrays, reachable)
+
+
+def _init_worker(arrays: GraphArrays, area_lower_bound: float, shared_best, deadline: float,
+                 params: dict | None = None):
+    """
+    Stores the problem data and the deadline (time.time() at which the decomposition stops) in the worker process
+    and creates a silent Gurobi environment.
+    """
+    _worker['arrays'] = arrays
+    _worker['area_lower_bound'] = area_lower_bound
+    _worker['shared_best'] = shared_best
+    _worker['deadline'] = deadline
+    _worker['params'] = params
+    _worker['env'] = gp.Env(params={'OutputFlag': 0})
+
+
+def _rooted_callback(m, where):
+    """
+    Contiguity callback of a rooted subproblem that also shares incumbents with the other workers and stops the
+    subproblem as soon as its bound can not beat the best incumbent of all workers.
+    """
+    num_lazy_cuts = m._numLazyCuts
+    cut_callback(m, where)
+    shared_best = m._sharedBest
+
+    if where == GRB.Callback.MIPSOL and m._numLazyCuts == num_lazy_cuts:
+        # the solution is contiguous (no lazy cut was added), so it is a new incumbent
+        objective = m.cbGet(GRB.Callback.MIPSOL_OBJ)
+        with shared_best.get_lock():
+            if objective < shared_best.value:
+                shared_best.value = objective
+
+    elif where == GRB.Callback.MIP:
+        if m.cbGet(GRB.Callback.MIP_OBJBND) >= shared_best.value - 1e-9:
+            m._prunedByCutoff = True
+            m.terminate()
+
+
+def _solve_root(root: int) -> dict:
+    """Solves the rooted subproblem of the given root index in a worker process."""
+    start = time.time()
+    arrays = _worker['arrays']
+    shared_best = _worker['shared_best']
+    result = {'root': int(arrays.fids[root]), 'objective': math.inf, 'solution': None}
+
+    sub_arrays = rooted_subgraph_arrays(arrays, root, _worker['area_lower_bound'])
+    if sub_arrays is None:
+        result['status'] = 'AREA_PRUNED'
+        result['time'] = time.time() - start
+        return result
+
+    remaining = _worker['deadline'] - time.time()
+    if remaining <= 0:
+        result['status'] = GRB.TIME_LIMIT
+        result['time'] = time.time() - start
+        return result
+
+    DG = graph_from_arrays(sub_arrays)
+    m = build_single_district_mip(DG, root=result['root'], area_lower_bound=_worker['area_lower_bound'],
+                                  env=_worker['env'], verbose=False, params=_worker['params'])
+    m.Params.Threads = 1
+    m.Params.TimeLimit = remaining
+    if shared_best.value < math.inf:
+        m.Params.Cutoff = shared_best.value
+    m._sharedBest = shared_best
+    m._prunedByCutoff = False
+
+    m.optimize(_rooted_callback)
+
+    # a subproblem stopped by _rooted_callback is pruned by the shared cutoff like one Gurobi cuts off itself
+    result['status'] = GRB.CUTOFF if m.status == GRB.INTERRUPTED and m._prunedByCutoff else m.status
+    result['num_nodes'] = sub_arrays.num_nodes
+    result['node_count'] = m.NodeCount
+    if m.SolCount > 0:
+        result['objective'] = m._z.X
+        result['solution'] = [i for i in DG.nodes if m._x[i].X > 0.5]
+        result['area'] = m._A.X
+        result['perimeter'] = m._P.X
+    result['time'] = time.time() - start
+    m.dispose()
+    return result
+
+
+def solve_rooted_decomposition(DG: nx.DiGraph, area_lower_bound: float = 0, processes: int | None = None,
+                               time_limit: float = 3600,
+                               params: dict | None = None) -> tuple[list[int] | None, dict, list[dict]]:
+    """
+    Solve the single district MIP by solving one rooted subproblem per candidate root in a worker pool.
+    Candidate roots are processed from the largest to the smallest weight, roots whose subproblem can not reach the
+    area lower bound are pruned without building a model.
+
+    :param DG: Directed graph representing the districting problem (see build_single_district_mip).
+    :param area_lower_bound: Lower bound for the area.
+    :param processes: Number of worker processes (one Gurobi thread each). Defaults to the number of CPUs.
+    :param time_limit: Time limit of the whole decomposition, every subproblem gets the time that is left.
+    :param params: Gurobi parameters of every subproblem (see build_single_district_mip), threads and time limit are
+                   set by the decomposition.
+    :return: A tuple of the best district (None if no district was found), the result of its root and the results of
+             all roots. The 'status' of the best result is the status of the decomposition (see
+             decomposition_status), the status of its own subproblem is its 'root_status'.
+    """
+    start = time.time()
+    arrays = get_graph_arrays(DG)
+    roots = np.argsort(-arrays.node_weight, kind="stable").tolist()
+    shared_best = Value('d', math.inf)
+
+    results = []
+    with Pool(processes or cpu_count(), initializer=_init_worker,
+              initargs=(arrays, area_lower_bound, shared_best, start + time_limit, params)) as pool:
+        for result in pool.imap_unordered(_solve_root, roots):
+            results.append(result)
+
+    best = min(results, key=lambda r: r['objective'])
+    best = dict(best, root_status=best['status'], status=decomposition_status(results))
+    solved = sum(1 for r in results if r['status'] != 'AREA_PRUNED')
+    unfinished = sum(1 for r in results if r['status'] not in FINISHED_STATUSES)
+    print(f"Rooted decomposition: {len(roots)} roots, {len(roots) - solved} pruned by area, {solved} solved "
+          f"({unfinished} not finished), best objective {best['objective']:.4f} (root {best['root']}) "
+          f"in {time.time() - start:.1f}s")
+
+    return best['solution'], best, results
+
+
+def decomposition_status(results: list[dict]) -> int:
+    """
+    Gurobi status of a rooted decomposition: OPTIMAL if every root finished (see FINISHED_STATUSES), otherwise
+    TIME_LIMIT, since a root that was stopped early may still contain a better district.
+    """
+    return GRB.OPTIMAL if all(r['status'] in FINISHED_STATUSES for r in results) else GRB.TIME_LIMIT
@@ -1,10 +1,18 @@
+import math
 import os
+import time
 
 import networkx as nx
 import gurobipy as gp
 from gurobipy import GRB
+import numpy as np
 
+from graph_reduction import expand_solution, reduce_district_graph
+from graph_utils import get_graph_arrays
 from mip_build_district import build_single_district_mip
+from mip_heuristic import find_warm_start
+from mip_telemetry import RunTelemetry, phase
+from solution_io import district_indices, save_solution_summary
 
 """
 Code based on "Political districting to optimize the Polsby-Popper compactness score with application to  voting
@@ -12,69 +20,340 @@ rights"
 """
 
 
-def solve_single_district_mip(DG: nx.DiGraph, area_lower_bound: float = 0) -> tuple[list[int], gp.Model] | None:
+def solve_single_district_mip(DG: nx.DiGraph, area_lower_bound: float = 0, threads: int = 1,
+                              user_cuts: bool = False, warm_start: bool = True, reduce: bool = True,
+                              telemetry: RunTelemetry | None = None, start_solution: list[int] | None = None,
+                              params: dict | None = None) -> tuple[list[int], gp.Model] | None:
     """
     Solve the single district MIP model.
     :param DG: Directed graph representing the districting problem, where nodes have 'node_weight' and 'boundary_perim' attributes,
                     and edges have 'shared_perim' attribute.
     :param area_lower_bound: Lower bound for the area.
+    :param threads: Number of threads Gurobi may use for this solve.
+    :param user_cuts: If True, also separate contiguity cuts from fractional solutions (see build_single_district_mip).
+    :param warm_start: If True, run the heuristic of mip_heuristic and pass its district to Gurobi as MIP start.
+    :param reduce: If True, build the model on the graph reduced by graph_reduction.reduce_graph. The returned
+                    solution always consists of the original FIDs.
+    :param telemetry: Optional RunTelemetry that records the phase times, the incumbent and bound trajectory and the
+                    results of this solve.
+    :param start_solution: Optional district (original FIDs, e.g. read with solution_io.read_solution) passed to
+                    Gurobi as MIP start, if it reaches the area lower bound and beats the heuristic district.
+    :param params: Gurobi parameters of the model (see build_single_district_mip), the time limit defaults to one
+                    hour.
     :return: A tuple containing the list of nodes in the district and the Gurobi model object.
     TODO: I dont know if this is correctly implemented (e.g. if the hyperparameters are set correctly).
     """
-    m = build_single_district_mip(DG, area_lower_bound=area_lower_bound)
+    DG, reduction, m = _prepare_model(DG, area_lower_bound, threads, user_cuts, reduce, telemetry, params)
 
-    # Set time limit for the optimization
-    m.Params.TimeLimit = 3600  # 1 hour
-
-    # Limit to 1 Thread
-    m.Params.Threads = 1
-
-    # Set the log file for Gurobi
-    suffix = f"_LB={area_lower_bound}" if area_lower_bound > 0 else ""
-    gurobi_logfile = f"data/solutions/{DG.graph['dataset_name']}{suffix}/{DG.graph['dataset_name']}{suffix}.log"
-    os.makedirs(os.path.dirname(gurobi_logfile), exist_ok=True)
-    m.setParam('LogFile', DG.graph.get('gurobi_logfile', gurobi_logfile))
+    # Seed Gurobi with a district from the heuristic (or the given start solution)
+    start = _find_start(DG, area_lower_bound, warm_start, start_solution, telemetry)
+    if start is not None:
+        set_mip_start(m, start['nodes'])
 
     # Optimize the model
+    m._telemetry = telemetry
+    if telemetry is not None:
+        telemetry.begin_solve()
     m.optimize(m._callback)
+    if telemetry is not None:
+        telemetry.record_gurobi_model(m)
+
+    first_incumbent = "-" if m._firstIncumbentTime is None else f"{m._firstIncumbentTime:.3f}s"
+    print(f"Time to first incumbent: {first_incumbent} ({'with' if warm_start else 'without'} warm start)")
+
+    print(f"Contiguity callback: {m._numCallbacks} calls, {m._numLazyCuts} lazy cuts, "
+          f"{m._callbackTime:.3f}s in callback ({m._separatorTime:.3f}s finding separators)")
+    if user_cuts:
+        print(f"Fractional separation: {m._numUserCuts} user cuts in {m._userCutTime:.3f}s")
+    print(f"Explored nodes: {m.NodeCount:.0f}, runtime: {m.Runtime:.3f}s")
 
     # Check if a solution was found
     if not m.status == GRB.OPTIMAL or m.status == GRB.TIME_LIMIT:
         print("ERROR: !!!Something went wrong when solving the MIP model.!!!")
 
-    # Extract the solution
+    # Extract the solution (in FIDs of the original graph)
     solution = [i for i in DG.nodes if m._x[i].x > 0.5]
+    if reduction is not None:
+        solution = expand_solution(reduction, solution)
+    return solution, m
+
+
+def solve_single_district_fractional(DG: nx.DiGraph, area_lower_bound: float = 0, threads: int = 1,
+                                     user_cuts: bool = False, warm_start: bool = True, reduce: bool = True,
+                                     method: str = "dinkelbach", tolerance: float = 1e-6, max_iterations: int = 100,
+                                     telemetry: RunTelemetry | None = None, start_solution: list[int] | None = None,
+                                     params: dict | None = None) -> tuple[list[int], gp.Model] | None:
+    """
+    Solve the single district problem as the fractional program min P^2 / (4*pi*A) instead of the MISOCP.
+    The SOC constraint and z are removed from the model, and a sequence of parametric MIQPs
+        F(lambda) = min P^2 / (4*pi) - lambda * A
+    is solved with the same contiguity callback. The optimal score is the lambda with F(lambda) = 0.
+    'dinkelbach' sets lambda to the score of the last optimal district (superlinear convergence),
+    'bisection' halves an interval [lower, upper] of lambda and stops every subproblem at the first district with
+    F(lambda) <= 0. Every subproblem is warm started with the best district so far, and the lazy cuts of earlier
+    subproblems are added to the model as constraints.
+    :param DG: Directed graph representing the districting problem (see solve_single_district_mip).
+    :param area_lower_bound: Lower bound for the area.
+    :param threads: Number of threads Gurobi may use for this solve.
+    :param user_cuts: If True, also separate contiguity cuts from fractional solutions (see build_single_district_mip).
+    :param warm_start: If True, start with lambda set to the score of the district found by the heuristic.
+    :param reduce: If True, build the model on the reduced graph (see solve_single_district_mip).
+    :param method: 'dinkelbach' or 'bisection'.
+    :param tolerance: Relative tolerance on lambda at which the iterations stop.
+    :param max_iterations: Maximum number of subproblems.
+    :param telemetry: Optional RunTelemetry, its trajectory gets the best score (and for bisection the lower bound)
+                      after every subproblem.
+    :param start_solution: Optional district (original FIDs) to start with (see solve_single_district_mip).
+    :param params: Gurobi parameters of the model (see solve_single_district_mip), its TimeLimit is the time limit of
+                   all subproblems together.
+    :return: A tuple containing the list of nodes in the district and the Gurobi model object (with the values of
+             the best district). m._z is None for this model, use inverse_polsby_popper_score for the objective.
+    """
+    if method not in ("dinkelbach", "bisection"):
+        raise ValueError(f"Unknown fractional method '{method}', expected 'dinkelbach' or 'bisection'.")
+
+    start = time.perf_counter()
+    DG, reduction, m = _prepare_model(DG, area_lower_bound, threads, user_cuts, reduce, telemetry, params)
+    time_limit = m.Params.TimeLimit
+
+    # Replace the SOC constraint and z by the parametric objective
+    m.remove(m._ppConstr)
+    m.remove(m._z)
+    m._z = None
+    m._ppConstr = None
+
+    # Gurobi replaces m._callback by its own wrapper during optimize, so keep the function for re-optimizations
+    callback = m._callback
+    arrays = m._contiguity.arrays
+
+    best = None  # node indices (into the graph arrays) of the best district so far
+    best_score = math.inf
+    start_district = _find_start(DG, area_lower_bound, warm_start, start_solution, telemetry)
+    if start_district is not None:
+        best, best_score = start_district['nodes'], start_district['objective']
+
+    # lambda of the next subproblem: the score of the best district or, without one, 0 (i.e., minimize P^2 first)
+    lower = 0.0
+    converged = False
+    lam = best_score if best is not None else 0.0
+    num_cuts_added = 0
+    m._fractionalIterations = []
+    status = GRB.OPTIMAL
+    for iteration in range(max_iterations):
+        remaining = time_limit - (time.perf_counter() - start)
+        if remaining <= 0:
+            status = GRB.TIME_LIMIT
+            break
+        m.Params.TimeLimit = remaining
+
+        # only bisection needs a sign of F(lambda), so it may stop at the first district with F(lambda) <= 0
+        m.Params.BestObjStop = 0.0 if method == "bisection" and best is not None else -GRB.INFINITY
+
+        # keep the contiguity cuts of the earlier subproblems
+        for a, b, C in m._lazyCuts[num_cuts_added:]:
+            m.addConstr(m._xvars[a] + m._xvars[b] <= 1 + gp.quicksum(m._xvars[c] for c in C.tolist()))
+        num_cuts_added = len(m._lazyCuts)
+
+        m.setObjective(m._P * m._P * (1 / (4 * math.pi)) - lam * m._A, GRB.MINIMIZE)
+        if best is not None:
+            set_mip_start(m, best)
+        m.optimize(callback)
+        status = m.status
+
+        found = m.SolCount > 0
+        if found:
+            area, perimeter = m._A.X, m._P.X
+            score = perimeter * perimeter / (4 * math.pi * area)
+            district = np.flatnonzero(np.array(m.getAttr('X', m._xvars)) > 0.5)
+        m._fractionalIterations.append({'lambda': lam, 'status': status, 'value': m.ObjVal if found else None,
+                                        'score': score if found else None, 'runtime': m.Runtime,
+                                        'node_count': m.NodeCount})
+        print(f"{method.capitalize()} iteration {iteration}: lambda {lam:.6f}, status {status}, "
+              f"score {score if found else math.inf:.6f}, {m.NodeCount:.0f} nodes, {m.Runtime:.3f}s")
+
+        # a district found before a time limit is feasible (contiguity is enforced by the lazy cuts) and may be the best
+        if found and score < best_score:
+            best, best_score = district, score
+        if telemetry is not None:
+            telemetry.record_point(best_score, lower if method == "bisection" else None)
+        if status not in (GRB.OPTIMAL, GRB.USER_OBJ_LIMIT):
+            # time limit or infeasible, the best district so far is the result
+            break
+
+        if method == "dinkelbach":
+            # F(lambda) = 0 at the optimal score, otherwise the new district has a strictly smaller score
+            if not found or lam > 0 and score >= lam * (1 - tolerance):
+                converged = found
+                break
+            lam = best_score
+        else:
+            if status == GRB.OPTIMAL and m.ObjVal > 0:
+                # no district has a score below lambda
+                lower = lam
+            if best_score - lower <= tolerance * best_score:
+                converged = True
+                break
+            lam = (lower + best_score) / 2
+
+    m._fractionalRuntime = time.perf_counter() - start
+    m._fractionalStatus = status
+    print(f"{method.capitalize()}: {len(m._fractionalIterations)} subproblems, score {best_score:.6f}, "
+          f"{m._numLazyCuts} lazy cuts, {m._fractionalRuntime:.3f}s")
+    if telemetry is not None:
+        telemetry.add_phase('build', m._buildTime)
+        telemetry.add_phase('optimize', sum(iteration['runtime'] for iteration in m._fractionalIterations))
+        telemetry.add_phase('callback', m._callbackTime)
+        telemetry.add_phase('separator', m._separatorTime)
+        telemetry.counters.update({'callbacks': m._numCallbacks, 'lazy cuts': m._numLazyCuts,
+                                   'user cuts': m._numUserCuts, 'subproblems': len(m._fractionalIterations)})
+        bound = best_score if converged else (lower if method == "bisection" and best is not None else None)
+        telemetry.record_result(status=status, objective=best_score, bound=bound,
+                                node_count=sum(iteration['node_count'] for iteration in m._fractionalIterations))
+
+    if best is None:
+        print("ERROR: !!!No district was found by the fractional solver.!!!")
+        return None, m
+
+    # Leave the values of the best district in the model, so print_and_save_solution reports it
+    m.Params.TimeLimit = max(1.0, time_limit - m._fractionalRuntime)
+    m.Params.BestObjStop = -GRB.INFINITY
+    m.setObjective(m._P * m._P * (1 / (4 * math.pi)) - best_score * m._A, GRB.MINIMIZE)
+    x = np.zeros(arrays.num_nodes)
+    x[best] = 1
+    for var, value in zip(m._xvars, x.tolist()):
+        var.LB = var.UB = value
+    m.optimize(callback)
+
+    solution = arrays.fids[best].tolist()
+    if reduction is not None:
+        solution = expand_solution(reduction, solution)
     return solution, m
 
 
-def print_and_save_solution(m: gp.Model, solution: list[int], dataset_name: str, print_all_vars:
-bool = True, file_suffix : str = None) -> None:
+def _prepare_model(DG: nx.DiGraph, area_lower_bound: float, threads: int, user_cuts: bool, reduce: bool,
+                   telemetry: RunTelemetry | None = None,
+                   params: dict | None = None) -> tuple[nx.DiGraph, dict | None, gp.Model]:
     """
-    Print the solution of the MIP model and save it to a file.
+    Reduces the graph (optional), builds the single district model with the given Gurobi parameters (a time limit of
+    one hour if they set none) and sets the threads and log file.
+    :return: The (reduced) graph, the reduction (None if reduce is False) and the Gurobi model.
     """
-    output_summary = []
-    output_summary.append("######Solution summary######")
-    output_summary.append(f"District nodes: {solution}")
-    output_summary.append(f"Suffix: {file_suffix if file_suffix else '-None-'}")
-    pp_inverse = float(m._z.x)
-    output_summary.append(f"Polsby-Popper score: {'infinity' if pp_inverse == 0 else f'{1 / pp_inverse:.4f}'}")
-    output_summary.append(f"Inverse Polsby-Popper score (Objective value): {m._z.x:.4f}")
-    output_summary.append(f"Area: {m._A.x:.4f}")
-    output_summary.append(f"Perimeter: {m._P.x:.4f}")
-    output_summary.append(f"Model status: {m.status}")  # Print the model status
+    reduction = None
+    if reduce:
+        with phase(telemetry, 'reduce'):
+            DG, reduction = reduce_district_graph(DG, area_lower_bound)
 
-    output_vars = []
-    if print_all_vars:
-        output_vars.append("######All Variables######")
-        for v in m.getVars():
-            output_vars.append(f"{v.varName}: {v.x:.4f}")
+    m = build_single_district_mip(DG, area_lower_bound=area_lower_bound, user_cuts=user_cuts,
+                                  params=dict({'TimeLimit': 3600}, **(params or {})))
 
-    # Save the output string to a file
-    os.makedirs(os.path.join("data", "solutions"), exist_ok=True)
-    solutions_path = os.path.join("data", "solutions",f"{dataset_name}{file_suffix}", f"{dataset_name}{file_suffix}.txt")
-    with open(solutions_path, "w") as file:
-        file.write("\n".join(output_summary + output_vars))
+    # Limit the number of threads (1 by default, batch runs hand out a per-job budget)
+    m.Params.Threads = threads
 
-    # Print only the solution summary to the console
-    print("\n".join(output_summary))
+    # Set the log file for Gurobi
+    suffix = f"_LB={area_lower_bound}" if area_lower_bound > 0 else ""
+    gurobi_logfile = f"data/solutions/{DG.graph['dataset_name']}{suffix}/{DG.graph['dataset_name']}{suffix}.log"
+    os.makedirs(os.path.dirname(gurobi_logfile), exist_ok=True)
+    m.setParam('LogFile', DG.graph.get('gurobi_logfile', gurobi_logfile))
+
+    return DG, reduction, m
+
+
+def _find_start(DG: nx.DiGraph, area_lower_bound: float, warm_start: bool, start_solution: list[int] | None,
+                telemetry: RunTelemetry | None = None) -> dict | None:
+    """
+    The better of the heuristic district (if warm_start) and the given start solution (if it reaches the area lower
+    bound), as dict with the node indices ('nodes') and the 'objective'. None if there is neither.
+    """
+    start = None
+    if warm_start:
+        with phase(telemetry, 'heuristic'):
+            start = run_warm_start_heuristic(DG, area_lower_bound)
+
+    if start_solution is not None:
+        arrays = get_graph_arrays(DG)
+        nodes = district_indices(arrays.fids, np.asarray(start_solution, dtype=np.int64))
+        x = np.zeros(arrays.num_nodes)
+        x[nodes] = 1
+        area = float(arrays.node_weight @ x)
+        perimeter = float(arrays.boundary_perim @ x + arrays.shared_perim @ (x[arrays.arc_tails()]
+                                                                              * (1 - x[arrays.indices])))
+        if len(nodes) > 0 and area > 0 and area >= area_lower_bound:
+            objective = perimeter * perimeter / (4 * math.pi * area)
+            print(f"Start solution: objective {objective:.4f} with {len(nodes)} nodes")
+            if start is None or objective < start['objective']:
+                start = {'nodes': nodes, 'objective': objective}
+        else:
+            print("Start solution does not reach the area lower bound, it is not used.")
+    return start
+
+
+def run_warm_start_heuristic(DG: nx.DiGraph, area_lower_bound: float) -> dict | None:
+    """
+    Runs the heuristic of mip_heuristic on DG and prints its result.
+    :return: The heuristic result (see find_warm_start) or None if it found no district.
+    """
+    heuristic = find_warm_start(get_graph_arrays(DG), area_lower_bound)
+    if heuristic is None:
+        print("Warm start heuristic found no district reaching the area lower bound.")
+    else:
+        print(f"Warm start heuristic: objective {heuristic['objective']:.4f} with {len(heuristic['nodes'])} nodes "
+              f"in {heuristic['time']:.3f}s")
+    return heuristic
+
+
+def set_mip_start(m: gp.Model, district: np.ndarray) -> None:
+    """
+    Passes a district to Gurobi as MIP start (x, y and the area, perimeter and score variables).
+    :param m: Gurobi model object built by build_single_district_mip.
+    :param district: Node indices (into the graph arrays) of the district.
+    """
+    arrays = m._contiguity.arrays
+    x = np.zeros(arrays.num_nodes)
+    x[district] = 1
+    y = x[arrays.arc_tails()] * (1 - x[arrays.indices])
+
+    area = float(arrays.node_weight @ x)
+    perimeter = float(arrays.shared_perim @ y + arrays.boundary_perim @ x)
+
+    m.setAttr('Start', m._xvars, x.tolist())
+    m.setAttr('Start', m._yvars, y.tolist())
+    m._A.Start = area
+    m._P.Start = perimeter
+    if m._z is not None:
+        m._z.Start = perimeter * perimeter / (4 * np.pi * area) if area > 0 else 0
+
+
+def inverse_polsby_popper_score(m: gp.Model) -> float:
+    """
+    Inverse Polsby-Popper score of the district in the solution of a single district model. This is z for the
+    MISOCP and P^2 / (4*pi*A) for the fractional model (see solve_single_district_fractional), which has no z.
+    """
+    if m._z is not None:
+        return float(m._z.x)
+    return m._P.x * m._P.x / (4 * math.pi * m._A.x)
+
+
+def model_status(m: gp.Model) -> int:
+    """
+    Gurobi status of a single district model. The fractional model is re-optimized with the best district fixed
+    at the end, so its status is the one of the last subproblem (see solve_single_district_fractional).
+    """
+    return m.status if m._z is not None else m._fractionalStatus
+
+
+def print_and_save_solution(m: gp.Model, solution: list[int], dataset_name: str, save_variables: bool = False,
+                            file_suffix: str = None) -> None:
+    """
+    Print the solution of the MIP model and save it (text summary and solution artifact, see solution_io).
+    :param save_variables: If True, also store the x and y values of the model (fetched in bulk) in the artifact,
+                           together with the FIDs of their nodes and arcs.
+    """
+    variables = None
+    if save_variables:
+        arrays = m._contiguity.arrays
+        variables = {'x': np.array(m.getAttr('X', m._xvars)), 'y': np.array(m.getAttr('X', m._yvars)),
+                     'node_fids': arrays.fids, 'arc_tail_fids': arrays.fids[arrays.arc_tails()],
+                     'arc_head_fids': arrays.fids[arrays.indices]}
 
+    save_solution_summary(solution, inverse_polsby_popper_score(m), m._A.x, m._P.x, model_status(m), dataset_name,
+                          file_suffix, variables)
@@ -0,0 +1,173 @@
+import argparse
+import csv
+import json
+import math
+import os
+import time
+
+import gurobipy as gp
+from gurobipy import GRB
+import networkx as nx
+import numpy as np
+
+from graph_reduction import expand_solution, reduce_district_graph
+from graph_utils import read_graph_from_dataset
+from mip_build_district import build_single_district_mip
+from mip_solver import run_warm_start_heuristic, set_mip_start
+from solution_io import save_solution_summary
+
+"""
+Sweep over area lower bounds with a single model, to trace the compactness-vs-area Pareto curve of a dataset.
+The model is built once (on the graph reduced for the smallest bound, which is valid for all larger bounds) and
+only the RHS of the area constraint changes between the solves. The lazy contiguity cuts found in earlier solves
+are valid for every bound and are added to the model as constraints. The bounds are solved from the largest to the
+smallest, so the district of the previous bound always satisfies the next bound and is passed as MIP start.
+"""
+
+
+def solve_lower_bound_sweep(DG: nx.DiGraph, area_lower_bounds: list[float], threads: int = 1,
+                            time_limit: float = 3600, user_cuts: bool = False, warm_start: bool = True,
+                            reduce: bool = True) -> list[dict]:
+    """
+    Solves the single district problem for every area lower bound with one Gurobi model.
+    :param DG: Directed graph representing the districting problem (see build_single_district_mip).
+    :param area_lower_bounds: The area lower bounds.
+    :param threads: Number of threads Gurobi may use.
+    :param time_limit: Time limit of every solve.
+    :param user_cuts: If True, also separate contiguity cuts from fractional solutions.
+    :param warm_start: If True, start the first (largest) bound with the district of the heuristic.
+    :param reduce: If True, build the model on the graph reduced for the smallest bound.
+    :return: One dict per bound (in increasing order) with the district (original FIDs), its score, area and
+             perimeter, the status, bound, node count and runtime of the solve and the number of cuts reused.
+    """
+    bounds = sorted(set(area_lower_bounds), reverse=True)
+    reduction = None
+    if reduce:
+        DG, reduction = reduce_district_graph(DG, bounds[-1])
+
+    m = build_single_district_mip(DG, area_lower_bound=bounds[-1], user_cuts=user_cuts)
+    m.Params.Threads = threads
+    m.Params.TimeLimit = time_limit
+    callback = m._callback  # Gurobi replaces m._callback by its own wrapper during optimize
+    if DG.graph.get('gurobi_logfile'):
+        m.Params.LogFile = DG.graph['gurobi_logfile']
+
+    district = None
+    if warm_start:
+        heuristic = run_warm_start_heuristic(DG, bounds[0])
+        if heuristic is not None:
+            district = heuristic['nodes']
+
+    points = []
+    num_cuts_added = 0
+    for area_lower_bound in bounds:
+        # keep the contiguity cuts of the earlier solves
+        reused = num_cuts_added
+        for a, b, C in m._lazyCuts[num_cuts_added:]:
+            m.addConstr(m._xvars[a] + m._xvars[b] <= 1 + gp.quicksum(m._xvars[c] for c in C.tolist()))
+        num_cuts_added = len(m._lazyCuts)
+
+        m._areaConstr.RHS = area_lower_bound
+        m._firstIncumbentTime = None
+        if district is not None:
+            set_mip_start(m, district)
+        start = time.perf_counter()
+        m.optimize(callback)
+
+        point = {'area_lower_bound': area_lower_bound, 'status': m.status, 'runtime': m.Runtime,
+                 'node_count': int(m.NodeCount), 'cuts_reused': reused,
+                 'bound': m.ObjBound if m.status != GRB.INFEASIBLE else None, 'solution': None}
+        if m.SolCount > 0:
+            district = np.flatnonzero(np.array(m.getAttr('X', m._xvars)) > 0.5)
+            solution = m._contiguity.arrays.fids[district].tolist()
+            point.update(objective=m._z.X, area=m._A.X, perimeter=m._P.X, gap=m.MIPGap,
+                         solution=expand_solution(reduction, solution) if reduction is not None else solution)
+        points.append(point)
+        print(f"Sweep LB={area_lower_bound:g}: status {m.status}, objective "
+              f"{point.get('objective', math.inf):.4f}, {m.NodeCount:.0f} nodes, {reused} cuts reused, "
+              f"{time.perf_counter() - start:.2f}s")
+
+    points.reverse()
+    mark_pareto(points)
+    return points
+
+
+def mark_pareto(points: list[dict]) -> None:
+    """
+    Sets 'pareto' of every point: True if no other district has at least the same area and a better (smaller)
+    inverse Polsby-Popper score.
+    """
+    solved = [point for point in points if point['solution'] is not None]
+    for point in points:
+        point['pareto'] = point['solution'] is not None and not any(
+            other['area'] >= point['area'] and other['objective'] < point['objective'] - 1e-9 for other in solved)
+
+
+def save_sweep(points: list[dict], dataset_name: str) -> str:
+    """
+    Saves the district of every point as solution named '<dataset>_sweep_LB=<bound>', so the sweep never overwrites
+    the solutions of solve, and the Pareto table as json and csv to data/solutions/<dataset>_sweep/.
+    :return: The path of the csv table.
+    """
+    for point in points:
+        if point['solution'] is not None:
+            save_solution_summary(point['solution'], point['objective'], point['area'], point['perimeter'],
+                                  point['status'], dataset_name, f"_sweep_LB={point['area_lower_bound']}")
+
+    table = [{key: value for key, value in point.items() if key != 'solution'}
+             | {'district_size': len(point['solution']) if point['solution'] is not None else 0,
+                'polsby_popper': 1 / point['objective'] if point.get('objective') else None}
+             for point in points]
+    path = os.path.join("data", "solutions", f"{dataset_name}_sweep", f"{dataset_name}_sweep")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".json", "w") as file:
+        json.dump(table, file, indent=2)
+    columns = ['area_lower_bound', 'objective', 'polsby_popper', 'area', 'perimeter', 'district_size', 'pareto',
+               'status', 'bound', 'gap', 'node_count', 'runtime', 'cuts_reused']
+    with open(path + ".csv", "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(table)
+    return path + ".csv"
+
+
+def print_pareto_table(points: list[dict]) -> None:
+    print(f"{'LB':>12}{'PP score':>10}{'area':>16}{'perimeter':>12}{'size':>7}{'status':>8}{'time':>9}  pareto")
+    for point in points:
+        if point['solution'] is None:
+            print(f"{point['area_lower_bound']:>12g}{'-':>10}{'-':>16}{'-':>12}{0:>7}{point['status']:>8}"
+                  f"{point['runtime']:>8.2f}s")
+            continue
+        print(f"{point['area_lower_bound']:>12g}{1 / point['objective']:>10.4f}{point['area']:>16.1f}"
+              f"{point['perimeter']:>12.1f}{len(point['solution']):>7}{point['status']:>8}{point['runtime']:>8.2f}s"
+              f"  {'*' if point['pareto'] else ''}")
+
+
+parser = argparse.ArgumentParser(description="Solve the single district problem for many area lower bounds")
+parser.add_argument('dataset', help='Name of the dataset (e.g. issoire)')
+parser.add_argument('-l', '--lower-bounds', type=float, nargs='+', default=None, help='Area lower bounds')
+parser.add_argument('--geometric', type=float, nargs=3, metavar=('MIN', 'MAX', 'NUM'), default=None,
+                    help='NUM area lower bounds spaced geometrically between MIN and MAX (plus 0)')
+parser.add_argument('-t', '--threads', type=int, default=1, help='Number of Gurobi threads')
+parser.add_argument('--time-limit', type=float, default=3600, help='Time limit of every solve')
+parser.add_argument('--user-cuts', action='store_true', help='Separate contiguity cuts from fractional solutions')
+parser.add_argument('--no-warm-start', action='store_true', help='Do not start with a heuristic district')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    lower_bounds = list(args.lower_bounds or [])
+    if args.geometric is not None:
+        lower_bounds += [0.0] + np.geomspace(args.geometric[0], args.geometric[1], int(args.geometric[2])).tolist()
+    if not lower_bounds:
+        parser.error("Give the area lower bounds with -l or --geometric.")
+
+    graph = read_graph_from_dataset(args.dataset)
+    graph.graph['dataset_name'] = args.dataset
+    log_path = os.path.join("data", "solutions", f"{args.dataset}_sweep", f"{args.dataset}_sweep.log")
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    graph.graph['gurobi_logfile'] = log_path
+
+    sweep = solve_lower_bound_sweep(graph, lower_bounds, threads=args.threads, time_limit=args.time_limit,
+                                    user_cuts=args.user_cuts, warm_start=not args.no_warm_start)
+    print_pareto_table(sweep)
+    print(f"Pareto table: {save_sweep(sweep, args.dataset)}")
@@ -0,0 +1,228 @@
+import argparse
+import contextlib
+import glob
+import json
+import math
+import os
+import time
+
+"""
+Structured telemetry of solver runs. A RunTelemetry collects the time spent in every phase of a run (load, reduce,
+build, heuristic, presolve, root LP, optimize, callback, plot, ...), the incumbent and bound trajectory recorded in
+the MIP callback, cut and node counts, gap and status, and is written as json next to the solution
+(data/solutions/<name>/<name>_telemetry.json). Run this module to aggregate all runs in data/solutions into one table.
+"""
+
+# Gurobi reports a missing incumbent as GRB.INFINITY (1e100)
+_NO_VALUE = 1e100
+
+
+class RunTelemetry:
+    """
+    Telemetry of a single solver run. Phases are timed with the phase context manager (or add_phase for times
+    measured elsewhere), the MIP callback feeds record_progress and record_root, and record_gurobi_model or
+    record_result store the final numbers of the solve.
+    """
+
+    def __init__(self, **info):
+        """
+        :param info: Description of the run (e.g., dataset, area_lower_bound, mode), stored as is.
+        """
+        self.info = dict(info)
+        self.phases = {}  # phase name -> seconds
+        self.counters = {}  # e.g., callbacks, lazy cuts, user cuts
+        self.results = {}  # status, objective, bound, gap, node count, ...
+        self.trajectory = []  # [seconds, incumbent, bound] whenever one of them changed
+        self.presolve_end = None  # solver runtime at the first MIP callback
+        self.root_end = None  # solver runtime at the first MIPNODE callback (root relaxation solved)
+        self.start = time.perf_counter()
+        self._solve_offset = 0.0
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Context manager adding the time spent in its body to the phase with the given name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        """Adds seconds to the phase with the given name."""
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        """Seconds since the run started."""
+        return time.perf_counter() - self.start
+
+    def begin_solve(self) -> None:
+        """Marks the start of a solver call, the solver runtimes of the callbacks are relative to it."""
+        self._solve_offset = self.elapsed()
+
+    def record_progress(self, runtime: float, incumbent: float | None, bound: float | None) -> None:
+        """
+        Records the incumbent and bound at the given solver runtime (called from the MIP callback), a point is only
+        added to the trajectory if one of the values changed.
+        """
+        if self.presolve_end is None:
+            self.presolve_end = runtime
+        self._add_point(self._solve_offset + runtime, incumbent, bound)
+
+    def record_point(self, incumbent: float | None, bound: float | None) -> None:
+        """Records the incumbent and bound now (for solvers without a MIP callback, e.g., between iterations)."""
+        self._add_point(self.elapsed(), incumbent, bound)
+
+    def _add_point(self, seconds: float, incumbent: float | None, bound: float | None) -> None:
+        incumbent = None if incumbent is None or abs(incumbent) >= _NO_VALUE else incumbent
+        bound = None if bound is None or abs(bound) >= _NO_VALUE else bound
+        if self.trajectory and self.trajectory[-1][1] == incumbent and self.trajectory[-1][2] == bound:
+            return
+        self.trajectory.append([seconds, incumbent, bound])
+
+    def record_root(self, runtime: float) -> None:
+        """Records the solver runtime at which the root relaxation was solved (called from the MIPNODE callback)."""
+        if self.root_end is None:
+            self.root_end = runtime
+
+    def record_gurobi_model(self, m) -> None:
+        """
+        Stores the phase times, counters and results of a single district model built by build_single_district_mip
+        after it was optimized.
+        """
+        self.add_phase('build', m._buildTime)
+        if self.presolve_end is not None:
+            self.add_phase('presolve', self.presolve_end)
+            if self.root_end is not None:
+                self.add_phase('root LP', self.root_end - self.presolve_end)
+        self.add_phase('optimize', m.Runtime)
+        self.add_phase('callback', m._callbackTime)
+        self.add_phase('separator', m._separatorTime)
+        if m._userCuts:
+            self.add_phase('user cuts', m._userCutTime)
+
+        self.counters['callbacks'] = self.counters.get('callbacks', 0) + m._numCallbacks
+        self.counters['lazy cuts'] = m._numLazyCuts
+        self.counters['user cuts'] = m._numUserCuts
+        self.counters['variables'] = m.NumVars
+        self.counters['constraints'] = m.NumConstrs
+
+        has_solution = m.SolCount > 0
+        self.record_result(status=m.Status, objective=_model_attr(m, 'ObjVal') if has_solution else None,
+                           bound=_model_attr(m, 'ObjBound'), gap=_model_attr(m, 'MIPGap') if has_solution else None,
+                           node_count=m.NodeCount, first_incumbent_time=m._firstIncumbentTime)
+
+    def record_result(self, **results) -> None:
+        """Stores final results of the run (status, objective, bound, node_count, ...). Infinite values become None."""
+        for key, value in results.items():
+            if isinstance(value, float) and not math.isfinite(value):
+                value = None
+            self.results[key] = value
+
+    def to_dict(self) -> dict:
+        """The telemetry as json serializable dict."""
+        return {'info': self.info, 'total_time': self.elapsed(), 'phases': self.phases, 'counters': self.counters,
+                'results': self.results, 'trajectory': self.trajectory}
+
+    def save(self, path: str) -> None:
+        """Writes the telemetry as json to path (atomically, via a temporary file)."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "w") as file:
+            json.dump(self.to_dict(), file, indent=2, default=_json_default)
+        os.replace(path + ".tmp", path)
+
+
+def phase(telemetry: RunTelemetry | None, name: str):
+    """telemetry.phase(name), or a context manager doing nothing if telemetry is None."""
+    return telemetry.phase(name) if telemetry is not None else contextlib.nullcontext()
+
+
+def telemetry_path(solution_name: str) -> str:
+    """Path of the telemetry file of the solution with the given name."""
+    return os.path.join("data", "solutions", solution_name, f"{solution_name}_telemetry.json")
+
+
+def _model_attr(m, name: str):
+    """A Gurobi model attribute or None, if it is not available (e.g., ObjBound of an infeasible model)."""
+    try:
+        return getattr(m, name)
+    except AttributeError:
+        return None
+
+
+def _json_default(value):
+    """Converts numpy scalars (and anything else json does not know) for json.dump."""
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+####################################
+# AGGREGATION
+####################################
+
+def load_runs(solutions_dir: str = os.path.join("data", "solutions")) -> list[dict]:
+    """
+    Loads the telemetry files of all runs in solutions_dir and flattens each into one row.
+    :param solutions_dir: Folder with one subfolder per solution.
+    :return: One dict per run with the run name, info, results, counters and 'time <phase>' columns.
+    """
+    rows = []
+    for path in sorted(glob.glob(os.path.join(solutions_dir, "*", "*_telemetry.json"))):
+        with open(path) as file:
+            telemetry = json.load(file)
+        row = {'run': os.path.basename(os.path.dirname(path))}
+        row.update(telemetry['info'])
+        row.update(telemetry['results'])
+        row.update(telemetry['counters'])
+        row.update({f"time {name}": seconds for name, seconds in telemetry['phases'].items()})
+        row['time total'] = telemetry['total_time']
+        row['trajectory points'] = len(telemetry['trajectory'])
+        rows.append(row)
+    return rows
+
+
+def print_runs(rows: list[dict]) -> None:
+    """Prints one line per run with its status, objective, bound, gap, counts and the main phase times."""
+    def number(value, digits=4):
+        return "-" if value is None else f"{value:.{digits}f}"
+
+    print(f"{'run':<28}{'mode':<12}{'status':>7}{'objective':>11}{'bound':>11}{'gap':>9}{'nodes':>9}{'cuts':>7}"
+          f"{'build':>8}{'presolve':>9}{'root':>8}{'optimize':>9}{'callback':>9}{'total':>9}")
+    for row in rows:
+        print(f"{row['run']:<28}{str(row.get('mode', '-')):<12}{str(row.get('status', '-')):>7}"
+              f"{number(row.get('objective')):>11}{number(row.get('bound')):>11}{number(row.get('gap')):>9}"
+              f"{number(row.get('node_count'), 0):>9}{row.get('lazy cuts', 0):>7}"
+              f"{number(row.get('time build'), 2):>8}{number(row.get('time presolve'), 2):>9}"
+              f"{number(row.get('time root LP'), 2):>8}{number(row.get('time optimize'), 2):>9}"
+              f"{number(row.get('time callback'), 2):>9}{number(row.get('time total'), 2):>9}")
+
+
+def write_runs(rows: list[dict], path: str) -> None:
+    """Writes the rows as csv, json or (with pandas and pyarrow) parquet file, depending on the extension of path."""
+    if path.endswith(".json"):
+        with open(path, "w") as file:
+            json.dump(rows, file, indent=2)
+        return
+
+    import pandas as pd
+    frame = pd.DataFrame(rows)
+    if path.endswith(".parquet"):
+        frame.to_parquet(path, index=False)
+    else:
+        frame.to_csv(path, index=False)
+
+
+parser = argparse.ArgumentParser(description="Aggregate the telemetry of all solver runs in data/solutions")
+parser.add_argument('-s', '--solutions', type=str, default=os.path.join("data", "solutions"),
+                    help='Folder with the solutions')
+parser.add_argument('-o', '--output', type=str, default=None, help='Also write the table to a csv, json or parquet file')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    runs = load_runs(args.solutions)
+    if not runs:
+        print(f"No telemetry found in {args.solutions}.")
+    else:
+        print_runs(runs)
+        if args.output:
+            write_runs(runs, args.output)
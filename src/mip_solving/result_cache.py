@@ -0,0 +1,163 @@
+import argparse
+import glob
+import hashlib
+import json
+import math
+import os
+import shutil
+
+from graph_utils import GraphArrays
+from preprocessing.graph_container import graph_checksum
+from solution_io import read_solution, solution_paths, write_solution
+
+"""
+Cache of solver results. An entry is keyed by a hash of the graph content (the checksum of its arrays), the area lower
+bound, the formulation mode and the solver parameters, so a changed dataset or different settings never reuse an old
+result. Entries are solution artifacts (see solution_io) in data/cache/results/<key>/, written to a temporary folder
+and renamed into place, so a crashed run never leaves an entry behind. Results of the same graph at other area lower
+bounds are offered as warm starts. Only optimal results answer a solve, a result stopped early (e.g., at the time
+limit) is a start solution for solving again and is replaced by the new result. When the cache grows beyond its size
+limit, the least recently used entries are evicted.
+"""
+
+CACHE_DIR = os.path.join("data", "cache", "results")
+DEFAULT_MAX_BYTES = 1 << 30
+OPTIMAL_STATUSES = (2, 'OPTIMAL')  # GRB.OPTIMAL and the status of the other backends (see mip_backends)
+
+
+def graph_hash(arrays: GraphArrays) -> str:
+    """Hash of the graph content."""
+    return graph_checksum(arrays._asdict())
+
+
+def is_optimal(entry: dict) -> bool:
+    """True if the cached result was solved to optimality."""
+    return entry.get('status') in OPTIMAL_STATUSES
+
+
+def cache_key(graph: str, area_lower_bound: float, mode: str, params: dict) -> str:
+    """Key of a result: hash of the graph hash, the area lower bound, the mode and the (json serializable) params."""
+    description = json.dumps({'graph': graph, 'area_lower_bound': float(area_lower_bound), 'mode': mode,
+                              'params': params}, sort_keys=True)
+    return hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+
+
+class ResultCache:
+    """
+    Result cache in a folder with one subfolder per entry. get and put work on exact keys, warm_start searches the
+    entries of the same graph for a good start solution.
+    """
+
+    def __init__(self, directory: str = CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def get(self, key: str) -> dict | None:
+        """
+        The cached result with this key (its metadata with the district FIDs in 'solution') or None. A hit marks the
+        entry as recently used.
+        """
+        json_path, _ = solution_paths(key, self.directory)
+        if not os.path.exists(json_path):
+            return None
+        metadata, fids, _ = read_solution(key, solutions_dir=self.directory)
+        os.utime(json_path)
+        return dict(metadata, solution=fids.tolist())
+
+    def put(self, key: str, solution: list[int], metadata: dict, replace: bool = False) -> None:
+        """
+        Stores a result atomically: the entry is written to a temporary folder and renamed into place. If another
+        process stored the same key in the meantime, its entry is kept.
+        :param metadata: Json serializable description of the result. 'graph', 'area_lower_bound', 'mode', 'params',
+                         'objective' and 'area' are used by warm_start.
+        :param replace: If True, an existing entry with this key (e.g., a result that was not optimal) is replaced.
+        """
+        tmp_directory = os.path.join(self.directory, f".tmp-{key}-{os.getpid()}")
+        try:
+            write_solution(key, solution, metadata, solutions_dir=tmp_directory)
+            if replace and os.path.isdir(os.path.join(self.directory, key)):
+                # move the old entry out of the way first, a reader in between sees a miss but never a mixed entry
+                os.rename(os.path.join(self.directory, key), os.path.join(tmp_directory, "replaced"))
+            try:
+                os.rename(os.path.join(tmp_directory, key), os.path.join(self.directory, key))
+            except OSError:
+                # the entry exists already
+                pass
+        finally:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+        self.evict()
+
+    def entries(self) -> list[dict]:
+        """Metadata of all entries (with their 'key')."""
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, "*", "*_solution.json")):
+            with open(path) as file:
+                entries.append(dict(json.load(file), key=os.path.basename(os.path.dirname(path))))
+        return entries
+
+    def warm_start(self, graph: str, area_lower_bound: float) -> dict | None:
+        """
+        Best start solution for the graph at the area lower bound from the results at other bounds: the best
+        result whose district reaches the area lower bound (e.g., the district found at a looser bound, if it is
+        large enough), otherwise the result at the closest looser bound (which at least seeds the bound and the
+        search, the solver checks its feasibility).
+        :return: The metadata of the entry (with 'solution'), or None if there is no result of this graph.
+        """
+        entries = [entry for entry in self.entries() if entry.get('graph') == graph]
+        feasible = [entry for entry in entries if entry.get('area', 0) >= area_lower_bound
+                    and entry.get('objective') is not None and math.isfinite(entry['objective'])]
+        if feasible:
+            best = min(feasible, key=lambda entry: entry['objective'])
+        else:
+            looser = [entry for entry in entries if entry['area_lower_bound'] <= area_lower_bound]
+            if not looser:
+                return None
+            best = max(looser, key=lambda entry: entry['area_lower_bound'])
+        return self.get(best['key'])
+
+    def size(self) -> tuple[int, list[tuple[float, int, str]]]:
+        """Total size in bytes and (last use, size, key) of every entry."""
+        total, entries = 0, []
+        for entry in os.scandir(self.directory) if os.path.isdir(self.directory) else []:
+            if not entry.is_dir() or entry.name.startswith(".tmp-"):
+                continue
+            files = list(os.scandir(entry.path))
+            size = sum(file.stat().st_size for file in files)
+            json_path, _ = solution_paths(entry.name, self.directory)
+            last_use = os.path.getmtime(json_path) if os.path.exists(json_path) else 0.0
+            entries.append((last_use, size, entry.name))
+            total += size
+        return total, entries
+
+    def evict(self) -> list[str]:
+        """
+        Removes the least recently used entries until the cache is at most max_bytes large.
+        :return: The keys of the removed entries.
+        """
+        total, entries = self.size()
+        removed = []
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            total -= size
+            removed.append(key)
+        return removed
+
+
+parser = argparse.ArgumentParser(description="Show or shrink the result cache")
+parser.add_argument('-d', '--dir', type=str, default=CACHE_DIR, help='Cache folder')
+parser.add_argument('--max-mb', type=float, default=None, help='Evict entries until the cache is at most this large')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    cache = ResultCache(args.dir)
+    if args.max_mb is not None:
+        cache.max_bytes = int(args.max_mb * 2 ** 20)
+        for evicted in cache.evict():
+            print(f"Evicted {evicted}")
+    for cached in sorted(cache.entries(), key=lambda entry: (entry.get('dataset', ''), entry['area_lower_bound'])):
+        print(f"{cached['key']}  {cached.get('dataset', '-'):<14}{cached['area_lower_bound']:>12g}  "
+              f"{cached['mode']:<12}{str(cached.get('status', '-')):<12}objective {cached.get('objective')}")
+    total_bytes, _ = cache.size()
+    print(f"{total_bytes / 2 ** 20:.2f} MB in {args.dir}")
@@ -0,0 +1,200 @@
+import argparse
+import glob
+import json
+import os
+import re
+
+import numpy as np
+
+"""
+Structured solution artifacts. A solution is stored in data/solutions/<name>/ as
+    <name>_solution.json  metadata (dataset, suffix, objective, Polsby-Popper score, area, perimeter, status, size)
+    <name>_solution.npz   compressed arrays: 'fids' (sorted FIDs of the district) and, optionally, the variable
+                          vectors of the model (e.g., 'x' and 'y' with the FIDs of their nodes and arcs)
+Both files are written atomically, the npz file first, so a json file always belongs to a complete solution.
+Plotting and warm starts read the district from here instead of parsing the text summary. Solutions written before
+these artifacts existed only have the <name>.txt summary, read_solution falls back to it.
+"""
+
+FORMAT_VERSION = 1
+
+
+def solution_paths(solution_name: str, solutions_dir: str = os.path.join("data", "solutions")) -> tuple[str, str]:
+    """Paths of the json metadata and the npz arrays of the solution with the given name."""
+    base = os.path.join(solutions_dir, solution_name, solution_name)
+    return base + "_solution.json", base + "_solution.npz"
+
+
+def write_solution(solution_name: str, solution: list[int], metadata: dict,
+                   variables: dict[str, np.ndarray] | None = None,
+                   solutions_dir: str = os.path.join("data", "solutions")) -> None:
+    """
+    Writes the solution artifact.
+    :param solution_name: Name of the solution (e.g., 'issoire_LB=1000000.0').
+    :param solution: FIDs of the district.
+    :param metadata: Json serializable description of the solution (objective, area, perimeter, status, ...).
+    :param variables: Optional arrays stored next to the district (e.g., all x and y values of the model).
+    """
+    json_path, npz_path = solution_paths(solution_name, solutions_dir)
+    os.makedirs(os.path.dirname(json_path), exist_ok=True)
+
+    fids = np.unique(np.asarray(solution, dtype=np.int64))
+    arrays = dict(variables or {})
+    arrays['fids'] = fids
+    # np.savez_compressed appends .npz to names without that extension
+    with open(npz_path + ".tmp", "wb") as file:
+        np.savez_compressed(file, **arrays)
+    os.replace(npz_path + ".tmp", npz_path)
+
+    header = {'version': FORMAT_VERSION, 'solution_name': solution_name, 'district_size': len(fids),
+              'variables': sorted(variables or {})}
+    header.update(metadata)
+    with open(json_path + ".tmp", "w") as file:
+        json.dump(header, file, indent=2, default=lambda value: value.item() if hasattr(value, 'item') else str(value))
+    os.replace(json_path + ".tmp", json_path)
+
+
+def save_solution_summary(solution: list[int], pp_inverse: float, area: float, perimeter: float, status,
+                          dataset_name: str, file_suffix: str = None,
+                          variables: dict[str, np.ndarray] | None = None) -> None:
+    """
+    Print the summary of a district and save it as text summary and as solution artifact (see solution_io).
+    Used for all solvers, so their results can be compared with each other.
+    :param solution: List of the nodes in the district.
+    :param pp_inverse: Inverse Polsby-Popper score of the district.
+    :param area: Area of the district.
+    :param perimeter: Perimeter of the district.
+    :param status: Status of the solver.
+    :param dataset_name: Name of the dataset.
+    :param file_suffix: Suffix of the solution name (e.g., '_LB=1000000.0').
+    :param variables: Optional variable vectors stored in the solution artifact.
+    """
+    file_suffix = file_suffix or ""
+    output_summary = []
+    output_summary.append("######Solution summary######")
+    output_summary.append(f"District nodes: {solution}")
+    output_summary.append(f"Suffix: {file_suffix if file_suffix else '-None-'}")
+    output_summary.append(f"Polsby-Popper score: {'infinity' if pp_inverse == 0 else f'{1 / pp_inverse:.4f}'}")
+    output_summary.append(f"Inverse Polsby-Popper score (Objective value): {pp_inverse:.4f}")
+    output_summary.append(f"Area: {area:.4f}")
+    output_summary.append(f"Perimeter: {perimeter:.4f}")
+    output_summary.append(f"Model status: {status}")  # Print the model status
+
+    solution_name = f"{dataset_name}{file_suffix}"
+    write_solution(solution_name, solution, {
+        'dataset': dataset_name, 'suffix': file_suffix, 'objective': pp_inverse,
+        'polsby_popper': 1 / pp_inverse if pp_inverse > 0 else None, 'area': area, 'perimeter': perimeter,
+        'status': status}, variables)
+
+    # Save the output string to a file. The file is written to a temporary path first and then renamed, so a
+    # crashed run never leaves a half-written solution file behind (its existence marks the solution as complete).
+    # It is written after the solution artifact, so a complete solution always has both.
+    solutions_path = os.path.join("data", "solutions", solution_name, f"{solution_name}.txt")
+    os.makedirs(os.path.dirname(solutions_path), exist_ok=True)
+    with open(solutions_path + ".tmp", "w") as file:
+        file.write("\n".join(output_summary))
+    os.replace(solutions_path + ".tmp", solutions_path)
+
+    # Print only the solution summary to the console
+    print("\n".join(output_summary))
+
+
+def read_solution(solution_name: str, variables: bool = False,
+                  solutions_dir: str = os.path.join("data", "solutions")) -> tuple[dict, np.ndarray, dict]:
+    """
+    Reads a solution artifact, or the text summary of a solution written before the artifacts existed.
+    :param variables: If True, also load the stored variable vectors.
+    :return: The metadata, the sorted FIDs of the district and the variable vectors (empty if not requested).
+    :raises FileNotFoundError: If there is no solution with this name.
+    """
+    json_path, npz_path = solution_paths(solution_name, solutions_dir)
+    if not os.path.exists(json_path):
+        metadata, fids = read_solution_summary(os.path.join(solutions_dir, solution_name, f"{solution_name}.txt"))
+        return metadata, fids, {}
+
+    with open(json_path) as file:
+        metadata = json.load(file)
+    with np.load(npz_path) as data:
+        fids = data['fids']
+        arrays = {key: data[key] for key in data.files if key != 'fids'} if variables else {}
+    return metadata, fids, arrays
+
+
+def read_solution_summary(path: str) -> tuple[dict, np.ndarray]:
+    """
+    Parses the text summary written by save_solution_summary (only its summary lines, a variable dump after them is
+    skipped without being parsed).
+    :return: The metadata and the sorted FIDs of the district.
+    """
+    metadata = {}
+    fids = np.zeros(0, dtype=np.int64)
+    keys = {"Inverse Polsby-Popper score (Objective value)": 'objective', "Polsby-Popper score": 'polsby_popper',
+            "Area": 'area', "Perimeter": 'perimeter', "Model status": 'status', "Suffix": 'suffix'}
+    with open(path) as file:
+        for line in file:
+            if line.startswith("######All Variables"):
+                break
+            key, _, value = line.rstrip("\n").partition(": ")
+            if key == "District nodes":
+                fids = np.unique(np.array(re.findall(r'-?\d+', value), dtype=np.int64))
+            elif key in keys:
+                metadata[keys[key]] = _parse_value(value)
+    if metadata.get('suffix') == '-None-':
+        metadata['suffix'] = ""
+    metadata['district_size'] = len(fids)
+    return metadata, fids
+
+
+def _parse_value(value: str):
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def district_indices(fids: np.ndarray, solution: np.ndarray) -> np.ndarray:
+    """
+    Node indices of the district in a graph with the given node FIDs (e.g., GraphArrays.fids), for warm starts.
+    Nodes of a reduced graph are identified by the FID of their first member, so a merged node belongs to the
+    district if that member does.
+    """
+    return np.flatnonzero(np.isin(fids, solution))
+
+
+def convert_legacy_solutions(solutions_dir: str = os.path.join("data", "solutions"), strip: bool = False) -> list[str]:
+    """
+    Writes the artifact of every solution that only has a text summary. With strip, the variable dump is removed
+    from the text summary afterwards.
+    :return: The names of the converted solutions.
+    """
+    converted = []
+    for path in sorted(glob.glob(os.path.join(solutions_dir, "*", "*.txt"))):
+        solution_name = os.path.basename(os.path.dirname(path))
+        if os.path.basename(path) != f"{solution_name}.txt" or os.path.exists(solution_paths(solution_name,
+                                                                                              solutions_dir)[0]):
+            continue
+        metadata, fids = read_solution_summary(path)
+        write_solution(solution_name, fids.tolist(), metadata, solutions_dir=solutions_dir)
+        if strip:
+            with open(path) as file:
+                lines = file.read().split("\n######All Variables######")[0]
+            with open(path + ".tmp", "w") as file:
+                file.write(lines)
+            os.replace(path + ".tmp", path)
+        converted.append(solution_name)
+    return converted
+
+
+parser = argparse.ArgumentParser(description="Write solution artifacts for solutions that only have a text summary")
+parser.add_argument('-s', '--solutions', type=str, default=os.path.join("data", "solutions"),
+                    help='Folder with the solutions')
+parser.add_argument('--strip', action='store_true', help='Remove the variable dump from the text summaries')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    for name in convert_legacy_solutions(args.solutions, args.strip):
+        print(f"Converted {name}")
@@ -1,55 +1,312 @@
+import argparse
 import os
+import time
+from multiprocessing import Pool, cpu_count
 
-from graph_utils import read_graph_from_dataset, print_graph
-from mip_solver import solve_single_district_mip, print_and_save_solution
-from solution_plotting.solution_plotter import plot_shapefile_with_highlights
+from graph_utils import get_graph_arrays, read_graph_from_dataset, print_graph
+from mip_backends import BACKENDS, BackendResult, solve_with_backend
+from mip_telemetry import RunTelemetry, telemetry_path
+from result_cache import ResultCache, cache_key, graph_hash, is_optimal
+from solution_io import read_solution, save_solution_summary
 
+# mip_rooted and mip_solver import gurobipy, they are imported in the branches that solve with Gurobi, so the HiGHS
+# backend (and --help) runs without it
 
-def solve(dataset_name: str, area_lower_bound: float = 0):
+
+# Gurobi parameters of every model solve builds (see build_single_district_mip), part of the cache key of every result
+SOLVER_PARAMS = {'TimeLimit': 3600, 'MIPGap': 0.0, 'FeasibilityTol': 1e-7, 'IntFeasTol': 1e-7}
+
+
+def get_solution_name(dataset_name: str, area_lower_bound: float = 0) -> str:
+    """
+    Name of the solution folder (and files) for the given dataset and area lower bound.
+    :param dataset_name: Name of the dataset (e.g., 'issoire').
+    :param area_lower_bound: Area lower bound for the district.
+    :return: The solution name, e.g. 'issoire' or 'issoire_LB=1000000.0'.
+    """
+    return f"{dataset_name}{'_LB=' + str(area_lower_bound) if area_lower_bound > 0 else ''}"
+
+
+def is_solution_complete(solution_name: str) -> bool:
+    """
+    Check if the solution with the given name was completely written to data/solutions.
+    The solution folder itself is created before solving starts (for the Gurobi log), so only the solution file,
+    which is written atomically after solving finished, marks the solution as done.
+    :param solution_name: Name of the solution (see get_solution_name).
+    :return: True if the solution file exists.
+    """
+    return os.path.exists(os.path.join("data", "solutions", solution_name, f"{solution_name}.txt"))
+
+
+def solve(dataset_name: str, area_lower_bound: float = 0, threads: int = 1, plot: bool = True, user_cuts: bool = False,
+          rooted: bool = False, warm_start: bool = True, backend: str = "gurobi", fractional: str | None = None,
+          start_from: str | None = None, use_cache: bool = True, backend_options: dict | None = None,
+          processes: int | None = None):
     """
     Solve the single district MIP model for the given dataset.
     :param dataset_name: Name of the dataset (e.g., 'issoire').
     :param area_lower_bound: Area lower bound for the district.
+    :param threads: Number of threads Gurobi may use.
+    :param plot: If True, render the solution (headless, PNG next to the solution).
+    :param user_cuts: If True, also separate contiguity cuts from fractional solutions.
+    :param rooted: If True, solve one rooted subproblem per candidate root in a pool of 'processes' worker processes
+                   with one Gurobi thread each (see solve_rooted_decomposition). No model is returned in this mode.
+    :param warm_start: If True, seed Gurobi with a district found by the heuristic of mip_heuristic.
+    :param backend: Solver backend (see mip_backends). Other backends than 'gurobi' return their BackendResult
+                    instead of the Gurobi model.
+    :param fractional: If 'dinkelbach' or 'bisection', solve the Gurobi model as fractional program with this method
+                       (see solve_single_district_fractional) instead of the MISOCP.
+    :param start_from: Optional name of a solution (see solution_io) whose district is used as start solution of the
+                       Gurobi model, e.g. the solution of the same dataset at a smaller area lower bound.
+    :param use_cache: If True, return the cached optimal result (see result_cache) of the same graph content, bound,
+                      mode and parameters instead of solving again, start from a cached result that is not optimal or
+                      from the cached result at the nearest other bound, and cache the new result.
+    :param backend_options: Options of a backend other than 'gurobi' (see mip_backends.get_backend).
+    :param processes: Number of worker processes of the rooted decomposition. Defaults to the number of CPUs.
     :return: A tuple containing the solution (list of nodes in the district) and the Gurobi model object.
+    The telemetry of the run (see mip_telemetry) is written next to the solution.
     """
 
-    # Check if the solution folder already exists
-    solution_name = f"{dataset_name}{'_LB=' + str(area_lower_bound) if area_lower_bound > 0 else ''}"
-    solution_folder = f"data/solutions/{solution_name}"
-    if os.path.exists(solution_folder):
-        print(f"Solution folder '{solution_name}' already exists. Skipping solving for {dataset_name}.")
-        return None, None
+    solution_name = get_solution_name(dataset_name, area_lower_bound)
+    mode = "rooted" if rooted else backend if backend != "gurobi" else fractional or "misocp"
+    telemetry = RunTelemetry(dataset=dataset_name, area_lower_bound=area_lower_bound, mode=mode, backend=backend,
+                             threads=threads, user_cuts=user_cuts, warm_start=warm_start)
 
     # Load the graph from the 'issoire' dataset
-    graph = read_graph_from_dataset(dataset_name)
+    with telemetry.phase('load'):
+        graph = read_graph_from_dataset(dataset_name)
 
     # print_graph(graph)
 
     graph.graph['dataset_name'] = dataset_name
     graph.graph['area_lower_bound'] = area_lower_bound
 
-    solution, m = solve_single_district_mip(graph, area_lower_bound)
-
     file_suffix = f"_LB={area_lower_bound}" if area_lower_bound > 0 else ""
+    start_solution = read_solution(start_from)[1].tolist() if start_from is not None else None
+
+    # The parameters the result depends on, the same dict is passed to the solver and hashed into the cache key
+    if backend != "gurobi" and not rooted:
+        solver_params = {'time_limit': SOLVER_PARAMS['TimeLimit'], **(backend_options or {})}
+    else:
+        solver_params = dict(SOLVER_PARAMS)
+
+    # Check if the result was already computed for this graph content, bound, mode and parameters
+    cache, cache_entry = None, None
+    if use_cache:
+        cache = ResultCache()
+        graph_id = graph_hash(get_graph_arrays(graph))
+        params = dict(solver_params, backend=backend, user_cuts=user_cuts, warm_start=warm_start)
+        key = cache_key(graph_id, area_lower_bound, mode, params)
+        cached = cache.get(key)
+        if cached is not None and is_optimal(cached):
+            print(f"Solution '{solution_name}' is cached ({key}). Skipping solving for {dataset_name}.")
+            if not is_solution_complete(solution_name):
+                save_solution_summary(cached['solution'], cached['objective'], cached['area'], cached['perimeter'],
+                                      cached['status'], dataset_name, file_suffix)
+            return cached['solution'], None
+        if cached is not None:
+            # a result that is not optimal is only a start solution (of the Gurobi model)
+            print(f"Cached result ({key}) has status {cached['status']}, solving again.")
+            if start_solution is None:
+                start_solution = cached['solution']
+        cache_entry = (key, {'dataset': dataset_name, 'graph': graph_id, 'area_lower_bound': area_lower_bound,
+                             'mode': mode, 'params': params})
+
+        # Seed the Gurobi model with the best cached district of the same graph at another bound
+        if start_solution is None and warm_start and not rooted and backend == "gurobi":
+            near = cache.warm_start(graph_id, area_lower_bound)
+            if near is not None:
+                print(f"Warm start from the cached result at area lower bound {near['area_lower_bound']}")
+                start_solution = near['solution']
+
+    if rooted:
+        from mip_rooted import solve_rooted_decomposition
+        with telemetry.phase('optimize'):
+            solution, best, _ = solve_rooted_decomposition(graph, area_lower_bound, processes=processes,
+                                                           time_limit=solver_params['TimeLimit'],
+                                                           params=solver_params)
+        if solution is None:
+            print("ERROR: !!!No district was found by the rooted decomposition.!!!")
+            telemetry.save(telemetry_path(solution_name))
+            return None, None
+        telemetry.record_result(status=best['status'], objective=best['objective'])
+        summary = best['objective'], best['area'], best['perimeter'], best['status']
+        save_solution_summary(solution, *summary, dataset_name, file_suffix)
+        m = None
+    elif backend != "gurobi":
+        m = solve_with_backend(graph, area_lower_bound, backend=backend, threads=threads, warm_start=warm_start,
+                               **solver_params)
+        telemetry.add_phase('optimize', m.runtime)
+        telemetry.counters['lazy cuts'] = m.num_lazy_cuts
+        telemetry.record_result(status=m.status, objective=m.objective, bound=m.bound, node_count=m.node_count)
+        solution = m.solution
+        if solution is None:
+            print(f"ERROR: !!!No district was found by the {backend} backend.!!!")
+            telemetry.save(telemetry_path(solution_name))
+            return None, m
+        summary = m.objective, m.area, m.perimeter, m.status
+        save_solution_summary(solution, *summary, dataset_name, file_suffix)
+    elif fractional is not None:
+        from mip_solver import solve_single_district_fractional, print_and_save_solution, inverse_polsby_popper_score, \
+            model_status
+        solution, m = solve_single_district_fractional(graph, area_lower_bound, threads=threads, user_cuts=user_cuts,
+                                                       warm_start=warm_start, method=fractional, telemetry=telemetry,
+                                                       start_solution=start_solution, params=solver_params)
+        if solution is None:
+            telemetry.save(telemetry_path(solution_name))
+            return None, m
+        with telemetry.phase('save'):
+            print_and_save_solution(m, solution, dataset_name, file_suffix=file_suffix)
+        summary = inverse_polsby_popper_score(m), m._A.X, m._P.X, model_status(m)
+    else:
+        from mip_solver import solve_single_district_mip, print_and_save_solution, inverse_polsby_popper_score, \
+            model_status
+        solution, m = solve_single_district_mip(graph, area_lower_bound, threads=threads, user_cuts=user_cuts,
+                                                 warm_start=warm_start, telemetry=telemetry,
+                                                 start_solution=start_solution, params=solver_params)
+        with telemetry.phase('save'):
+            print_and_save_solution(m, solution, dataset_name, file_suffix=file_suffix)
+        summary = inverse_polsby_popper_score(m), m._A.X, m._P.X, model_status(m)
+
+    if cache is not None:
+        key, metadata = cache_entry
+        objective, area, perimeter, status = summary
+        cache.put(key, solution, dict(metadata, objective=objective, area=area, perimeter=perimeter, status=status),
+                  replace=True)
 
-    print_and_save_solution(m, solution, dataset_name, file_suffix=file_suffix)
+    if plot:
+        # geopandas and matplotlib are only imported when a solution is plotted
+        from solution_plotting.solution_plotter import render_solution
+        with telemetry.phase('plot'):
+            render_solution(dataset_name, file_suffix=file_suffix)
 
-    plot_shapefile_with_highlights(dataset_name, highlight_color="red", base_color="lightblue", marker_color="orange", file_suffix=file_suffix)
+    telemetry.record_result(district_size=len(solution))
+    telemetry.save(telemetry_path(solution_name))
 
     return solution, m
 
 
+def _solve_job(job: tuple[str, float, int, bool, bool, bool, str, str | None, bool, int | None]) -> dict:
+    """
+    Solve a single (dataset, area lower bound) job of a batch in a worker process.
+    Models can not be sent between processes, so only a small summary is returned.
+    """
+    dataset_name, area_lower_bound, threads, plot, user_cuts, warm_start, backend, fractional, rooted, processes = job
+    start = time.time()
+    try:
+        solution, m = solve(dataset_name, area_lower_bound, threads=threads, plot=plot, user_cuts=user_cuts,
+                            warm_start=warm_start, backend=backend, fractional=fractional, rooted=rooted,
+                            processes=processes)
+    except Exception as e:
+        # One failing job must not abort the whole sweep, the job is simply solved again on the next run
+        return {"solution_name": get_solution_name(dataset_name, area_lower_bound), "error": repr(e)}
+
+    result = {"solution_name": get_solution_name(dataset_name, area_lower_bound), "time": time.time() - start}
+    if isinstance(m, BackendResult):
+        result["status"] = m.status
+        result["objective"] = m.objective
+        result["district_size"] = len(solution) if solution is not None else 0
+        result["node_count"] = m.node_count
+    elif m is not None:
+        from mip_solver import inverse_polsby_popper_score, model_status
+        result["status"] = model_status(m)
+        result["objective"] = inverse_polsby_popper_score(m) if solution is not None else None
+        result["district_size"] = len(solution) if solution is not None else 0
+        result["node_count"] = m.NodeCount if m._z is not None else sum(
+            iteration['node_count'] for iteration in m._fractionalIterations)
+        result["first_incumbent_time"] = m._firstIncumbentTime
+    return result
+
+
+def solve_batch(jobs: list[tuple[str, float]], processes: int | None = None, threads_per_job: int = 1,
+                plot: bool = False, user_cuts: bool = False, warm_start: bool = True,
+                backend: str = "gurobi", fractional: str | None = None, rooted: bool = False,
+                resolve: bool = False) -> list[dict]:
+    """
+    Solve a grid of (dataset, area lower bound) jobs in a process pool.
+    Every finished job is written to data/solutions/ and the result cache right away, so an interrupted batch can
+    simply be restarted: jobs whose solution is already complete are skipped, also if it is not optimal (e.g., hit
+    the time limit), and the workers answer jobs with an optimal cached result from the cache.
+    :param jobs: List of (dataset name, area lower bound) tuples.
+    :param processes: Number of worker processes. Defaults to the number of CPUs divided by threads_per_job.
+    :param threads_per_job: Number of threads Gurobi may use in each job.
+    :param plot: If True, plot every solution (headless PNGs, off by default for batch runs).
+    :param user_cuts: If True, also separate contiguity cuts from fractional solutions.
+    :param warm_start: If True, seed Gurobi with a district found by the heuristic of mip_heuristic.
+    :param backend: Solver backend (see mip_backends).
+    :param fractional: Fractional method for the Gurobi model (see solve), None solves the MISOCP.
+    :param rooted: If True, solve every job with the rooted decomposition (see solve). Its worker pool can not be
+                   started from a worker of the batch pool, so the jobs are solved one after another, each with
+                   'processes' workers.
+    :param resolve: If True, also solve jobs whose solution is complete. Only an optimal cached result is reused, a
+                    cached result that is not optimal is the start solution of the new solve.
+    :return: A list with a summary dict per solved job (in the order the jobs finished).
+    """
+    # Skip jobs that were already solved in an earlier run
+    open_jobs = []
+    for dataset_name, area_lower_bound in jobs:
+        solution_name = get_solution_name(dataset_name, area_lower_bound)
+        if not resolve and is_solution_complete(solution_name):
+            print(f"Solution '{solution_name}' already exists. Skipping.")
+        else:
+            open_jobs.append((dataset_name, area_lower_bound, threads_per_job, plot, user_cuts, warm_start, backend,
+                              fractional, rooted, processes if rooted else None))
+
+    if not open_jobs:
+        return []
+
+    def report(result: dict) -> dict:
+        if "error" in result:
+            print(f"FAILED {result['solution_name']}: {result['error']}")
+        else:
+            print(f"Finished {result['solution_name']} in {result['time']:.1f}s.")
+        return result
+
+    if rooted:
+        print(f"Solving {len(open_jobs)} jobs one after another with the rooted decomposition...")
+        return [report(_solve_job(job)) for job in open_jobs]
+
+    if processes is None:
+        processes = max(1, cpu_count() // threads_per_job)
+    processes = min(processes, len(open_jobs))
+    print(f"Solving {len(open_jobs)} jobs with {processes} processes and {threads_per_job} thread(s) per job...")
+
+    # maxtasksperchild=1 gives every job a fresh process (and Gurobi environment)
+    results = []
+    with Pool(processes, maxtasksperchild=1) as pool:
+        for result in pool.imap_unordered(_solve_job, open_jobs):
+            results.append(report(result))
+
+    return results
+
+
+parser = argparse.ArgumentParser(description="Solve the single district MIP for a grid of datasets and area lower bounds")
+parser.add_argument('-d', '--datasets', nargs='+', default=None,
+                    help='Datasets to solve (default: all datasets, with an additional job avignon at 1e-4)')
+parser.add_argument('-l', '--lower-bounds', type=float, nargs='+', default=None,
+                    help='Area lower bounds of every dataset (default: 0 and 1e6)')
+parser.add_argument('-p', '--processes', type=int, default=None,
+                    help='Number of worker processes (of the batch, or of every rooted decomposition with --rooted)')
+parser.add_argument('-t', '--threads', type=int, default=1, help='Number of Gurobi threads per job')
+parser.add_argument('--plot', action='store_true', help='Plot every solution after solving')
+parser.add_argument('--user-cuts', action='store_true', help='Separate contiguity cuts from fractional solutions')
+parser.add_argument('--no-warm-start', action='store_true', help='Do not seed Gurobi with a heuristic district')
+parser.add_argument('--backend', choices=list(BACKENDS), default='gurobi', help='Solver backend')
+parser.add_argument('--fractional', choices=['dinkelbach', 'bisection'], default=None,
+                    help='Solve the Gurobi model as fractional program P^2/A with this method instead of the MISOCP')
+parser.add_argument('--rooted', action='store_true',
+                    help='Solve one rooted subproblem per candidate root in a worker pool (jobs one after another)')
+parser.add_argument('--resolve', action='store_true',
+                    help='Also solve jobs whose solution already exists (e.g., to continue time-limited results)')
+
 if __name__ == '__main__':
-    datasets = ["issoire", "avignon", "braunschweig", "karlsruhe", "neumuenster","rheinruhr"]
-    for dataset in datasets:
-        print(f"Solving {dataset}...")
-        solve(dataset, area_lower_bound=0)
-        solve(dataset, area_lower_bound=1e6)
-        print(f"Finished solving {dataset}.\n")
-    # solve("avignon", area_lower_bound=1e6)
-    solve("avignon", area_lower_bound=1e-4)
-    # solve("avignon")
-    # solve("braunschweig")
-    # solve("karlsruhe")
-    # solve("neumuenster")
-    # solve("rheinruhr")
+    args = parser.parse_args()
+
+    datasets = args.datasets or ["issoire", "avignon", "braunschweig", "karlsruhe", "neumuenster","rheinruhr"]
+    jobs = [(dataset, area_lower_bound) for dataset in datasets for area_lower_bound in (args.lower_bounds or (0, 1e6))]
+    if args.datasets is None and args.lower_bounds is None:
+        jobs.append(("avignon", 1e-4))
+
+    solve_batch(jobs, processes=args.processes, threads_per_job=args.threads, plot=args.plot, user_cuts=args.user_cuts,
+                warm_start=not args.no_warm_start, backend=args.backend, fractional=args.fractional, rooted=args.rooted,
+                resolve=args.resolve)
@@ -1,20 +1,16 @@
 import argparse
+import functools
+import time
+from multiprocessing import Pool
 
-from libpysal import weights
-import libpysal
-import matplotlib
-
-matplotlib.use('TkAgg')  # Use a standard backend (for pycharm)
-import matplotlib.pyplot as plt
-import networkx as nx
-import geopandas
 import numpy as np
-import itertools
-import pandas as pd
+import shapely
 
-import argparse
 import os
 
+from geometry_store import load_geometry
+from graph_container import arrays_from_edge_list, write_graph_container
+
 
 def writeGraphToCsv(graph, filename, ids=None):
     """Write a weighted NetworkX graph to a file using all attributes of the
@@ -57,15 +53,40 @@ def writeGraphToCsv(graph, filename, ids=None):
             file.write("\n")
 
 
-def visualizeGraph(graph, subdivision, dataset_name):
-    """Visualize a connectivity graph of a planar subdivision with vertex IDs matching those in _vertices.txt."""
+def writeGraphContainer(graph, filename):
+    """Write a weighted NetworkX graph (with the FID and area attributes of the nodes) to the binary graph container
+    filename + "_graph.bin", with the same vertices and edges as the csv files of writeGraphToCsv.
+    """
+    fids = np.array([fid for _, fid in graph.nodes(data="FID")], dtype=np.int64)
+    areas = np.array([area for _, area in graph.nodes(data="area")], dtype=float)
+    fid_of = dict(zip(graph.nodes, fids.tolist()))
+    edges = list(graph.edges(data="weight"))
+    arrays = arrays_from_edge_list(fids, areas, np.array([fid_of[u] for u, _, _ in edges], dtype=np.int64),
+                                   np.array([fid_of[v] for _, v, _ in edges], dtype=np.int64),
+                                   np.array([w for _, _, w in edges], dtype=float), source=filename)
+    write_graph_container(filename + "_graph.bin", arrays,
+                          metadata={'dataset': os.path.basename(filename), 'source': 'shapefile'})
+
+
+def visualizeGraph(graph, subdivision, dataset_name, filename=None, centroids=None):
+    """Visualize a connectivity graph of a planar subdivision with vertex IDs matching those in _vertices.txt.
+    If a filename is given, the figure is rendered headless (Agg backend) and saved to that file.
+    The centroids of the polygons (n x 2) are computed from the subdivision if not given.
+    """
+    # matplotlib is only needed for plotting, import it here so preprocessing works without a display
+    import matplotlib
+    import networkx as nx
+    if filename is not None:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
 
     # Use the same IDs as in writeGraphToTxt (first column of subdivision)
     ids = subdivision.iloc[:, 0].values
     id_map = dict(zip(graph.nodes, ids))
 
     # extract the centroids for connecting the regions
-    centroids = np.column_stack((subdivision.centroid.x, subdivision.centroid.y))
+    if centroids is None:
+        centroids = np.column_stack((subdivision.centroid.x, subdivision.centroid.y))
     # Only assign positions to nodes that correspond to actual polygons (not -1)
     positions = {node: (x, y) for node, (x, y) in zip(graph.nodes, centroids) if node != -1}
 
@@ -82,48 +103,117 @@ def visualizeGraph(graph, subdivision, dataset_name):
     # draw a title
     ax.set_title(f"Connectivity Graph of {dataset_name}", fontsize=16, pad=20)
 
+    if filename is not None:
+        ax.figure.savefig(filename, bbox_inches="tight")
+        plt.close(ax.figure)
 
-def processDataset(dataset_path):
-    dataset_name = dataset_path.split("/")[-1]  # Get the last part of the path as dataset name
 
-    path = os.path.join("data", "shape", f"{dataset_path}.shp")
+def _sharedLengthsOfChunk(chunk):
+    """Shared boundary lengths of one chunk of neighbor pairs, run in a worker process. The chunk holds the WKB of the
+    geometries it needs and the pairs as indices into them.
+    """
+    wkb, sources, targets = chunk
+    geometries = shapely.from_wkb(wkb)
+    return shapely.length(shapely.intersection(geometries[sources], geometries[targets]))
+
 
-    subdivision = geopandas.read_file(path)
+def computeSharedLengths(geometries, rook, pool=None, chunks=1):
+    """Compute the length of the shared boundary of every pair of rook neighbors (each pair only once, from the
+    smaller to the larger id) with one vectorized intersection.
+    With a pool and more than one chunk, the pairs are split into spatial chunks (strips ordered by the x coordinate
+    of the source centroid) that are intersected in the worker processes.
+    """
+    # Iterate over all nodes of the connectivity, only select neighbors with id greater than source
+    pairs = [(source, target) for source in rook.id_order for target in rook.neighbors[source] if target > source]
+    sources = np.array([source for source, _ in pairs], dtype=int)
+    targets = np.array([target for _, target in pairs], dtype=int)
+
+    if pool is None or chunks <= 1 or len(pairs) == 0:
+        # Lengths of the shared edges between the polygons and their neighbors
+        lengths = shapely.length(shapely.intersection(geometries[sources], geometries[targets]))
+        return sources, targets, lengths
+
+    # Neighboring pairs end up in the same chunk, so every chunk only ships the geometries of one strip
+    order = np.argsort(shapely.get_x(shapely.centroid(geometries))[sources], kind="stable")
+    parts = [part for part in np.array_split(order, chunks) if len(part) > 0]
+    tasks = []
+    for part in parts:
+        ids, local = np.unique(np.concatenate((sources[part], targets[part])), return_inverse=True)
+        tasks.append((shapely.to_wkb(geometries[ids]), local[:len(part)], local[len(part):]))
+
+    lengths = np.empty(len(pairs))
+    for part, part_lengths in zip(parts, pool.map(_sharedLengthsOfChunk, tasks)):
+        lengths[part] = part_lengths
+    return sources, targets, lengths
+
+
+def computeExteriorLengths(geometries, exterior, tree=None):
+    """Compute the length of the boundary every polygon shares with the exterior (the boundary of the union of all
+    polygons). Returns the ids of the polygons that touch the exterior and the lengths.
+    """
+    # Only polygons near the exterior are tested exactly, the STRtree filters the others by their bounding boxes
+    if tree is None:
+        tree = shapely.STRtree(geometries)
+    touching = np.sort(tree.query(exterior, predicate="touches"))
+    # Use the length of the shared boundary with the exterior as weight
+    lengths = shapely.length(shapely.intersection(shapely.boundary(geometries[touching]), exterior))
+    return touching, lengths
+
+
+def processDataset(dataset_path, shape_dir=os.path.join("data", "shape"), plot=False, pool=None, chunks=1,
+                   formats=("csv", "binary")):
+    """Build the adjacency graph of the shapefile {shape_dir}/{dataset_path}.shp and write it to
+    data/graphs/{dataset_name}. Returns the time spent in every stage.
+    The geometry is loaded from its geometry store (see geometry_store), which is only built from the shapefile on
+    the first run or after the shapefile changed.
+
+    :param dataset_path: Path of the shapefile relative to shape_dir without the extension, or a dataset name
+    :param shape_dir: Directory containing the shapefiles
+    :param plot: If True, save a plot of the graph to data/graphs/{dataset_name}/{dataset_name}_graph.png
+    :param pool: Optional process pool for computing the shared boundary lengths in chunks
+    :param chunks: Number of spatial chunks for the shared boundary lengths (only used with a pool)
+    :param formats: Output formats, "csv" for the _vertices.csv and _edges.csv files, "binary" for the graph container
+    :return: Dict with the time in seconds of every stage
+    """
+    # libpysal and networkx take long to import, only load them when a dataset is processed (not for --help or in
+    # idle workers)
+    from libpysal import weights
+    import networkx as nx
+
+    dataset_name = dataset_path.split("/")[-1]  # Get the last part of the path as dataset name
+    timings = {}
+    stage_start = time.perf_counter()
+
+    def finishStage(stage):
+        nonlocal stage_start
+        now = time.perf_counter()
+        timings[stage] = now - stage_start
+        stage_start = now
+
+    store = load_geometry(dataset_path, shape_dir)
+    subdivision = store.to_geodataframe()
+    finishStage("read")
     # print(subdivision.crs)
     rook = weights.Rook.from_dataframe(subdivision)
+    finishStage("rook")
 
-    shared = []
-    # Iterate over all nodes of the connectivity
-    for source in rook.id_order:
-        # First geometry
-        poly1 = subdivision.geometry[source]
-        # Ids of neighbors as array
-        neighbor_ids = np.array(rook.neighbors[source], dtype=int)
-        # Only select neighbors with id greater than source (use only one direction)
-        neighbor_ids = neighbor_ids[neighbor_ids > source]
-        # Skip if no neighbors left
-        if neighbor_ids.size == 0:
-            continue
-        # Get the geometries of the neighbors
-        neighbors = subdivision.geometry[neighbor_ids]
-        # Lengths of the shared edges between the first poly and its neighbors
-        dist = poly1.intersection(neighbors).length
-        # Save the adjacencies
-        for n, d in dist.items():
-            shared.append([source, n, d])
+    geometries = store.geometries
+
+    sources, targets, lengths = computeSharedLengths(geometries, rook, pool=pool, chunks=chunks)
+    # Save the adjacencies
+    shared = list(zip(sources.tolist(), targets.tolist(), lengths.tolist()))
+    finishStage("shared lengths")
 
     # Add the outside as a vertex with id -1
     outside_idx = subdivision.shape[0]  # Use the next free index as outside vertex
     # Find polygons that touch the exterior (boundary of the union of all polygons)
-    union_geom = subdivision.unary_union
-    exterior = union_geom.boundary
-    for idx, poly in subdivision.iterrows():
-        # If the polygon touches the exterior, add an edge to the outside vertex
-        if poly.geometry.touches(exterior):
-            # Use the length of the shared boundary with the exterior as weight
-            shared_length = poly.geometry.boundary.intersection(exterior).length
-            if shared_length > 0:
-                shared.append([outside_idx, idx, shared_length])
+    exterior = store.exterior
+    shapely.prepare(exterior)
+    touching, exterior_lengths = computeExteriorLengths(geometries, exterior, store.tree)
+    # If the polygon touches the exterior, add an edge to the outside vertex
+    shared.extend((outside_idx, idx, length) for idx, length in zip(touching.tolist(), exterior_lengths.tolist())
+                  if length > 0)
+    finishStage("exterior")
 
     # Then, we can convert the graph to networkx object using the
     # .to_networkx() method.
@@ -135,46 +225,78 @@ def processDataset(dataset_path):
     graph.nodes[outside_idx]["FID"] = -1
     graph.nodes[outside_idx]["area"] = 0
 
-    # Write data from the polygons to the nodes
-    for idx, poly in subdivision.iterrows():
-        for col in subdivision:
-            # Do not save the geometry column
-            if col == "geometry":
-                continue
-            graph.nodes[idx][col] = poly[col]
-        # Add an additional area column
-        graph.nodes[idx]["area"] = poly.geometry.area
+    # Write data from the polygons to the nodes (all columns but the geometry, and an additional area column)
+    attributes = subdivision.drop(columns="geometry")
+    attributes["area"] = store.areas
+    nx.set_node_attributes(graph, dict(enumerate(attributes.to_dict("records"))))
 
     # Add the computed edge weights to the graph
     graph.add_weighted_edges_from(shared)
+    finishStage("graph")
 
     # The command assumes that the ids are in the first column
     # ids =  list(subdivision.iloc[:, 0])
 
     csv_path = os.path.join("data", "graphs", f"{dataset_name}", f"{dataset_name}")
-    writeGraphToCsv(graph, csv_path)
-
-    visualizeGraph(graph, subdivision, dataset_name)
-
-
-parser = argparse.ArgumentParser(description="Path to data directory")
-parser.add_argument('-d', '--dir', type=str, default=None, help='Path to the directory containing the streetmap files')
+    if "csv" in formats:
+        writeGraphToCsv(graph, csv_path)
+    if "binary" in formats:
+        writeGraphContainer(graph, csv_path)
+    finishStage("write")
+
+    if plot:
+        visualizeGraph(graph, subdivision, dataset_name, filename=f"{csv_path}_graph.png", centroids=store.centroids)
+        finishStage("plot")
+
+    return timings
+
+
+def printTimings(dataset_path, timings):
+    """Print the time of every stage of processDataset."""
+    stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in timings.items())
+    print(f"{dataset_path}: {stages} (total {sum(timings.values()):.2f}s)")
+
+
+def _processDatasetJob(dataset_path, shape_dir, plot, formats):
+    """Worker entry point for processing one dataset in a pool."""
+    return dataset_path, processDataset(dataset_path, shape_dir=shape_dir, plot=plot, formats=formats)
+
+
+default_datasets = [
+    "roads-reduced/avignon",
+    "roads-reduced/braunschweig", "roads-reduced/issoire", "roads-reduced/karlsruhe",
+    "roads-reduced/neumuenster",
+    # "rheinruhr/rheinruhr"
+    # ,"F_NUTS3_UTM"
+]
+
+parser = argparse.ArgumentParser(description="Build the adjacency graphs of planar subdivisions given as shapefiles")
+parser.add_argument('datasets', nargs='*', default=default_datasets,
+                    help='Shapefiles to process, relative to the shapefile directory and without extension '
+                         '(e.g. roads-reduced/issoire)')
+parser.add_argument('-d', '--dir', type=str, default=os.path.join("data", "shape"),
+                    help='Path to the directory containing the shapefiles')
+parser.add_argument('-p', '--processes', type=int, default=None,
+                    help='Number of worker processes (default: number of CPUs)')
+parser.add_argument('-c', '--chunks', type=int, default=1,
+                    help='Split the shared boundary computation of every dataset into this many spatial chunks. '
+                         'The datasets are then processed one after another, each using all workers')
+parser.add_argument('--plot', action='store_true',
+                    help='Save a plot of every graph next to its csv files')
+parser.add_argument('-f', '--format', choices=['csv', 'binary', 'both'], default='both',
+                    help='Write the graphs as csv files, as binary graph containers or both')
 
 if __name__ == '__main__':
-    from multiprocessing import Pool
-
-    datasets = [
-        "roads-reduced/avignon",
-        "roads-reduced/braunschweig", "roads-reduced/issoire", "roads-reduced/karlsruhe",
-        "roads-reduced/neumuenster",
-        # "rheinruhr/rheinruhr"
-        # ,"F_NUTS3_UTM"
-    ]
-    # datasets = ["issoire"]
-    # datasets = ["F_NUTS3_UTM"]
-    # with Pool() as p:
-    #     p.map(processDataset, datasets)
-
-    for dataset in datasets:
-        processDataset(dataset)
-    plt.show()
+    args = parser.parse_args()
+    formats = ("csv", "binary") if args.format == "both" else (args.format,)
+
+    with Pool(args.processes) as pool:
+        if args.chunks > 1:
+            # Workers can not start pools themselves, so the chunks of one dataset share the pool
+            for dataset in args.datasets:
+                printTimings(dataset, processDataset(dataset, shape_dir=args.dir, plot=args.plot, pool=pool,
+                                                     chunks=args.chunks, formats=formats))
+        else:
+            job = functools.partial(_processDatasetJob, shape_dir=args.dir, plot=args.plot, formats=formats)
+            for dataset, timings in pool.imap_unordered(job, args.datasets):
+                printTimings(dataset, timings)
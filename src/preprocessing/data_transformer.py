@@ -1,73 +1,214 @@
-import csv
+import argparse
 import os
+import warnings
+from itertools import islice
 
+import numpy as np
 
-def write_graph_to_csv(input_file, vertices_file, edges_file):
+from graph_container import arrays_from_edge_list, write_graph_container
+
+"""
+Converter for dual graph text files ('v <id> <weight>' and 'e <from> <to> <weight>' lines after a header line) to the
+vertices and edges files of a dataset. The input is streamed in chunks of lines that are parsed into numpy arrays
+(24 bytes per edge instead of lists of python objects), the symmetry check and the sorting work on these arrays.
+"""
+
+# Number of lines parsed (or rows written) at once
+CHUNK_LINES = 1 << 18
+
+
+def _parse_columns(lines: list[str], num_columns: int) -> np.ndarray:
     """
-    Read a graph from a text file and write it to CSV files for vertices and edges.
+    Parses lines of whitespace separated numbers (without the leading type letter) into an array with num_columns
+    columns. All lines of a chunk are parsed with one call, lines with a different number of values are parsed
+    one by one (extra values are ignored, malformed lines raise a ValueError).
+    """
+    try:
+        with warnings.catch_warnings():
+            # numpy warns (or raises) if the text does not end with a number
+            warnings.simplefilter("ignore", DeprecationWarning)
+            values = np.fromstring("".join(lines), sep=" ") if lines else np.empty(0)
+    except ValueError:
+        values = None
+    if values is not None and len(values) == num_columns * len(lines):
+        return values.reshape(-1, num_columns)
+    return np.array([[float(x) for x in line.split()[:num_columns]] for line in lines]).reshape(-1, num_columns)
+
+
+def read_dual_graph(input_file: str, chunk_lines: int = CHUNK_LINES) -> tuple[np.ndarray, ...]:
+    """
+    Reads a dual graph text file in a single streaming pass. Every chunk of lines is parsed into arrays right away,
+    so only one chunk of text is in memory at a time.
 
     :param input_file: Path to the input text file containing the graph data.
-    :param vertices_file: Path to the output CSV file for vertices.
-    :param edges_file: Path to the output CSV file for edges.
+    :param chunk_lines: Number of lines parsed at once.
+    :return: Tuple of the vertex ids, vertex weights, edge sources, edge targets and edge weights (in file order).
     """
+    vertex_chunks, edge_chunks = [], []
 
-    # Initialize lists to store vertices and edges
-    vertices = []
-    edges = []
-
-    # Read the input file
     with open(input_file, 'r') as file:
-        lines = file.readlines()
-
-    # Process the file
-    for line in lines[1:]:  # Skip the header
-        parts = line.strip().split()
-        if parts[0] == 'v':  # Vertex line
-            vertex_id = int(parts[1])
-            weight = float(parts[2])
-            vertices.append([vertex_id, weight])
-        elif parts[0] == 'e':  # Edge line
-            from_id = int(parts[1])
-            to_id = int(parts[2])
-            weight = float(parts[3])
-            edges.append([from_id, to_id, weight])
-
+        file.readline()  # Skip the header
+        while True:
+            lines = list(islice(file, chunk_lines))
+            if not lines:
+                break
+            vertex_chunks.append(_parse_columns([line[1:] for line in lines if line[0] == 'v'], 2))
+            edge_chunks.append(_parse_columns([line[1:] for line in lines if line[0] == 'e'], 3))
+            del lines
+
+    vertices = np.concatenate(vertex_chunks) if vertex_chunks else np.empty((0, 2))
+    del vertex_chunks
+    edges = np.concatenate(edge_chunks) if edge_chunks else np.empty((0, 3))
+    del edge_chunks
+
+    # Ids are parsed as floats, which is exact for ids below 2^53
+    return (vertices[:, 0].astype(np.int64), vertices[:, 1].copy(), edges[:, 0].astype(np.int64),
+            edges[:, 1].astype(np.int64), edges[:, 2].copy())
+
+
+def check_symmetric(from_ids: np.ndarray, to_ids: np.ndarray, weights: np.ndarray):
+    """
+    Checks that for every edge (u, v) with weight w, the file also contains the edge (v, u) with weight w.
+    Instead of a dict of all edges, the edges are sorted by their canonical (min, max, weight) triple: every group
+    of equal triples has to contain both directions.
 
-    # Check if all edges are symmetric
-    edge_dict = {(edge[0], edge[1]): edge[2] for edge in edges}
-    for edge in edges:
-        if (edge[1], edge[0]) not in edge_dict or edge_dict[(edge[1], edge[0])] != edge[2]:
-            raise ValueError(f"Edge ({edge[0]}, {edge[1]}) is not symmetric.")
+    :raises ValueError: If an edge is not symmetric (the first one in file order is reported).
+    """
+    low, high = np.minimum(from_ids, to_ids), np.maximum(from_ids, to_ids)
+    order = np.lexsort((weights, high, low))
+    low, high, sorted_weights = low[order], high[order], weights[order]
+
+    group_start = np.ones(len(order), dtype=bool)
+    group_start[1:] = (low[1:] != low[:-1]) | (high[1:] != high[:-1]) | (sorted_weights[1:] != sorted_weights[:-1])
+    starts = np.flatnonzero(group_start)
+    if len(starts) == 0:
+        return
+
+    # self loops are their own reverse edge, they count for both directions
+    has_forward = np.logical_or.reduceat(from_ids[order] <= to_ids[order], starts)
+    has_backward = np.logical_or.reduceat(from_ids[order] >= to_ids[order], starts)
+    symmetric = has_forward & has_backward
+    if np.all(symmetric):
+        return
+
+    group = np.cumsum(group_start) - 1
+    i = order[~symmetric[group]].min()
+    raise ValueError(f"Edge ({from_ids[i]}, {to_ids[i]}) is not symmetric.")
+
+
+def _canonical_edge_order(low: np.ndarray, high: np.ndarray) -> np.ndarray:
+    """Stable order of the edges by (low, high), with a single integer sort key if the id range allows it."""
+    if len(low) == 0:
+        return np.arange(0)
+    smallest, id_range = int(low.min()), int(high.max()) - int(low.min()) + 1
+    if id_range < 2 ** 31:
+        return np.argsort((low - smallest) * id_range + (high - smallest), kind="stable")
+    return np.lexsort((high, low))
+
+
+def canonical_sorted_graph(input_file: str, chunk_lines: int = CHUNK_LINES) -> tuple[np.ndarray, ...]:
+    """
+    Reads a dual graph text file, checks the symmetry of the edges and returns the vertices sorted by id and the
+    edges from the smaller to the larger vertex id, sorted by (from_id, to_id). The sorts are stable, so vertices and
+    edges with the same ids keep their order in the file.
 
+    :return: Tuple of the vertex ids, vertex weights, edge sources, edge targets and edge weights.
+    """
+    vertex_ids, vertex_weights, from_ids, to_ids, weights = read_dual_graph(input_file, chunk_lines)
 
     # Only save edges from smaller to larger vertex IDs to ensure symmetry
-    edges = [[min(edge[0], edge[1]), max(edge[0], edge[1]), edge[2]] for edge in edges]
+    low, high = np.minimum(from_ids, to_ids), np.maximum(from_ids, to_ids)
 
     # Sort vertices and edges
-    vertices.sort(key=lambda x: x[0])  # Sort vertices by ID
-    edges.sort(key=lambda x: (x[0], x[1]))  # Sort edges by from_id, then to_id
+    vertex_order = np.argsort(vertex_ids, kind="stable")
+    edge_order = _canonical_edge_order(low, high)
+    low, high, sorted_weights = low[edge_order], high[edge_order], weights[edge_order]
+
+    # Check if all edges are symmetric. Usually every edge is listed once per direction, so most groups of edges with
+    # the same ids are a pair of reverse edges with the same weight. Only the other groups need the full check.
+    num_edges = len(edge_order)
+    group_start = np.ones(num_edges + 1, dtype=bool)
+    group_start[1:-1] = (low[1:] != low[:-1]) | (high[1:] != high[:-1])
+    starts = np.flatnonzero(group_start)
+    sizes = np.diff(starts)
+    first = starts[:-1][sizes == 2]
+    sorted_from = from_ids[edge_order]
+    reverse_pair = (sorted_weights[first] == sorted_weights[first + 1]) \
+        & ((sorted_from[first] != sorted_from[first + 1]) | (low[first] == high[first]))
+    checked = np.zeros(num_edges, dtype=bool)
+    checked[first[reverse_pair]] = True
+    checked[first[reverse_pair] + 1] = True
+    unchecked = np.sort(edge_order[~checked])
+    del sorted_from, checked
+    check_symmetric(from_ids[unchecked], to_ids[unchecked], weights[unchecked])
+    del from_ids, to_ids, weights
+
+    return vertex_ids[vertex_order], vertex_weights[vertex_order], low, high, sorted_weights
+
+
+def _write_rows(file, header: str, columns: tuple[np.ndarray, ...], chunk_lines: int):
+    """
+    Writes the columns as csv rows in chunks, formatted like csv.writer (str for ints, repr for floats and '\\r\\n'
+    line endings).
+    """
+    file.write(header + "\r\n")
+    num_rows = len(columns[0])
+    for start in range(0, num_rows, chunk_lines):
+        rows = zip(*(column[start:start + chunk_lines].tolist() for column in columns))
+        file.write("".join(",".join(map(repr, row)) + "\r\n" for row in rows))
+
+
+def write_graph_to_csv(input_file, vertices_file, edges_file, chunk_lines=CHUNK_LINES):
+    """
+    Read a graph from a text file and write it to CSV files for vertices and edges.
+
+    :param input_file: Path to the input text file containing the graph data.
+    :param vertices_file: Path to the output CSV file for vertices.
+    :param edges_file: Path to the output CSV file for edges.
+    :param chunk_lines: Number of lines parsed (or rows written) at once.
+    """
+    vertex_ids, vertex_weights, from_ids, to_ids, weights = canonical_sorted_graph(input_file, chunk_lines)
 
     #Create the directory if it does not exist
     os.makedirs(os.path.dirname(vertices_file), exist_ok=True)
 
     # Write vertices to CSV
     with open(vertices_file, 'w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['FID', 'area'])  # Header
-        writer.writerows(vertices)
+        _write_rows(file, "FID,area", (vertex_ids, vertex_weights), chunk_lines)
 
     # Write edges to CSV
     with open(edges_file, 'w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['from_id', 'to_id', 'weight'])  # Header
-        writer.writerows(edges)
+        _write_rows(file, "from_id,to_id,weight", (from_ids, to_ids, weights), chunk_lines)
+
+
+def write_graph_to_container(input_file, graph_file, chunk_lines=CHUNK_LINES):
+    """
+    Read a graph from a text file and write it to a binary graph container (see graph_container), with the same
+    vertices and edges as the csv files of write_graph_to_csv.
+
+    :param input_file: Path to the input text file containing the graph data.
+    :param graph_file: Path to the output container file.
+    :param chunk_lines: Number of lines parsed at once.
+    """
+    vertex_ids, vertex_weights, from_ids, to_ids, weights = canonical_sorted_graph(input_file, chunk_lines)
+    arrays = arrays_from_edge_list(vertex_ids, vertex_weights, from_ids, to_ids, weights, source=input_file)
+    del from_ids, to_ids, weights
+    write_graph_container(graph_file, arrays, metadata={'source': os.path.basename(input_file)})
+
 
+parser = argparse.ArgumentParser(description="Convert a dual graph text file to the vertices and edges of a dataset")
+parser.add_argument('input', nargs='?', default='data/graphs/rheinruhr_joshua/rheinruhr_merged_result_dual.txt',
+                    help='Path to the dual graph text file')
+parser.add_argument('output', nargs='?', default='data/graphs/rheinruhr/rheinruhr',
+                    help='Output path prefix, the files {output}_vertices.csv and {output}_edges.csv '
+                         '(or the graph container {output}_graph.bin) are written')
+parser.add_argument('-f', '--format', choices=['csv', 'binary', 'both'], default='both', help='Output format')
 
 if __name__ == '__main__':
-    # File paths
-    input_file = 'data/graphs/rheinruhr_joshua/rheinruhr_merged_result_dual.txt'
-    vertices_file = 'data/graphs/rheinruhr/rheinruhr_vertices.csv'
-    edges_file = 'data/graphs/rheinruhr/rheinruhr_edges.csv'
+    args = parser.parse_args()
 
-    # Write the graph to CSV files
-    write_graph_to_csv(input_file, vertices_file, edges_file)
\ No newline at end of file
+    # Write the graph to CSV files and/or a binary graph container
+    if args.format in ('csv', 'both'):
+        write_graph_to_csv(args.input, f"{args.output}_vertices.csv", f"{args.output}_edges.csv")
+    if args.format in ('binary', 'both'):
+        write_graph_to_container(args.input, f"{args.output}_graph.bin")
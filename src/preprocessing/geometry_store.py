@@ -0,0 +1,234 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+import shapely
+
+"""
+Dataset registry and persisted geometry store. dataset_shapefile resolves a dataset name (or a path relative to the
+shapefile directory, e.g. 'roads-reduced/issoire') to its shapefile. load_geometry converts a shapefile once into a
+columnar store in data/cache/geometry/<dataset>.npz and loads it from there afterwards:
+    wkb, wkb_offsets   the geometries as concatenated WKB (geometry i is wkb[wkb_offsets[i]:wkb_offsets[i + 1]])
+    areas, centroids   area and centroid (x, y) of every geometry
+    bounds             bounding box (xmin, ymin, xmax, ymax) of every geometry
+    exterior           WKB of the boundary of the union of all geometries
+    column:<name>      the attribute columns of the shapefile (strings as unicode arrays)
+    header             json with the version, the CRS, the column order and the stamp of the source files
+The store is rebuilt when the source files change: their modification times and sizes are checked on every load and,
+if they differ, their content hash decides (with the same content, only the stamp in the store is updated). The
+STRtree is built on first use, from the loaded geometries (shapely can not serialize trees, building one takes
+milliseconds).
+Preprocessing (dataToAdjacencyGraph) and plotting (solution_plotter) both load their geometry through this module.
+"""
+
+VERSION = 1
+SHAPE_DIR = os.path.join("data", "shape")
+STORE_DIR = os.path.join("data", "cache", "geometry")
+SOURCE_EXTENSIONS = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+# Shapefile of every dataset, relative to SHAPE_DIR and without the extension
+DATASETS = {
+    'avignon': "roads-reduced/avignon",
+    'braunschweig': "roads-reduced/braunschweig",
+    'issoire': "roads-reduced/issoire",
+    'karlsruhe': "roads-reduced/karlsruhe",
+    'neumuenster': "roads-reduced/neumuenster",
+    'rheinruhr': "rheinruhr/rheinruhr",
+}
+
+
+def dataset_shapefile(dataset: str, shape_dir: str = SHAPE_DIR) -> str:
+    """
+    Path of the shapefile of a dataset.
+    :param dataset: Name of a registered dataset (see DATASETS), a path relative to shape_dir without extension (e.g.
+                    'roads-reduced/issoire') or the name of a shapefile in a subfolder of shape_dir.
+    :raises FileNotFoundError: If there is no such shapefile.
+    """
+    path = os.path.join(shape_dir, f"{DATASETS.get(dataset, dataset)}.shp")
+    if not os.path.exists(path):
+        found = sorted(glob.glob(os.path.join(shape_dir, "*", f"{dataset}.shp")))
+        if not found:
+            raise FileNotFoundError(f"No shapefile for dataset {dataset} in {shape_dir}")
+        path = found[0]
+    return path
+
+
+def _source_files(shapefile: str) -> list[str]:
+    base = os.path.splitext(shapefile)[0]
+    return [base + extension for extension in SOURCE_EXTENSIONS if os.path.exists(base + extension)]
+
+
+def _source_stamp(shapefile: str) -> dict[str, list[int]]:
+    """Modification time (ns) and size of every source file."""
+    return {os.path.basename(path): [os.stat(path).st_mtime_ns, os.stat(path).st_size]
+            for path in _source_files(shapefile)}
+
+
+def _source_hash(shapefile: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for path in _source_files(shapefile):
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+class GeometryStore:
+    """
+    Geometry of a dataset as arrays: the shapely geometries, their attribute columns, areas, centroids and bounds,
+    the boundary of their union (exterior) and a lazily built STRtree. Geometry i belongs to row i of the shapefile.
+    """
+
+    def __init__(self, name: str, geometries: np.ndarray, columns: dict[str, np.ndarray], areas: np.ndarray,
+                 centroids: np.ndarray, bounds: np.ndarray, exterior, crs: str | None):
+        self.name = name
+        self.geometries = geometries
+        self.columns = columns
+        self.areas = areas
+        self.centroids = centroids
+        self.bounds = bounds
+        self.exterior = exterior
+        self.crs = crs
+        self._tree = None
+
+    def __len__(self) -> int:
+        return len(self.geometries)
+
+    @property
+    def fids(self) -> np.ndarray:
+        """The FID column, or the row numbers if the shapefile has none."""
+        return self.columns['FID'] if 'FID' in self.columns else np.arange(len(self.geometries))
+
+    @property
+    def total_bounds(self) -> np.ndarray:
+        """Bounding box (xmin, ymin, xmax, ymax) of all geometries."""
+        return np.concatenate((self.bounds[:, :2].min(axis=0), self.bounds[:, 2:].max(axis=0)))
+
+    @property
+    def tree(self) -> shapely.STRtree:
+        if self._tree is None:
+            self._tree = shapely.STRtree(self.geometries)
+        return self._tree
+
+    def to_geodataframe(self):
+        """The geometry as GeoDataFrame with the attribute columns, like geopandas.read_file of the shapefile."""
+        import geopandas
+        return geopandas.GeoDataFrame(dict(self.columns), geometry=self.geometries, crs=self.crs)
+
+
+def build_geometry_store(shapefile: str, store_path: str) -> None:
+    """Reads a shapefile with geopandas and writes its geometry store (atomically)."""
+    import geopandas
+    stamp = _source_stamp(shapefile)
+    source_hash = _source_hash(shapefile)
+    subdivision = geopandas.read_file(shapefile)
+    geometries = subdivision.geometry.values.to_numpy()
+
+    wkb = shapely.to_wkb(geometries)
+    offsets = np.zeros(len(wkb) + 1, dtype=np.int64)
+    np.cumsum([len(item) for item in wkb], out=offsets[1:])
+    centroids = shapely.centroid(geometries)
+    arrays = {'wkb': np.frombuffer(b"".join(wkb), dtype=np.uint8), 'wkb_offsets': offsets,
+              'areas': shapely.area(geometries),
+              'centroids': np.column_stack((shapely.get_x(centroids), shapely.get_y(centroids))),
+              'bounds': shapely.bounds(geometries).reshape(-1, 4),
+              'exterior': np.frombuffer(shapely.to_wkb(subdivision.union_all().boundary), dtype=np.uint8)}
+
+    columns = [column for column in subdivision.columns if column != subdivision.geometry.name]
+    for column in columns:
+        values = subdivision[column].to_numpy()
+        # object columns (strings, missing values) are stored as strings, so the store loads without pickle
+        arrays[f"column:{column}"] = values.astype(str) if values.dtype == object else values
+
+    header = {'version': VERSION, 'name': os.path.splitext(os.path.basename(shapefile))[0], 'source': shapefile,
+              'stamp': stamp, 'hash': source_hash, 'columns': columns,
+              'crs': subdivision.crs.to_wkt() if subdivision.crs is not None else None}
+    arrays['header'] = np.frombuffer(json.dumps(header).encode(), dtype=np.uint8)
+    _write_store(store_path, arrays)
+
+
+def _write_store(store_path: str, arrays: dict[str, np.ndarray]) -> None:
+    os.makedirs(os.path.dirname(store_path) or ".", exist_ok=True)
+    # np.savez appends .npz to names without that extension
+    with open(store_path + ".tmp", "wb") as file:
+        np.savez(file, **arrays)
+    os.replace(store_path + ".tmp", store_path)
+
+
+def _restamp_store(store_path: str, header: dict, stamp: dict[str, list[int]]) -> None:
+    """Rewrites the store with the new stamp of its unchanged source files, so the next load skips the hash."""
+    with np.load(store_path) as data:
+        arrays = {name: data[name] for name in data.files}
+    arrays['header'] = np.frombuffer(json.dumps(dict(header, stamp=stamp)).encode(), dtype=np.uint8)
+    _write_store(store_path, arrays)
+
+
+def _read_header(store_path: str) -> dict | None:
+    try:
+        with np.load(store_path) as data:
+            return json.loads(data['header'].tobytes())
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def read_geometry_store(store_path: str) -> GeometryStore:
+    with np.load(store_path) as data:
+        header = json.loads(data['header'].tobytes())
+        wkb, offsets = data['wkb'].tobytes(), data['wkb_offsets']
+        geometries = shapely.from_wkb([wkb[start:end] for start, end in zip(offsets[:-1].tolist(),
+                                                                             offsets[1:].tolist())])
+        columns = {column: data[f"column:{column}"] for column in header['columns']}
+        return GeometryStore(header['name'], np.asarray(geometries, dtype=object), columns, data['areas'],
+                             data['centroids'], data['bounds'], shapely.from_wkb(data['exterior'].tobytes()),
+                             header['crs'])
+
+
+# Loaded stores of this process by store path, with the source stamp they were checked against
+_LOADED: dict[str, tuple[dict, GeometryStore]] = {}
+
+
+def load_geometry(dataset: str, shape_dir: str = SHAPE_DIR, store_dir: str = STORE_DIR,
+                  refresh: bool = False) -> GeometryStore:
+    """
+    Geometry of a dataset from its store, which is (re)built from the shapefile if it is missing or outdated. Stores
+    are kept in memory per process, as long as the source files do not change.
+    :param dataset: Dataset name or shapefile path (see dataset_shapefile).
+    :param refresh: If True, always rebuild the store.
+    """
+    shapefile = dataset_shapefile(dataset, shape_dir)
+    store_path = os.path.join(store_dir, f"{os.path.splitext(os.path.basename(shapefile))[0]}.npz")
+    stamp = _source_stamp(shapefile)
+    if not refresh and store_path in _LOADED and _LOADED[store_path][0] == stamp:
+        return _LOADED[store_path][1]
+
+    header = _read_header(store_path)
+    if refresh or header is None or header.get('version') != VERSION:
+        build_geometry_store(shapefile, store_path)
+    elif header['stamp'] != stamp:
+        if header['hash'] == _source_hash(shapefile):
+            # same content with new modification times (e.g., after a checkout)
+            _restamp_store(store_path, header, stamp)
+        else:
+            build_geometry_store(shapefile, store_path)
+    store = read_geometry_store(store_path)
+    _LOADED[store_path] = stamp, store
+    return store
+
+
+parser = argparse.ArgumentParser(description="Build the geometry stores of datasets")
+parser.add_argument('datasets', nargs='*', default=list(DATASETS), help='Dataset names or shapefile paths')
+parser.add_argument('-d', '--dir', type=str, default=SHAPE_DIR, help='Path to the directory containing the shapefiles')
+parser.add_argument('--refresh', action='store_true', help='Rebuild the stores even if they are current')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    for name in args.datasets:
+        try:
+            geometry = load_geometry(name, args.dir, refresh=args.refresh)
+        except FileNotFoundError as error:
+            print(error)
+            continue
+        print(f"{name}: {len(geometry)} geometries, columns {', '.join(geometry.columns)}")
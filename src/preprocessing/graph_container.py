@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+
+"""
+Versioned binary container for dataset graphs. The file starts with a fixed header (magic, version and the length of
+a json header), followed by the json header and the arrays. The json header lists the dtype, shape and offset of
+every array, a checksum of the array data and free metadata. Every array starts at a multiple of ALIGNMENT bytes, so
+it can be memory-mapped directly (zero-copy) with numpy.
+
+The arrays are the fields of graph_utils.GraphArrays: node i is the vertex with FID fids[i], its neighbors are
+indices[indptr[i]:indptr[i + 1]] with the shared perimeters shared_perim[indptr[i]:indptr[i + 1]].
+"""
+
+MAGIC = b"CIRCGRPH"
+VERSION = 1
+ALIGNMENT = 64
+_PREFIX = struct.Struct("<8sII")  # magic, version, length of the json header
+
+# Arrays of a graph container and their dtypes (little endian)
+FIELDS = {
+    'fids': '<i8',
+    'node_weight': '<f8',
+    'boundary_node': '|b1',
+    'boundary_perim': '<f8',
+    'indptr': '<i8',
+    'indices': '<i8',
+    'shared_perim': '<f8',
+}
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _checksum(arrays) -> str:
+    """Hash of the data of the arrays (in the given order)."""
+    h = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        h.update(memoryview(np.ascontiguousarray(array)).cast("B"))
+    return h.hexdigest()
+
+
+def graph_checksum(arrays: dict[str, np.ndarray]) -> str:
+    """Checksum of the arrays of a graph (the same one write_graph_container stores), e.g. as cache key."""
+    return _checksum(np.ascontiguousarray(arrays[name], dtype=dtype) for name, dtype in FIELDS.items())
+
+
+def source_stamp(paths: list[str]) -> dict[str, list[int]]:
+    """Modification time (ns) and size of every source file of a container, to detect changed sources cheaply."""
+    return {os.path.basename(path): [os.stat(path).st_mtime_ns, os.stat(path).st_size] for path in paths}
+
+
+def source_hash(paths: list[str]) -> str:
+    """Hash of the content of the source files of a container, decides if sources with a new stamp changed."""
+    h = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+def arrays_from_edge_list(vertex_ids: np.ndarray, vertex_weights: np.ndarray, from_ids: np.ndarray,
+                          to_ids: np.ndarray, weights: np.ndarray, source: str = "edge list") -> dict[str, np.ndarray]:
+    """
+    Builds the container arrays from the vertex and edge columns of a dataset (as in the *_vertices.csv and
+    *_edges.csv files). The vertex with FID -1 is the outside: it is not a node, edges to it define the boundary
+    perimeter of their node (a later edge overwrites an earlier one). Duplicate edges (some files list every edge in
+    both directions) are removed, keeping the first occurrence. The neighbors of a node are in the order of the
+    edges, which is the same order the networkx graph would have.
+
+    :param source: Name of the input for error messages.
+    :return: Dict with the arrays of FIELDS.
+    """
+    # Skip the outside vertex
+    inside = vertex_ids != -1
+    fids = vertex_ids[inside].astype(np.int64)
+    node_weight = vertex_weights[inside].astype(np.float64)
+    n = len(fids)
+
+    # Map FIDs to node indices (an index of -1 marks the outside vertex)
+    order = np.argsort(fids, kind="stable")
+    sources, targets, weights = from_ids.astype(np.int64), to_ids.astype(np.int64), weights.astype(np.float64)
+
+    def to_index(ids):
+        if n == 0:
+            if np.any(ids != -1):
+                raise ValueError(f"Edges of {source} reference vertices that do not exist.")
+            return ids
+        pos = np.minimum(np.searchsorted(fids, ids, sorter=order), n - 1)
+        idx = order[pos]
+        if np.any((fids[idx] != ids) & (ids != -1)):
+            raise ValueError(f"Edges of {source} reference vertices that do not exist.")
+        return np.where(ids == -1, -1, idx)
+
+    sources, targets = to_index(sources), to_index(targets)
+
+    # Edges to the outside vertex define the boundary perimeter (a later row overwrites an earlier one)
+    outside = (sources == -1) | (targets == -1)
+    boundary_node = np.zeros(n, dtype=bool)
+    boundary_perim = np.zeros(n)
+    valid = np.where(sources[outside] != -1, sources[outside], targets[outside])
+    boundary_node[valid] = True
+    boundary_perim[valid] = weights[outside]
+
+    # Remove duplicate edges, keeping the first occurrence
+    sources, targets, weights = sources[~outside], targets[~outside], weights[~outside]
+    keys = np.minimum(sources, targets) * n + np.maximum(sources, targets)
+    _, first = np.unique(keys, return_index=True)
+    first.sort()
+    sources, targets, weights = sources[first], targets[first], weights[first]
+
+    # Store every edge in both directions, grouped by tail. The stable sort keeps the neighbors of a node in edge
+    # order.
+    tails = np.column_stack((sources, targets)).ravel()
+    heads = np.column_stack((targets, sources)).ravel()
+    arc_weights = np.repeat(weights, 2)
+    arc_order = np.argsort(tails, kind="stable")
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(tails, minlength=n), out=indptr[1:])
+
+    return {'fids': fids, 'node_weight': node_weight, 'boundary_node': boundary_node,
+            'boundary_perim': boundary_perim, 'indptr': indptr, 'indices': heads[arc_order].astype(np.int64),
+            'shared_perim': arc_weights[arc_order]}
+
+
+def write_graph_container(path: str, arrays: dict[str, np.ndarray], metadata: dict | None = None) -> str:
+    """
+    Writes the arrays of a graph to a container file. The file is written to a temporary file first and then moved
+    into place, so readers never see a half-written container.
+
+    :param path: Path of the container file.
+    :param arrays: Dict with the arrays of FIELDS (other keys are ignored).
+    :param metadata: Optional json serializable metadata stored in the header.
+    :return: The checksum of the array data.
+    """
+    data = [np.ascontiguousarray(arrays[name], dtype=dtype) for name, dtype in FIELDS.items()]
+    num_nodes = len(data[0])
+    if any(len(array) != num_nodes for array in data[1:4]) or len(data[4]) != num_nodes + 1 \
+            or len(data[5]) != len(data[6]) or data[4][-1] != len(data[5]):
+        raise ValueError("The arrays do not form a valid graph.")
+
+    entries, offset = {}, 0
+    for (name, dtype), array in zip(FIELDS.items(), data):
+        entries[name] = {'dtype': dtype, 'shape': list(array.shape), 'offset': offset}
+        offset = _aligned(offset + array.nbytes)
+    checksum = _checksum(data)
+    header = json.dumps({'arrays': entries, 'checksum': checksum, 'metadata': metadata or {}}).encode()
+
+    # The array data starts at an aligned offset after the json header
+    data_start = _aligned(_PREFIX.size + len(header))
+    header = header.ljust(data_start - _PREFIX.size)
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(_PREFIX.pack(MAGIC, VERSION, len(header)))
+        file.write(header)
+        for (name, _), array in zip(FIELDS.items(), data):
+            file.seek(data_start + entries[name]['offset'])
+            file.write(memoryview(array).cast("B"))
+        file.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+    return checksum
+
+
+def read_graph_container(path: str, mmap: bool = True, verify: bool = False) -> tuple[dict[str, np.ndarray], dict]:
+    """
+    Reads a container file.
+
+    :param path: Path of the container file.
+    :param mmap: If True, the arrays are read-only memory maps of the file, otherwise they are read into memory.
+    :param verify: If True, the checksum of the array data is verified (this reads all arrays, so it is off by
+                   default and meant for checking a file on demand).
+    :return: Tuple of the dict with the arrays of FIELDS and the header (with 'checksum' and 'metadata').
+    """
+    with open(path, "rb") as file:
+        prefix = file.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size:
+            raise ValueError(f"{path} is not a graph container.")
+        magic, version, header_length = _PREFIX.unpack(prefix)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a graph container.")
+        if version > VERSION:
+            raise ValueError(f"{path} has version {version}, only versions up to {VERSION} are supported.")
+        header = json.loads(file.read(header_length))
+        data_start = _PREFIX.size + header_length
+
+    # One read-only memory map of the whole file, the arrays are views into it
+    buffer = np.memmap(path, dtype=np.uint8, mode="r") if mmap else np.fromfile(path, dtype=np.uint8)
+    arrays = {}
+    for name in FIELDS:
+        entry = header['arrays'][name]
+        start = data_start + entry['offset']
+        size = int(np.prod(entry['shape'])) * np.dtype(entry['dtype']).itemsize
+        arrays[name] = buffer[start:start + size].view(np.ndarray).view(entry['dtype']).reshape(entry['shape'])
+
+    if verify and _checksum(arrays.values()) != header['checksum']:
+        raise ValueError(f"Checksum mismatch in {path}, the file is corrupted.")
+    return arrays, {'checksum': header['checksum'], 'metadata': header['metadata']}
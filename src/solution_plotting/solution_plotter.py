@@ -1,9 +1,46 @@
-import geopandas as gpd
-import matplotlib
-matplotlib.use('TkAgg')  # Use a standard backend (for pycharm)
-import matplotlib.pyplot as plt
+import argparse
+import functools
+import glob
 import os
-import re
+from multiprocessing import Pool
+
+import geopandas as gpd
+
+from mip_solving.solution_io import read_solution
+from preprocessing.geometry_store import DATASETS, load_geometry
+
+"""
+Plots of single district solutions. plot_shapefile_with_highlights shows a solution interactively. For batches (e.g.,
+all lower bounds of a sweep) the SolutionRenderer works headless: it loads the geometry of a dataset once per process,
+draws the base map once and renders every solution as overlay of its highlighted polygons only. The base map is
+rasterized, so SVGs only contain the highlighted polygons as vectors. render_solutions renders many solutions in a
+process pool, grouped by dataset so every worker builds the base map of a dataset at most once.
+"""
+
+
+@functools.lru_cache(maxsize=4)
+def load_subdivision(dataset_name: str, simplify: float = 0.0) -> gpd.GeoDataFrame:
+    """
+    Geometry of a dataset with a 'FID' column (the index if the shapefile has none), loaded from its geometry store
+    (see geometry_store) once per process.
+    :param simplify: If positive, the polygons are simplified with this tolerance (in map units), which makes
+                     rendering large datasets faster. The topology is preserved.
+    """
+    store = load_geometry(dataset_name)
+    subdivision = gpd.GeoDataFrame({"FID": store.fids}, geometry=store.geometries, crs=store.crs)
+    if simplify > 0:
+        subdivision = subdivision.set_geometry(subdivision.geometry.simplify(simplify, preserve_topology=True))
+    return subdivision
+
+
+def highlight_circle(subdivision: gpd.GeoDataFrame, highlighted: gpd.GeoDataFrame) -> tuple[tuple[float, float], float]:
+    """Center and radius of the marker circle around the highlighted polygons (at least 2% of the map size)."""
+    highlighted_bounds = highlighted.geometry.total_bounds
+    center = ((highlighted_bounds[0] + highlighted_bounds[2]) / 2, (highlighted_bounds[1] + highlighted_bounds[3]) / 2)
+    radius = max(highlighted_bounds[2] - highlighted_bounds[0], highlighted_bounds[3] - highlighted_bounds[1])
+    total_bounds = subdivision.geometry.total_bounds
+    image_size = max(total_bounds[2] - total_bounds[0], total_bounds[3] - total_bounds[1])
+    return center, max(radius, 0.02 * image_size)
 
 
 def plot_shapefile_with_highlights(dataset_name, highlight_color="red", base_color="lightblue",
@@ -17,24 +54,20 @@ def plot_shapefile_with_highlights(dataset_name, highlight_color="red", base_col
     :param base_color: Color for non-highlighted polygons.
     :param marker_color: Color for the markers.
     """
-    if dataset_name == "rheinruhr":
-        shapefile_path = os.path.join("data", "shape", "rheinruhr", f"{dataset_name}.shp")
-    else:
-        shapefile_path = os.path.join("data", "shape", "roads-reduced", f"{dataset_name}.shp")
-    solution_path = os.path.join("data", "solutions",f"{dataset_name}{file_suffix}", f"{dataset_name}{file_suffix}.txt")
-    # Load the shapefile
-    subdivision = gpd.read_file(shapefile_path)
+    # the interactive plots need a window, headless rendering (SolutionRenderer) uses Agg instead
+    import matplotlib
+    matplotlib.use('TkAgg')  # Use a standard backend (for pycharm)
+    import matplotlib.pyplot as plt
 
-    # Load the solution file (IDs to highlight)
-    with open(solution_path, "r") as file:
-        highlighted_ids = set(map(int, re.findall(r'\d+', file.readlines()[1])))
+    solution_dir = os.path.join("data", "solutions", f"{dataset_name}{file_suffix}")
+    # Load the shapefile
+    subdivision = load_subdivision(dataset_name).copy()
 
+    # Load the solution artifact (IDs to highlight)
+    _, highlighted_ids, _ = read_solution(f"{dataset_name}{file_suffix}")
 
     # Add a column to indicate whether a polygon should be highlighted
-    if "FID" in subdivision.columns:
-        subdivision["highlight"] = subdivision["FID"].isin(highlighted_ids)
-    else:
-        subdivision["highlight"] = subdivision.index.isin(highlighted_ids)
+    subdivision["highlight"] = subdivision["FID"].isin(highlighted_ids)
 
     # Plot the shapefile
     ax = subdivision.plot(
@@ -43,34 +76,15 @@ def plot_shapefile_with_highlights(dataset_name, highlight_color="red", base_col
         facecolor=subdivision["highlight"].map({True: highlight_color, False: base_color}),
     )
 
-    # Add markers for highlighted polygons
-    # Calculate a bounding circle around all highlighted areas
-    highlighted_bounds = subdivision[subdivision["highlight"]].geometry.total_bounds
-    circle_center_x = (highlighted_bounds[0] + highlighted_bounds[2]) / 2
-    circle_center_y = (highlighted_bounds[1] + highlighted_bounds[3]) / 2
-    circle_radius = max(
-        highlighted_bounds[2] - highlighted_bounds[0],
-        highlighted_bounds[3] - highlighted_bounds[1]
-    )
-    image_size = max(subdivision.geometry.total_bounds[2] - subdivision.geometry.total_bounds[0], subdivision.geometry.total_bounds[3] - subdivision.geometry.total_bounds[1])
-    circle_radius = max(circle_radius, 0.02 * image_size)
-
     # Add a circle around all highlighted areas
-    circle = plt.Circle(
-        (circle_center_x, circle_center_y),
-        circle_radius,
-        color=marker_color,
-        fill=False,
-        linewidth=2,
-        zorder=5
-    )
+    center, radius = highlight_circle(subdivision, subdivision[subdivision["highlight"]])
+    circle = plt.Circle(center, radius, color=marker_color, fill=False, linewidth=2, zorder=5)
     ax.add_artist(circle)
 
-    ax.axis("off")
     ax.axis("off")
     ax.set_title(f"Solution for {dataset_name} {file_suffix}", fontsize=16, pad=20)
 
-    plt.savefig(os.path.join(os.path.dirname(solution_path), f"{dataset_name}_highlighted{file_suffix}.svg"))
+    plt.savefig(os.path.join(solution_dir, f"{dataset_name}_highlighted{file_suffix}.svg"))
     plt.show()
 
     # Create a second plot zooming in on the highlighted area
@@ -85,12 +99,157 @@ def plot_shapefile_with_highlights(dataset_name, highlight_color="red", base_col
     zoom_ax.axis("off")
     zoom_ax.set_title(f"Zoomed-In Solution for {dataset_name} {file_suffix}", fontsize=16, pad=20)
 
-    plt.savefig(os.path.join(os.path.dirname(solution_path), f"{dataset_name}_highlighted_zoomed{file_suffix}.svg"))
+    plt.savefig(os.path.join(solution_dir, f"{dataset_name}_highlighted_zoomed{file_suffix}.svg"))
     plt.show()
 
 
-if __name__ == '__main__':
+class SolutionRenderer:
+    """
+    Headless renderer of the solutions of one dataset. The base map is drawn once in the constructor, render adds the
+    highlighted polygons and the marker circle, saves the figure and removes them again.
+    """
+
+    def __init__(self, dataset_name: str, base_color: str = "lightblue", simplify: float = 0.0,
+                 figsize: tuple[float, float] = (8, 8), dpi: int = 150):
+        # the Agg backend renders without a display, import pyplot here so importing this module selects no backend
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+
+        self.plt = plt
+        self.dataset_name = dataset_name
+        self.subdivision = load_subdivision(dataset_name, simplify)
+        self.figure, self.ax = plt.subplots(figsize=figsize, dpi=dpi)
+        self.subdivision.plot(ax=self.ax, linewidth=1, edgecolor="grey", facecolor=base_color, rasterized=True)
+        self.ax.axis("off")
+        self.limits = self.ax.get_xlim(), self.ax.get_ylim()
+
+    def render(self, highlighted_ids, title: str, path: str, zoomed_path: str | None = None,
+               highlight_color: str = "red", marker_color: str = "orange") -> list[str]:
+        """
+        Renders a solution. The format follows the file extension (e.g., .png or .svg).
+        :param highlighted_ids: FIDs of the district.
+        :param title: Title of the full map, the zoomed map is titled 'Zoomed-In <title>'.
+        :param path: Path of the full map.
+        :param zoomed_path: Optional path of a map zoomed in on the district.
+        :return: The paths of the written files.
+        """
+        self.plt.figure(self.figure.number)
+        highlighted = self.subdivision[self.subdivision["FID"].isin(highlighted_ids)]
+        num_collections = len(self.ax.collections)
+        if len(highlighted) > 0:
+            highlighted.plot(ax=self.ax, linewidth=1, edgecolor="grey", facecolor=highlight_color)
+        overlay = list(self.ax.collections[num_collections:])
+        written = []
+        try:
+            if len(highlighted) > 0:
+                center, radius = highlight_circle(self.subdivision, highlighted)
+                overlay.append(self.ax.add_artist(self.plt.Circle(center, radius, color=marker_color, fill=False,
+                                                                  linewidth=2, zorder=5)))
+            self.ax.set_title(title, fontsize=16, pad=20)
+            self.figure.savefig(path)
+            written.append(path)
+
+            if zoomed_path is not None and len(highlighted) > 0:
+                bounds = highlighted.geometry.total_bounds
+                overlay[-1].set_visible(False)
+                self.ax.set_xlim(bounds[0], bounds[2])
+                self.ax.set_ylim(bounds[1], bounds[3])
+                self.ax.set_title(f"Zoomed-In {title}", fontsize=16, pad=20)
+                self.figure.savefig(zoomed_path)
+                written.append(zoomed_path)
+        finally:
+            for artist in overlay:
+                artist.remove()
+            self.ax.set_xlim(*self.limits[0])
+            self.ax.set_ylim(*self.limits[1])
+        return written
+
+
+@functools.lru_cache(maxsize=4)
+def _renderer(dataset_name: str, simplify: float, dpi: int) -> SolutionRenderer:
+    """Renderer of a dataset, kept per (worker) process."""
+    return SolutionRenderer(dataset_name, simplify=simplify, dpi=dpi)
+
+
+def render_solution(dataset_name: str, file_suffix: str = "", fmt: str = "png", zoom: bool = True,
+                    simplify: float = 0.0, dpi: int = 150) -> list[str]:
+    """
+    Renders a solution headless next to its artifact, as data/solutions/<name>/<dataset>_highlighted<suffix>.<fmt>
+    (and _highlighted_zoomed with zoom).
+    :return: The paths of the written files.
+    """
+    solution_name = f"{dataset_name}{file_suffix}"
+    _, highlighted_ids, _ = read_solution(solution_name)
+    solution_dir = os.path.join("data", "solutions", solution_name)
+    path = os.path.join(solution_dir, f"{dataset_name}_highlighted{file_suffix}.{fmt}")
+    zoomed_path = os.path.join(solution_dir, f"{dataset_name}_highlighted_zoomed{file_suffix}.{fmt}") if zoom else None
+    return _renderer(dataset_name, simplify, dpi).render(highlighted_ids, f"Solution for {dataset_name} {file_suffix}",
+                                                         path, zoomed_path)
 
-    datasets = ["avignon", "braunschweig", "issoire", "karlsruhe", "neumuenster","rheinruhr"]
-    for dataset_name in datasets:
-        plot_shapefile_with_highlights(dataset_name)
\ No newline at end of file
+
+def _render_job(job: tuple[str, str], fmt: str, zoom: bool, simplify: float, dpi: int) -> list[str]:
+    """Worker entry point for rendering one solution in a pool."""
+    dataset_name, file_suffix = job
+    return render_solution(dataset_name, file_suffix, fmt, zoom, simplify, dpi)
+
+
+def render_solutions(jobs: list[tuple[str, str]], processes: int | None = None, fmt: str = "png", zoom: bool = True,
+                     simplify: float = 0.0, dpi: int = 150) -> list[str]:
+    """
+    Renders many solutions in a process pool.
+    :param jobs: (dataset name, file suffix) of every solution.
+    :param processes: Number of worker processes (default: number of CPUs), 1 renders in this process.
+    :return: The paths of the written files.
+    """
+    # sorted by dataset, so the chunks of a worker mostly belong to one dataset
+    jobs = sorted(jobs)
+    render = functools.partial(_render_job, fmt=fmt, zoom=zoom, simplify=simplify, dpi=dpi)
+    if processes == 1 or len(jobs) <= 1:
+        return [path for job in jobs for path in render(job)]
+    written = []
+    with Pool(processes) as pool:
+        chunksize = max(1, len(jobs) // (4 * (processes or os.cpu_count() or 1)))
+        for paths in pool.imap_unordered(render, jobs, chunksize=chunksize):
+            written.extend(paths)
+    return written
+
+
+def solution_suffixes(dataset_name: str) -> list[str]:
+    """File suffixes of the single district solutions of a dataset in data/solutions (e.g., '' and '_LB=1000.0')."""
+    suffixes = []
+    for directory in [os.path.join("data", "solutions", dataset_name)] + glob.glob(
+            os.path.join("data", "solutions", f"{dataset_name}_LB=*")):
+        name = os.path.basename(directory)
+        if os.path.exists(os.path.join(directory, f"{name}_solution.json")) or os.path.exists(
+                os.path.join(directory, f"{name}.txt")):
+            suffixes.append(name[len(dataset_name):])
+    return suffixes
+
+
+parser = argparse.ArgumentParser(description="Plot single district solutions")
+parser.add_argument('datasets', nargs='*',
+                    default=list(DATASETS),
+                    help='Datasets whose solutions are plotted')
+parser.add_argument('-s', '--suffix', type=str, nargs='+', default=None,
+                    help='File suffixes of the solutions (e.g. _LB=1000.0), default: all solutions of the datasets')
+parser.add_argument('--show', action='store_true', help='Show the plots interactively (SVG, one after another)')
+parser.add_argument('-f', '--format', choices=['png', 'svg'], default='png', help='Format of the headless plots')
+parser.add_argument('-p', '--processes', type=int, default=None,
+                    help='Number of worker processes (default: number of CPUs)')
+parser.add_argument('--no-zoom', action='store_true', help='Do not render the zoomed-in plots')
+parser.add_argument('--simplify', type=float, default=0.0,
+                    help='Simplify the polygons with this tolerance (map units) before rendering')
+parser.add_argument('--dpi', type=int, default=150, help='Resolution of PNGs and of the rasterized base map')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    solutions = [(dataset, suffix) for dataset in args.datasets
+                 for suffix in (args.suffix if args.suffix is not None else solution_suffixes(dataset))]
+    if args.show:
+        for dataset, suffix in solutions:
+            plot_shapefile_with_highlights(dataset, file_suffix=suffix)
+    else:
+        for written_path in render_solutions(solutions, args.processes, args.format, not args.no_zoom, args.simplify,
+                                             args.dpi):
+            print(f"Saved {written_path}")
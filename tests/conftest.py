@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The modules import each other by bare names, like running with PYTHONPATH=src:src/mip_solving:src/preprocessing
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+for folder in ("preprocessing", "mip_solving", ""):
+    path = os.path.join(SRC_DIR, folder)
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,26 @@
+import math
+
+import pytest
+
+pytest.importorskip("gurobipy")
+
+from benchmarking.synthetic_instances import FACE_AREA, grid_instance
+from graph_utils import graph_from_arrays
+from mip_solver import inverse_polsby_popper_score, model_status, solve_single_district_fractional
+
+
+@pytest.mark.parametrize("method", ["dinkelbach", "bisection"])
+@pytest.mark.parametrize("warm_start", [True, False])
+def test_fractional_solver_finds_square(tmp_path, method, warm_start):
+    # On a 3 x 3 grid with at least 4 cells, a 2 x 2 square (or the whole grid) has the optimal score 4 / pi
+    DG = graph_from_arrays(grid_instance(9))
+    DG.graph['dataset_name'] = "grid_9"
+    DG.graph['gurobi_logfile'] = str(tmp_path / "gurobi.log")
+
+    solution, m = solve_single_district_fractional(DG, area_lower_bound=4 * FACE_AREA, method=method,
+                                                   warm_start=warm_start, params={'TimeLimit': 60})
+
+    assert model_status(m) in (2, 15)  # OPTIMAL or USER_OBJ_LIMIT of the last bisection subproblem
+    assert len(solution) in (4, 9)
+    assert inverse_polsby_popper_score(m) == pytest.approx(4 / math.pi, rel=1e-5)
+    assert m._fractionalRuntime < 60